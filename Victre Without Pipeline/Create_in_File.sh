@@ -12,6 +12,9 @@ export voxels=$(echo "$Source * 2 / 0.05" | bc -l)  # Dynamically calculate voxe
 export voxels=${voxels%.*}  # Convert to integer
 export zvoxels="${zvoxels:-37}"  # Fixed value
 export ZDistance="${ZDistance:-0.0}"
+export Spectrum="${Spectrum:-"spectrum/SPEKTR_Energy_Spectra_NGT_TASMICS/W28kVp_Al700um.spc"}"
+export SpectrumTag="${SpectrumTag:-"kVp[28W]_Filter[Al700um]"}"  # Spectrum in the output image name
+export Suffix="${Suffix:-""}"  # Appended to the output image name, e.g. _Z[20.0]
 
 # Generate JSON data with matching keys for the template
 data=$(jq -n \
@@ -25,7 +28,10 @@ data=$(jq -n \
   --argjson voxels "$voxels" \
   --argjson zvoxels "$zvoxels" \
   --argjson ZDistance "$ZDistance" \
-  '{Simulator: $Simulator, Histories: $Histories, Material: $Material, Size: $Size, Thickness: $Thickness, Phantom: $Phantom, Source: $Source, voxels: $voxels, zvoxels: $zvoxels, ZDistance: $ZDistance}')
+  --arg Spectrum "$Spectrum" \
+  --arg SpectrumTag "$SpectrumTag" \
+  --arg Suffix "$Suffix" \
+  '{Simulator: $Simulator, Histories: $Histories, Material: $Material, Size: $Size, Thickness: $Thickness, Phantom: $Phantom, Source: $Source, voxels: $voxels, zvoxels: $zvoxels, ZDistance: $ZDistance, Spectrum: $Spectrum, SpectrumTag: $SpectrumTag, Suffix: $Suffix}')
 
 # Debugging: Print the generated JSON to verify
 echo "Generated JSON:"
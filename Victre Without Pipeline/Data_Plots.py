@@ -1,12 +1,19 @@
 import pandas as pd
+import matplotlib
+matplotlib.use('Agg')  # Non-interactive backend, the figures are only saved to files (also in the worker processes)
 import matplotlib.pyplot as plt
 import seaborn as sns
 from pathlib import Path
-import cupy as np
+import sqlite3
+import contextlib
+import hashlib
+import json
+from concurrent.futures import ProcessPoolExecutor
 
 ##########################################################################
 ################# EXAMPLE USAGE ###########################################
 # python3 path/to/script.py /path/to/csv/files --output /path/to/output
+# python3 path/to/script.py /path/to/csv/files --output /path/to/output --processes 8 --force
 
 # Global plot parameters
 plt.rcParams.update({
@@ -29,47 +36,48 @@ def ensure_directory(path):
     """Ensure directory exists, creating it and all parent directories if necessary"""
     Path(path).mkdir(parents=True, exist_ok=True)
 
-def plot_ml_sp_ratios(df, output_dir):
-    """Create separate S/P ratio plots for each ML distance"""
+def plot_ml_sp_ratio(ml_data, ml_size, output_dir):
+    """Create the S/P ratio plot of one ML distance, one line per phantom thickness"""
     ensure_directory(output_dir)
+    plt.figure(figsize=(15, 10))
+
+    # For each phantom thickness at this ML distance
+    for thickness in sorted(ml_data['Thickness'].unique()):
+        thick_data = ml_data[ml_data['Thickness'] == thickness]
 
-    # For each ML distance
+        # Get primary and scatter data
+        primary_data = thick_data[thick_data['Stack'] == 'Primary_Stack.raw']
+        scatter_data = thick_data[thick_data['Stack'] == 'Scatter_Stack.raw']
+
+        # Calculate S/P ratio
+        ratio_data = pd.merge(
+            primary_data[['Height_Above_Detector_cm', 'Mean']],
+            scatter_data[['Height_Above_Detector_cm', 'Mean']],
+            on='Height_Above_Detector_cm', suffixes=('_primary', '_scatter')
+        )
+        ratio_data['ratio'] = ratio_data['Mean_scatter'] / ratio_data['Mean_primary']
+
+        # Plot this thickness's S/P ratio
+        plt.plot(ratio_data['Height_Above_Detector_cm'],
+                ratio_data['ratio'],
+                'o-',
+                label=f'Thickness {thickness}cm',
+                markersize=12)
+
+    plt.title(f'Scatter to Primary Ratio - ML Distance {ml_size}cm')
+    plt.xlabel('Height Above Detector (cm)')
+    plt.ylabel(r"$\frac{S}{P}$", fontsize=40)
+    plt.grid(True, alpha=0.3)
+    plt.legend(fontsize=20, title="Phantom Thickness")
+
+    plt.tight_layout()
+    plt.savefig(Path(output_dir) / f'sp_ratio_ML{ml_size}cm.png', bbox_inches='tight', dpi=300)
+    plt.close()
+
+def plot_ml_sp_ratios(df, output_dir):
+    """Create separate S/P ratio plots for each ML distance"""
     for ml_size in sorted(df['PhantomSize'].unique()):
-        plt.figure(figsize=(15, 10))
-        ml_data = df[df['PhantomSize'] == ml_size]
-
-        # For each phantom thickness at this ML distance
-        for thickness in sorted(ml_data['Thickness'].unique()):
-            thick_data = ml_data[ml_data['Thickness'] == thickness]
-
-            # Get primary and scatter data
-            primary_data = thick_data[thick_data['Stack'] == 'Primary_Stack.raw']
-            scatter_data = thick_data[thick_data['Stack'] == 'Scatter_Stack.raw']
-
-            # Calculate S/P ratio
-            ratio_data = pd.merge(
-                primary_data[['Height_Above_Detector_cm', 'Mean']],
-                scatter_data[['Height_Above_Detector_cm', 'Mean']],
-                on='Height_Above_Detector_cm', suffixes=('_primary', '_scatter')
-            )
-            ratio_data['ratio'] = ratio_data['Mean_scatter'] / ratio_data['Mean_primary']
-
-            # Plot this thickness's S/P ratio
-            plt.plot(ratio_data['Height_Above_Detector_cm'],
-                    ratio_data['ratio'],
-                    'o-',
-                    label=f'Thickness {thickness}cm',
-                    markersize=12)
-
-        plt.title(f'Scatter to Primary Ratio - ML Distance {ml_size}cm')
-        plt.xlabel('Height Above Detector (cm)')
-        plt.ylabel(r"$\frac{S}{P}$", fontsize=40)
-        plt.grid(True, alpha=0.3)
-        plt.legend(fontsize=20, title="Phantom Thickness")
-
-        plt.tight_layout()
-        plt.savefig(Path(output_dir) / f'sp_ratio_ML{ml_size}cm.png', bbox_inches='tight', dpi=300)
-        plt.close()
+        plot_ml_sp_ratio(df[df['PhantomSize'] == ml_size], ml_size, output_dir)
 
 def plot_single_csv(df, output_dir, title_prefix=""):
     """Create individual plots for each dataset"""
@@ -134,21 +142,107 @@ def load_and_assign_sizes(csv_dir):
 
     return pd.concat(dfs, ignore_index=True)
 
-def plot_all_data(df, output_dir='plots'):
+def load_from_catalog(catalog_file):
+    """Load the analysis results registered in the results catalog, with their ML and CC sizes"""
+    with contextlib.closing(sqlite3.connect(catalog_file)) as db:
+        rows = db.execute("SELECT path, ml, cc FROM outputs WHERE stage = 'analysis' "
+                          "AND ml IS NOT NULL AND cc IS NOT NULL ORDER BY ml, cc").fetchall()
+
+    dfs = []
+    for path, ml, cc in rows:
+        df = pd.read_csv(path)
+        df['PhantomSize'] = int(ml)
+        df['Thickness'] = int(cc)
+        df['SourceFile'] = Path(path).stem
+        dfs.append(df)
+
+    return pd.concat(dfs, ignore_index=True)
+
+def load_sp_ratios(catalog_file):
+    """
+    Load the S/P statistics written by the SPRatioHook of the Pipeline while projecting, in the layout of
+    the stackanalyzer results so no stacks are needed. The heights are the Z offsets relative to the lowest one.
+    """
+    with contextlib.closing(sqlite3.connect(catalog_file)) as db:
+        df = pd.read_sql_query("SELECT ml, cc, z, mean_primary, std_primary, mean_scatter, std_scatter FROM sp_ratios "
+                               "WHERE signal_found AND ml IS NOT NULL AND cc IS NOT NULL AND z IS NOT NULL", db)
+
+    # repeated projections of the same phantom and Z are averaged
+    df = df.groupby(['ml', 'cc', 'z'], as_index=False).mean()
+    df['Height_Above_Detector_cm'] = df['z'] - df.groupby(['ml', 'cc'])['z'].transform('min')
+
+    dfs = []
+    for stack, suffix in [('Primary_Stack.raw', 'primary'), ('Scatter_Stack.raw', 'scatter')]:
+        dfs.append(pd.DataFrame({'Stack': stack,
+                                 'Height_Above_Detector_cm': df['Height_Above_Detector_cm'],
+                                 'Mean': df[f'mean_{suffix}'],
+                                 'StdDev': df[f'std_{suffix}'],
+                                 'PhantomSize': df['ml'].astype(int),
+                                 'Thickness': df['cc'].astype(int),
+                                 'SourceFile': 'ML_' + df['ml'].astype(int).astype(str) + 'x_' + df['cc'].astype(int).astype(str) + 'cm'}))
+
+    return pd.concat(dfs, ignore_index=True).sort_values(['PhantomSize', 'Thickness', 'Stack', 'Height_Above_Detector_cm'])
+
+# Bump when the figures change, so the cached ones are rendered again
+PLOT_VERSION = 1
+PLOT_COLUMNS = ['Stack', 'Height_Above_Detector_cm', 'Mean', 'Thickness']
+CACHE_FILE = '.plot_cache.json'
+
+def fingerprint(data, *keys):
+    """Hash of the data a figure is drawn from (only the plotted columns, in a stable order) and its keys"""
+    data = data[[c for c in PLOT_COLUMNS if c in data.columns]]
+    data = data.sort_values(list(data.columns), kind='mergesort')
+    digest = hashlib.sha1(json.dumps([PLOT_VERSION, *map(str, keys)]).encode())
+    digest.update(pd.util.hash_pandas_object(data, index=False).values.tobytes())
+    return digest.hexdigest()
+
+def render_figure(figure):
+    """Render one figure in a worker process"""
+    kind, data, key, output_dir = figure
+    if kind == 'single':
+        plot_single_csv(data, output_dir, title_prefix=key)
+    else:
+        plot_ml_sp_ratio(data, key, output_dir)
+
+def plot_all_data(df, output_dir='plots', processes=None, force=False):
+    """
+    Create the per-dataset and per-ML figures. Every figure is fingerprinted with the data it is drawn from,
+    the ones whose data did not change since the last run (and whose file still exists) are skipped,
+    and the rest are rendered in a process pool. force=True renders all of them.
+    """
     output_dir = Path(output_dir)
     ensure_directory(output_dir)
 
-    # Create individual plots for each dataset
+    cache_file = output_dir / CACHE_FILE
+    cache = {}
+    if cache_file.exists() and not force:
+        with open(cache_file) as f:
+            cache = json.load(f)
+
+    # Individual plots for each dataset and ML-specific S/P ratio plots
+    figures = []
     for source_file in df['SourceFile'].unique():
-        single_file_data = df[df['SourceFile'] == source_file]
-        plot_single_csv(
-            single_file_data,
-            output_dir,
-            title_prefix=source_file
-        )
+        figures.append(('single', df[df['SourceFile'] == source_file], source_file,
+                        output_dir / "primary_scatter_plots" / f'{source_file}_analysis.png'))
+    for ml_size in sorted(df['PhantomSize'].unique()):
+        figures.append(('ml', df[df['PhantomSize'] == ml_size], ml_size,
+                        output_dir / f'sp_ratio_ML{ml_size}cm.png'))
 
-    # Create ML-specific S/P ratio plots
-    plot_ml_sp_ratios(df, output_dir)
+    fingerprints = {str(path.relative_to(output_dir)): fingerprint(data, kind, key) for kind, data, key, path in figures}
+    pending = [(kind, data, key, output_dir) for kind, data, key, path in figures
+               if cache.get(str(path.relative_to(output_dir))) != fingerprints[str(path.relative_to(output_dir))] or not path.exists()]
+    print(f"Rendering {len(pending)} of {len(figures)} figures ({len(figures) - len(pending)} unchanged)")
+
+    if len(pending) > 1 and processes != 1:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            list(pool.map(render_figure, pending))
+    else:
+        for figure in pending:
+            render_figure(figure)
+
+    # Only the figures of the current data are kept in the cache
+    with open(cache_file, 'w') as f:
+        json.dump(fingerprints, f, indent=4, sort_keys=True)
 
     # Save processed data
     df.to_csv(output_dir / 'all_data.csv', index=False)
@@ -156,14 +250,28 @@ def plot_all_data(df, output_dir='plots'):
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('csv_dir', help='Directory containing CSV files')
+    parser.add_argument('csv_dir', nargs='?', default=None, help='Directory containing CSV files')
     parser.add_argument('--output', default='plots', help='Output directory for plots')
+    parser.add_argument('--catalog', default=None, help='Results catalog (e.g. results_catalog.db) to load the analysis results from instead of csv_dir')
+    parser.add_argument('--processes', type=int, default=None, help='Number of processes rendering the figures (default: number of CPUs)')
+    parser.add_argument('--force', action='store_true', help='Render all the figures, even the ones whose data did not change')
+    parser.add_argument('--sp-ratios', default=None, help='Database with the S/P ratios computed while projecting (e.g. results_catalog.db), plotted without the stacks')
     args = parser.parse_args()
 
+    if args.sp_ratios:
+        df = load_sp_ratios(args.sp_ratios)
+        plot_all_data(df, args.output, args.processes, args.force)
+        exit(0)
+
+    if args.catalog:
+        df = load_from_catalog(args.catalog)
+        plot_all_data(df, args.output, args.processes, args.force)
+        exit(0)
+
     # Verify input directory exists
-    if not Path(args.csv_dir).exists():
+    if args.csv_dir is None or not Path(args.csv_dir).exists():
         print(f"Error: Input directory '{args.csv_dir}' does not exist")
         exit(1)
 
     df = load_and_assign_sizes(args.csv_dir)
-    plot_all_data(df, args.output)
+    plot_all_data(df, args.output, args.processes, args.force)
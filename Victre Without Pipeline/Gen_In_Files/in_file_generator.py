@@ -1,162 +1,219 @@
 import os
+import re
 import json
+import hashlib
 import datetime
-import sys
+import argparse
+import itertools
+from pathlib import Path
 from jinja2 import Template
-import re
 
-global name_for_bash
-global bash_variable
-bash_variable = []
-
-# function to define each mode
-def mode_selection():
-    # request user input
-    global mode
-    mode = input("Single or batch Mode? ")
-    #different modes
-    if mode == 'single':
-        return(mode)
-    elif mode == 'batch':
-        global parameter
-        parameter = input("What parameter will you be varying? ")
-        global step_size
-        step_size = int(input("What step size will the parameter be varying by? "))
-        global initial_val
-        initial_val = int(input("What is the minimum value for the parameter? "))
-        global end_val
-        end_val = int(input("What is the maximum value of the parameter? "))
-        return(mode, parameter, step_size, initial_val, end_val)
-    else:
-        raise ValueError(f"This mode is not defined yet...")
-
-
-# function to generate the in file
-def GenerateInFiles(simulator, mode):
-    print("Generating in File")
-    global Simulation_date
-    Simulation_date = datetime.datetime.now().strftime("%Y-%m-%d")
-    global particle_histories
-    particle_histories = input("Enter the number of particle histories ( e.g. 5.51e10 )  ")
-    # For my use case this is really just directing where the approriate result directory
-    global material_selection
-    material_selection = input("Enter the Directory to store the images (named by material) ")
-    # Use this dimension to change magnification
-    global z_offset_distance
-    z_offset_distance = float(input("Enter the z-offset of the phantom from the detector "))
-    if z_offset_distance > 0:
-        material_selection = material_selection + "/Mag"
-    print(material_selection)
-    # Again my use case involved a square phantom and so I can describe it with 1 dimension
-    # I use this 1 dimension to locate the approriate result directory
-    global phantom_size
-    phantom_size = float(input("Enter the side ML distance of the phantom ")) # this distance will lated be used to find zvoxels later
-    # Craniocaudal length of the phantom
-    global cc_length
-    cc_length = float(input("Enter the Cranio Caudal distance of the phantom "))
-    if abs(cc_length - 1.9) < 0.01:
-        global t
-        t = "1p9cm"
-    else:
-        t = f"{int(cc_length)}cm"
-    print(t)
-
-    global phantom_name
-    phantom_name = input("Copy paste the name of the phantom you generated ")
-    global source_center
-    source_center = phantom_size / 2 # in cm
-    global number_of_voxels_xy
-    number_of_voxels_xy = int(phantom_size / 0.05) #cm/0.05[cm/voxel]
-    global number_of_voxels_z
-    number_of_voxels_z = int(cc_length / 0.05)  #cm/0.05[cm/voxel]
-    
-    # Change behavior depending on mode
-    if mode == 'single':
-        create_json_and_in_file()
-    elif mode == 'batch':
-        if parameter == 'z':
-            for i in range(int(initial_val), int(end_val), int(step_size)):
-                z_offset_distance = float(i)
-                create_json_and_in_file()
-                bash_variable.append(name_for_bash)
-        else:
-            raise ValueError(f"Unsupported Parameter Value")
-    else:
-        raise ValueError(f"This Mode Has Not Been Programmed Yet...")
-                
-    
-    print("Generated Simulation_Title.in successfully!")
-
-
-def create_json_and_in_file():
-    #create the json input file
-    data = {
-        "Simulator": "#                          ["+ Simulating_indv + ",  " + Simulation_date + "]",
-        "Histories": f"{particle_histories}",
-        "Material": f"{material_selection}",
-        "Size": f"{int(phantom_size)}x{int(phantom_size)}",
-        "Thickness": f"{t}",
-        "Phantom": f"{phantom_name}",
-        "Source": source_center,
-        "voxels": number_of_voxels_xy,
-        "zvoxels": number_of_voxels_z,
-        "ZDistance": z_offset_distance
+################################################################
+###################### EXAMPLE USAGE  ##########################
+# python3 in_file_generator.py --set phantom=BlockPhantom_20cm size=20 thickness=3 --sweep z=5:30:5 histories=5.51e10,1.1e11 --script run_all.sh
+# python3 in_file_generator.py --config base.json --sweep thickness=1.9,3,5 --output-dir InFiles
+# python3 in_file_generator.py --interactive
+# python3 mcgpu_runner.py InFiles --gpus 0,1   # runs the generated files in parallel instead of the --script
+#
+# from in_file_generator import generate_in_files
+# files = generate_in_files({"phantom": "BlockPhantom_20cm", "size": 20, "thickness": 3}, {"z": [5, 10, 15]})
+
+TEMPLATE_FILE = Path(__file__).with_name('MC_GPU_in_File.tmpl')
+
+# Base configuration, every key can be set or swept
+DEFAULT_CONFIG = {
+    "simulator": "",             # Name written in the header of the .in file
+    "histories": "5.51e10",      # Particle histories per projection
+    "material": "Lucite_Block",  # Results directory (named by material), /Mag is added if z > 0
+    "size": 20.0,                # Side ML distance of the (square) phantom [cm]
+    "thickness": 1.9,            # Cranio caudal distance of the phantom [cm]
+    "phantom": "BlockPhantom",   # Name of the phantom file in phantom/NGT/<size>/
+    "z": 0.0,                    # Z offset of the phantom from the detector [cm]
+    "spectrum": "spectrum/SPEKTR_Energy_Spectra_NGT_TASMICS/W28kVp_Al700um.spc"
+}
+SWEEP_KEYS = ["z", "histories", "spectrum", "phantom", "size", "thickness", "material"]
+
+
+def load_template(template_file=TEMPLATE_FILE):
+    """Read and compile the MC-GPU template, once for all the files"""
+    with open(template_file) as f:
+        return Template(f.read())
+
+
+def spectrum_tag(spectrum):
+    """Spectrum part of the output image name, e.g. W28kVp_Al700um.spc -> kVp[28W]_Filter[Al700um]"""
+    stem = Path(spectrum).stem
+    match = re.match(r'W(\d+(?:\.\d+)?)kVp_([^_]+)(_.*)?$', stem)
+    if match:
+        return f"kVp[{match.group(1)}W]_Filter[{match.group(2)}]{match.group(3) or ''}"
+    return f"Spectrum[{stem}]"
+
+
+def template_data(config):
+    """Values of the template placeholders for one configuration"""
+    thickness = float(config["thickness"])
+    z = float(config["z"])
+    return {
+        "Simulator": f"#                          [{config['simulator']}]" if config["simulator"] else "#",
+        "Histories": f"{config['histories']}",
+        "Material": config["material"] + ("/Mag" if z > 0 else ""),
+        "Size": f"{int(float(config['size']))}x{int(float(config['size']))}",
+        "Thickness": "1p9cm" if abs(thickness - 1.9) < 0.01 else f"{int(thickness)}cm",
+        "Phantom": config["phantom"],
+        "Source": float(config["size"]) / 2,  # in cm
+        "voxels": int(float(config["size"]) / 0.05),  # cm/0.05[cm/voxel]
+        "zvoxels": int(thickness / 0.05),  # cm/0.05[cm/voxel]
+        "ZDistance": z,
+        "Spectrum": config["spectrum"],
+        "SpectrumTag": spectrum_tag(config["spectrum"]),
+        "Suffix": f"_Z[{z}]" if z > 0 else ""  # Different output images for every Z
     }
 
-    # Writing to the input.json
-    with open('data.json', 'w') as f:
-        json.dump(data, f, indent=4)
 
-
-    #Load the template
-    with open('MC_GPU_in_File.tmpl') as f:
-        template = Template(f.read())
-
-    #Render the template with data
-    output = template.render(data)
-
-    # Save to output file
-    if z_offset_distance > 0:
-        # If we are in Mag Mode Rename accordingly
-        with open( f"InFiles/{phantom_name}_bit[32R]_size[3584x2816]_Histories[{particle_histories}]_kVp[28W]_Filter[Al700um]_projections[2]_Z[{z_offset_distance}].in", 'w') as f:
-            f.write(output)
-            global name_for_bash
-            name_for_bash = f"{phantom_name}_bit[32R]_size[3584x2816]_Histories[{particle_histories}]_kVp[28W]_Filter[Al700um]_projections[2]_Z[{z_offset_distance}]"
-    else:
-        with open( f"InFiles/{phantom_name}_bit[32R]_size[3584x2816]_Histories[{particle_histories}]_kVp[28W]_Filter[Al700um]_projections[2].in", 'w') as f:
-            f.write(output)
-            name_for_bash = f"{phantom_name}_bit[32R]_size[3584x2816]_Histories[{particle_histories}]_kVp[28W]_Filter[Al700um]_projections[2]_Z[{z_offset_distance}]"
-        
-def Generate_Bash_Script():
-    # Generate the Bash Script
+def parse_values(text):
+    """Values of a swept parameter: a comma-separated list or a start:stop:step range (stop included)"""
+    if ':' in text:
+        start, stop, step = [float(v) for v in text.split(':')]
+        count = int(round((stop - start) / step)) + 1
+        return [round(start + i * step, 6) for i in range(count)]
+    return [v.strip() for v in text.split(',')]
+
+
+def expand_sweep(base, sweep=None):
+    """All the configurations of a sweep (dictionary of parameter to list of values) around a base configuration"""
+    config = dict(DEFAULT_CONFIG, **base)
+    sweep = sweep or {}
+    unknown = set(sweep) - set(SWEEP_KEYS)
+    if unknown:
+        raise ValueError(f"Unsupported sweep parameters: {', '.join(sorted(unknown))} (available: {', '.join(SWEEP_KEYS)})")
+
+    names = sorted(sweep)
+    return [dict(config, **dict(zip(names, values))) for values in itertools.product(*[sweep[n] for n in names])]
+
+
+def output_image(text):
+    """Output image name of a rendered .in file (the OUTPUT IMAGE FILE NAME line)"""
+    for line in text.splitlines():
+        if '# OUTPUT IMAGE FILE NAME' in line:
+            return line.split('#')[0].strip()
+    return None
+
+
+def content_name(config, text):
+    """Stable file name of a rendered .in file: the phantom name and a hash of the content"""
+    return f"{config['phantom']}_{hashlib.sha1(text.encode()).hexdigest()[:12]}"
+
+
+def generate_in_files(base, sweep=None, output_dir="InFiles", template=None, script=None):
+    """
+    Render the .in files of all the configurations of a sweep in one pass. Files are named by the hash of
+    their content, so generating the same sweep again does not write anything new. An index.json in the
+    output directory maps every file to its configuration.
+    Returns the list of (file name, configuration) pairs.
+    """
+    template = template if template is not None else load_template()
+    os.makedirs(output_dir, exist_ok=True)
+
+    index_file = Path(output_dir) / "index.json"
+    index = {}
+    if index_file.exists():
+        with open(index_file) as f:
+            index = json.load(f)
+
+    # Every configuration is rendered first, different files writing the same output images are rejected
+    rendered, images = [], {}
+    for config in expand_sweep(base, sweep):
+        output = template.render(template_data(config))
+        name = content_name(config, output)
+        image = output_image(output)
+        if images.setdefault(image, name) != name:
+            raise ValueError(f"Different configurations write the same output image {image}, "
+                             f"add the parameters they differ in to the output name: {config}")
+        rendered.append((config, output, name))
+
+    files, written = [], 0
+    for config, output, name in rendered:
+        in_file = Path(output_dir) / f"{name}.in"
+        if not in_file.exists():
+            with open(in_file, 'w') as f:
+                f.write(output)
+            written += 1
+        index.setdefault(name, dict(config, created=datetime.datetime.now().strftime("%Y-%m-%d")))
+        files.append((name, config))
+
+    with open(index_file, 'w') as f:
+        json.dump(index, f, indent=4, sort_keys=True)
+    print(f"{len(files)} .in files in {output_dir} ({written} new)")
+
+    if script is not None:
+        generate_bash_script(files, script, output_dir)
+    return files
+
+
+def generate_bash_script(files, script, output_dir="InFiles"):
+    """Write a bash script that runs MC-GPU for every .in file"""
     bash_script = "#!/bin/bash\n\n"
-    
-    # iterate over the in files created and amake an executable bash command
-    for filename in bash_variable:
-        bash_script += f"#{phantom_size}x{phantom_size}cm {cc_length}cm thick\n./MC-GPU_1.5b.x {filename}.in | tee {filename}.out\n\n"
-
-    # save the bash script as a .sh file
-    bash_script += f"\n\n\n\n\necho 'Simulations Completed!'"
-    script_name = f"{phantom_name}_thickness[{cc_length}cm]_Z[{initial_val}cm_to{end_val}_cm].sh"
-    with open(script_name, 'w') as f:
+    for name, config in files:
+        in_file = os.path.join(output_dir, name)
+        bash_script += (f"#{config['size']}x{config['size']}cm {config['thickness']}cm thick, Z = {config['z']}\n"
+                        f"./MC-GPU_1.5b.x {in_file}.in | tee {in_file}.out\n\n")
+    bash_script += "\n\n\n\n\necho 'Simulations Completed!'"
+    with open(script, 'w') as f:
         f.write(bash_script)
-        
     return bash_script
 
 
+def interactive_config():
+    """Ask for the base configuration and a Z sweep, as the previous interactive generator did"""
+    base = {
+        "simulator": input("First Name, Last Name "),
+        "histories": input("Enter the number of particle histories ( e.g. 5.51e10 )  "),
+        "material": input("Enter the Directory to store the images (named by material) "),
+        "z": float(input("Enter the z-offset of the phantom from the detector ")),
+        "size": float(input("Enter the side ML distance of the phantom ")),
+        "thickness": float(input("Enter the Cranio Caudal distance of the phantom ")),
+        "phantom": input("Copy paste the name of the phantom you generated ")
+    }
+    sweep = {}
+    if input("Single or batch Mode? ") == 'batch':
+        parameter = input(f"What parameter will you be varying? ({', '.join(SWEEP_KEYS)}) ")
+        sweep[parameter] = parse_values(input("Enter the values, as start:stop:step or a comma-separated list "))
+    return base, sweep
+
+
+def parse_assignments(assignments):
+    """KEY=VALUE pairs of the command line"""
+    pairs = [a.split('=', 1) for a in assignments or []]
+    if any(len(p) != 2 for p in pairs):
+        raise ValueError("Parameters must be given as KEY=VALUE")
+    return dict(pairs)
+
+
 def main():
-    print("Starting main function...")
-    # User input to start the process
-    global Simulating_indv
-    Simulating_indv = input("First Name, Last Name ")
-    # Mode selection
-    mode_selection()
-    # Generate the in File
-    GenerateInFiles(Simulating_indv, mode)
-    # Generate bash script
-    Generate_Bash_Script()
-  
+    parser = argparse.ArgumentParser(description='Generate MC-GPU .in files for a base configuration and any number of swept parameters')
+    parser.add_argument('--config', default=None, help='JSON file with the base configuration')
+    parser.add_argument('--set', nargs='+', default=None, metavar='KEY=VALUE',
+                        help=f"Base configuration values ({', '.join(DEFAULT_CONFIG)})")
+    parser.add_argument('--sweep', nargs='+', default=None, metavar='KEY=VALUES',
+                        help=f"Swept parameters ({', '.join(SWEEP_KEYS)}) as start:stop:step (stop included) or v1,v2,...")
+    parser.add_argument('--output-dir', default='InFiles', help='Directory of the .in files (default: InFiles)')
+    parser.add_argument('--template', default=str(TEMPLATE_FILE), help='MC-GPU template (default: MC_GPU_in_File.tmpl)')
+    parser.add_argument('--script', default=None, help='Bash script that runs all the simulations')
+    parser.add_argument('--interactive', action='store_true', help='Ask for the configuration instead')
+    args = parser.parse_args()
+
+    if args.interactive:
+        base, sweep = interactive_config()
+    else:
+        base = {}
+        if args.config:
+            with open(args.config) as f:
+                base = json.load(f)
+        base.update(parse_assignments(args.set))
+        sweep = {key: parse_values(values) for key, values in parse_assignments(args.sweep).items()}
+
+    generate_in_files(base, sweep, args.output_dir, load_template(args.template), args.script)
+
 
 if __name__ == "__main__":
-    print("Script is running...")
-    main()
\ No newline at end of file
+    main()
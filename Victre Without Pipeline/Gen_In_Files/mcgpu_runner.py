@@ -0,0 +1,189 @@
+import os
+import sys
+import glob
+import json
+import time
+import queue
+import argparse
+import datetime
+import threading
+import subprocess
+from pathlib import Path
+
+################################################################
+###################### EXAMPLE USAGE  ##########################
+# python3 mcgpu_runner.py InFiles --gpus 0,1,2,3 --mcgpu ./MC-GPU_1.5b.x
+# python3 mcgpu_runner.py InFiles/BP_*.in --log-dir logs --quiet
+# python3 mcgpu_runner.py InFiles --mcgpu ./fake_mcgpu.sh --gpus 0,1   # stand-in binary: any executable taking the .in file
+
+STATUS_FILE = 'status.json'
+
+
+def find_in_files(paths):
+    """The .in files given directly, in directories or as glob patterns, sorted and without duplicates"""
+    in_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            in_files += glob.glob(os.path.join(path, '*.in'))
+        else:
+            in_files += glob.glob(path) if glob.has_magic(path) else [path]
+    return sorted(set(in_files))
+
+
+def output_image(in_file):
+    """Base name of the output images of an .in file (the OUTPUT IMAGE FILE NAME line)"""
+    with open(in_file) as f:
+        for line in f:
+            if '# OUTPUT IMAGE FILE NAME' in line:
+                return line.split('#')[0].strip()
+    return None
+
+
+def detect_gpus():
+    """GPU indices from CUDA_VISIBLE_DEVICES or nvidia-smi, [0] if neither is available"""
+    visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+    if visible:
+        return [gpu.strip() for gpu in visible.split(',') if gpu.strip()]
+    try:
+        listing = subprocess.run(['nvidia-smi', '-L'], capture_output=True, text=True, check=True).stdout
+        gpus = [str(i) for i, line in enumerate(listing.splitlines()) if line.startswith('GPU')]
+        return gpus or ['0']
+    except (OSError, subprocess.CalledProcessError):
+        return ['0']
+
+
+class MCGPURunner:
+    """
+    Run MC-GPU for a set of .in files, one job per GPU at a time (the GPU is selected with CUDA_VISIBLE_DEVICES,
+    so the GPU number in the .in files stays 0). The output of every job is streamed to <log_dir>/<name>.out
+    (and the console), and its state, exit status and timing are recorded in <log_dir>/status.json.
+    Jobs whose output images exist are skipped, unless their last run failed or did not finish.
+    """
+
+    def __init__(self, mcgpu='./MC-GPU_1.5b.x', gpus=None, log_dir='logs', workdir='.', stream=True):
+        self.mcgpu = mcgpu
+        self.gpus = gpus if gpus else detect_gpus()
+        self.log_dir = Path(log_dir)
+        self.workdir = workdir  # The paths in the .in files are relative to it
+        self.stream = stream
+        self.lock = threading.Lock()
+
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        self.status = {}
+        if (self.log_dir / STATUS_FILE).exists():
+            with open(self.log_dir / STATUS_FILE) as f:
+                self.status = json.load(f)
+
+    def _update(self, name, **fields):
+        # status.json is rewritten atomically after every change, so an interrupted run keeps its record
+        with self.lock:
+            self.status.setdefault(name, {}).update(fields)
+            with open(self.log_dir / (STATUS_FILE + '.tmp'), 'w') as f:
+                json.dump(self.status, f, indent=4, sort_keys=True)
+            os.replace(self.log_dir / (STATUS_FILE + '.tmp'), self.log_dir / STATUS_FILE)
+
+    def is_done(self, in_file):
+        """True if the output images of the .in file exist and its last recorded run (if any) succeeded"""
+        output = output_image(in_file)
+        if output is None or not glob.glob(glob.escape(os.path.join(self.workdir, output)) + '*.raw'):
+            return False
+        return self.status.get(Path(in_file).stem, {}).get('state', 'done') == 'done'
+
+    def run_job(self, in_file, gpu):
+        """Run one .in file on one GPU, returns the exit status"""
+        name = Path(in_file).stem
+        log_file = self.log_dir / f'{name}.out'
+        output = output_image(in_file)
+        if output is not None:
+            os.makedirs(os.path.dirname(os.path.join(self.workdir, output)) or '.', exist_ok=True)
+
+        self._update(name, in_file=os.path.abspath(in_file), gpu=gpu, state='running', log=str(log_file),
+                     started=datetime.datetime.now().isoformat(timespec='seconds'), returncode=None, elapsed=None)
+        start = time.perf_counter()
+        try:
+            with open(log_file, 'w') as log:
+                process = subprocess.Popen([self.mcgpu, os.path.abspath(in_file)], cwd=self.workdir,
+                                           env=dict(os.environ, CUDA_VISIBLE_DEVICES=str(gpu)),
+                                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+                for line in process.stdout:
+                    log.write(line)
+                    log.flush()
+                    if self.stream:
+                        print(f"[GPU {gpu}] [{name}] {line}", end='', flush=True)
+                returncode = process.wait()
+        except OSError as e:
+            returncode = -1
+            with open(log_file, 'a') as log:
+                log.write(f"Could not run {self.mcgpu}: {e}\n")
+
+        elapsed = time.perf_counter() - start
+        self._update(name, state='done' if returncode == 0 else 'failed', returncode=returncode,
+                     elapsed=round(elapsed, 3), finished=datetime.datetime.now().isoformat(timespec='seconds'))
+        print(f"[GPU {gpu}] {name} {'finished' if returncode == 0 else f'FAILED ({returncode})'} in {elapsed:.1f} s")
+        return returncode
+
+    def _worker(self, gpu, jobs, results):
+        while True:
+            try:
+                in_file = jobs.get_nowait()
+            except queue.Empty:
+                return
+            results[in_file] = self.run_job(in_file, gpu)
+
+    def run(self, in_files, force=False):
+        """Run all the .in files across the GPUs, returns a dictionary of .in file to exit status (None if skipped)"""
+        # Jobs writing the same output images would overwrite each other on different GPUs
+        images = {}
+        for in_file in in_files:
+            images.setdefault(output_image(in_file), []).append(in_file)
+        collisions = {image: files for image, files in images.items() if image is not None and len(files) > 1}
+        if collisions:
+            raise ValueError("Different .in files write the same output images: " +
+                             "; ".join(f"{image} ({', '.join(files)})" for image, files in collisions.items()))
+
+        results = {}
+        jobs = queue.Queue()
+        for in_file in in_files:
+            if not force and self.is_done(in_file):
+                results[in_file] = None
+            else:
+                jobs.put(in_file)
+        print(f"{jobs.qsize()} jobs to run on GPUs {', '.join(map(str, self.gpus))} ({len(results)} already done)")
+
+        # One thread per GPU, each one runs its jobs one after another
+        threads = [threading.Thread(target=self._worker, args=(gpu, jobs, results)) for gpu in self.gpus]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run MC-GPU for a set of .in files across the available GPUs')
+    parser.add_argument('in_files', nargs='+', help='.in files, directories containing them or glob patterns')
+    parser.add_argument('--mcgpu', default='./MC-GPU_1.5b.x', help='MC-GPU binary, or a stand-in taking the .in file (default: ./MC-GPU_1.5b.x)')
+    parser.add_argument('--gpus', default=None, help='Comma-separated GPU indices (default: CUDA_VISIBLE_DEVICES or all the GPUs listed by nvidia-smi)')
+    parser.add_argument('--log-dir', default='logs', help='Directory of the job logs and status.json (default: logs)')
+    parser.add_argument('--workdir', default='.', help='Directory MC-GPU runs in, the paths in the .in files are relative to it (default: .)')
+    parser.add_argument('--force', action='store_true', help='Run the jobs whose output images already exist')
+    parser.add_argument('--quiet', action='store_true', help='Only write the MC-GPU output to the logs, not to the console')
+    args = parser.parse_args()
+
+    in_files = find_in_files(args.in_files)
+    if not in_files:
+        print("No .in files found")
+        sys.exit(1)
+
+    runner = MCGPURunner(args.mcgpu, args.gpus.split(',') if args.gpus else None, args.log_dir, args.workdir, not args.quiet)
+    results = runner.run(in_files, args.force)
+
+    failed = [in_file for in_file, returncode in results.items() if returncode not in (0, None)]
+    print(f"{sum(r == 0 for r in results.values())} finished, {sum(r is None for r in results.values())} skipped, {len(failed)} failed")
+    for in_file in failed:
+        print(f"  FAILED: {in_file} (log: {runner.status[Path(in_file).stem]['log']})")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
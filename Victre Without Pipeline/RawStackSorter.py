@@ -1,7 +1,10 @@
 import os
+import glob
+import sqlite3
 import argparse
-#import numpy as np
-import cupy as np   #If you want to use CUPY instead of NUMPY
+import contextlib
+import numpy as np   # The stacks are assembled in memory-mapped files, on the host
+from array_backend import BACKENDS, get_backend, to_device, to_host
 import re
 
 ################################################################
@@ -36,6 +39,19 @@ def custom_sort_key(filename):
     """
     return extract_sort_value(filename)
 
+def catalog_file_list(catalog_file, input_folder):
+    """
+    Query the results catalog written by the Pipeline for the projections in the input folder,
+    sorted by their Z value, instead of listing the folder and parsing the file names.
+    Returns a list of file names.
+    """
+    input_folder = os.path.abspath(input_folder)
+    with contextlib.closing(sqlite3.connect(catalog_file)) as db:
+        rows = db.execute("SELECT path FROM outputs WHERE stage = 'project' AND path GLOB ? ORDER BY z, path",
+                          (os.path.join(glob.escape(input_folder), '*_0002.raw'),)).fetchall()
+    # GLOB also matches the subfolders, only the files directly in the input folder are stacked
+    return [os.path.basename(path) for (path,) in rows if os.path.dirname(path) == input_folder]
+
 
 
 def main():
@@ -47,8 +63,11 @@ def main():
     parser.add_argument('--width', type=int, required=True, help='Width of each image slice.')
     parser.add_argument('--height', type=int, required=True, help='Height of each image slice.')
     parser.add_argument('--dtype', default='float32', choices=['uint8', 'uint16', 'float32'], help='Data type of the pixel data.')
+    parser.add_argument('--catalog', default=None, help='Results catalog written by the Pipeline (e.g. results_catalog.db), used instead of listing the input folder.')
+    parser.add_argument('--backend', default=None, choices=BACKENDS, help='Array backend for the subtraction (default: VICTRE_BACKEND environment variable or numpy).')
 
     args = parser.parse_args()
+    xp = get_backend(args.backend)
 
     # Create output directories if they don't exist
     os.makedirs(args.output_folder1, exist_ok=True)
@@ -70,15 +89,13 @@ def main():
     slice_size = args.width * args.height * bytes_per_pixel
     expected_length = slice_size * 2  # two slices
 
-    # Initialize lists to hold all slices for each stack
-    stack1_slices = []  # Primary+Scatter
-    stack2_slices = []  # Primary
-    stack3_slices = []  # Scatter (difference)
-
     # Get list of raw image files
-    file_list = [f for f in os.listdir(args.input_folder)
-                 if f.endswith('_0002.raw')]
-    file_list.sort(key=custom_sort_key)
+    if args.catalog:
+        file_list = catalog_file_list(args.catalog, args.input_folder)
+    else:
+        file_list = [f for f in os.listdir(args.input_folder)
+                     if f.endswith('_0002.raw')]
+        file_list.sort(key=custom_sort_key)
 
     # Print the sorted order with the sorting values for verification
     print("\nSorted files to process:")
@@ -88,58 +105,96 @@ def main():
         print(f"{type_str}[{value}] - {f}")
     print(f"\nTotal files found: {len(file_list)}")
 
-    for idx, filename in enumerate(file_list):
-        filepath = os.path.join(args.input_folder, filename)
+    # Count the files with the expected size first, so the stacks can be preallocated
+    valid_list = []
+    for filename in file_list:
+        file_size = os.path.getsize(os.path.join(args.input_folder, filename))
+        if file_size != expected_length:
+            print(f"File {filename} has unexpected size: {file_size} bytes vs expected {expected_length} bytes")
+            continue
+        valid_list.append(filename)
 
-        try:
-            with open(filepath, 'rb') as f:
-                data = f.read()
+    if not valid_list:
+        print("No valid files to stack")
+        return
 
-            if len(data) != expected_length:
-                print(f"File {filename} has unexpected size: {len(data)} bytes vs expected {expected_length} bytes")
-                continue
+    # Save each stack as a single file
+    stack1_path = os.path.join(args.output_folder1, 'Primary+Scatter_Stack.raw')
+    stack2_path = os.path.join(args.output_folder2, 'Primary_Stack.raw')
+    stack3_path = os.path.join(args.output_folder3, 'Scatter_Stack.raw')
 
-            # Split the data into two slices
-            data_slice1 = data[:slice_size]
-            data_slice2 = data[slice_size:]
+    # Preallocate the 3D stacks (stack_size × height × width) as memory maps of the output files,
+    # each slice is written straight into its position so only one slice is in memory at a time
+    try:
+        shape = (len(valid_list), args.height, args.width)
+        stack1 = np.memmap(stack1_path, dtype=np_dtype, mode='w+', shape=shape)  # Primary+Scatter
+        stack2 = np.memmap(stack2_path, dtype=np_dtype, mode='w+', shape=shape)  # Primary
+        stack3 = np.memmap(stack3_path, dtype=np_dtype, mode='w+', shape=shape)  # Scatter (difference)
+    except Exception as e:
+        print(f"Error saving stacks: {str(e)}")
+        return
 
-            # Convert data to numpy arrays for processing
-            arr_slice1 = np.frombuffer(data_slice1, dtype=np_dtype).reshape((args.height, args.width))
-            arr_slice2 = np.frombuffer(data_slice2, dtype=np_dtype).reshape((args.height, args.width))
+    failed = set()
+    for idx, filename in enumerate(valid_list):
+        filepath = os.path.join(args.input_folder, filename)
 
-            # Compute subtraction while maintaining the original data type
-            arr_result = np.subtract(arr_slice1, arr_slice2, dtype=np_dtype)
+        try:
+            with open(filepath, 'rb') as f:
+                # Read each slice at its offset directly into the stacks
+                f.seek(0)
+                if f.readinto(stack1[idx]) != slice_size:
+                    raise IOError("file truncated while reading")
+                f.seek(slice_size)
+                if f.readinto(stack2[idx]) != slice_size:
+                    raise IOError("file truncated while reading")
 
-            # Append each slice to its respective stack
-            stack1_slices.append(arr_slice1)
-            stack2_slices.append(arr_slice2)
-            stack3_slices.append(arr_result)
+            # Compute subtraction while maintaining the original data type
+            if xp is np:
+                np.subtract(stack1[idx], stack2[idx], out=stack3[idx])
+            else:
+                # Device round trip, the memmaps live on the host
+                stack3[idx] = to_host(xp.subtract(to_device(stack1[idx], xp), to_device(stack2[idx], xp), dtype=np_dtype))
 
-            print(f"Processed file {idx + 1}/{len(file_list)}: {filename}")
+            print(f"Processed file {idx + 1}/{len(valid_list)}: {filename}")
 
         except Exception as e:
+            # The slice is dropped from the stacks, never left filled with zeros
+            failed.add(idx)
             print(f"Error processing {filename}: {str(e)}")
             continue
 
-    # Convert lists of arrays into 3D arrays (stack_size × height × width)
-    stack1 = np.stack(stack1_slices)
-    stack2 = np.stack(stack2_slices)
-    stack3 = np.stack(stack3_slices)
-
-    # Save each stack as a single file
-    stack1_path = os.path.join(args.output_folder1, 'Primary+Scatter_Stack.raw')
-    stack2_path = os.path.join(args.output_folder2, 'Primary_Stack.raw')
-    stack3_path = os.path.join(args.output_folder3, 'Scatter_Stack.raw')
+    # Move the slices after the failed ones down over them, the stack files are shortened once flushed
+    n_slices = 0
+    for idx in range(len(valid_list)):
+        if idx in failed:
+            continue
+        if idx != n_slices:
+            stack1[n_slices] = stack1[idx]
+            stack2[n_slices] = stack2[idx]
+            stack3[n_slices] = stack3[idx]
+        n_slices += 1
+    if failed:
+        print(f"Dropped {len(failed)} files that could not be processed")
 
     try:
-        stack1.tofile(stack1_path)
-        stack2.tofile(stack2_path)
-        stack3.tofile(stack3_path)
-
+        stack1.flush()
+        stack2.flush()
+        stack3.flush()
+        del stack1, stack2, stack3
+        if n_slices == 0:
+            for stack_path in [stack1_path, stack2_path, stack3_path]:
+                os.remove(stack_path)
+            print("No valid files to stack")
+            return
+        if failed:
+            for stack_path in [stack1_path, stack2_path, stack3_path]:
+                os.truncate(stack_path, n_slices * slice_size)
+
+        shape = (n_slices, args.height, args.width)
         print("\nStack sizes:")
-        print(f"Primary+Scatter Stack: {stack1.shape}")
-        print(f"Primary Stack: {stack2.shape}")
-        print(f"Scatter Stack: {stack3.shape}")
+        print(f"Primary+Scatter Stack: {shape}")
+        print(f"Primary Stack: {shape}")
+        print(f"Scatter Stack: {shape}")
         print(f"\nStacks have been saved successfully")
 
     except Exception as e:
@@ -0,0 +1,58 @@
+import os
+import numpy
+
+################################################################
+###################### EXAMPLE USAGE  ##########################
+# xp = get_backend(args.backend)       # --backend cupy, or VICTRE_BACKEND=cupy
+# image = to_device(numpy_memmap[i], xp)
+# to_host(xp.subtract(a, b)).tofile(path)
+
+BACKENDS = ['numpy', 'cupy']
+
+
+def get_backend(name=None):
+    """
+    Return the array module used for the computations: NumPy (default) or CuPy, selected by name or
+    by the VICTRE_BACKEND environment variable. Falls back to NumPy if CuPy or a GPU is not available.
+    """
+    name = (name or os.environ.get('VICTRE_BACKEND', 'numpy')).lower()
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown array backend: {name} (available: {', '.join(BACKENDS)})")
+    if name == 'cupy':
+        try:
+            import cupy
+            cupy.cuda.runtime.getDeviceCount()
+            return cupy
+        except Exception as e:
+            print(f"CuPy backend not available ({e}), falling back to NumPy")
+    return numpy
+
+
+def is_device_array(array):
+    """
+    True for arrays in GPU memory (CuPy arrays)
+    """
+    return hasattr(array, '__cuda_array_interface__')
+
+
+def to_device(array, xp):
+    """
+    Move a host array (e.g. read from a file or a memmap) to the backend, without a copy for NumPy
+    """
+    return xp.asarray(array)
+
+
+def to_host(array):
+    """
+    Move an array back to the host, before writing it to a file or a memmap or using it with pandas
+    """
+    if is_device_array(array):
+        return array.get()
+    return numpy.asarray(array)
+
+
+def to_scalar(value):
+    """
+    Convert a 0-d backend array (e.g. a reduction) to a Python float
+    """
+    return float(to_host(value))
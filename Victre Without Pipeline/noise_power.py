@@ -0,0 +1,222 @@
+import numpy as np   # The NPS engine runs on the CPU, on the memory-mapped stacks
+from scipy import fft
+import pandas as pd
+from pathlib import Path
+import argparse
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from stackanalyzer import open_stack
+
+
+################################################################
+###################### EXAMPLE USAGE  ##########################
+# python3 /pathtoscript/noise_power.py /path/to/stack --output nps.csv --tile-size 128 --threads 8
+# python3 /pathtoscript/noise_power.py /path/to/projections --pattern '*_0002.raw' --region 200 1200 2400 3400
+
+logger = logging.getLogger('noise_power')
+
+# MC-GPU detector pixel: 30.464 cm / 3584 pixels = 85 micron
+DEFAULT_PIXEL_SIZE = 0.085  # mm
+DETREND_ORDERS = {'mean': 0, 'plane': 1, 'quadratic': 2}
+
+
+def detrend_basis(tile_size, order):
+    """Polynomial surfaces (constant, plane or quadratic) over a tile, as a (pixels, terms) design matrix"""
+    y, x = np.mgrid[0:tile_size, 0:tile_size] / (tile_size - 1) - 0.5
+    terms = [np.ones_like(x)]
+    if order >= 1:
+        terms += [x, y]
+    if order >= 2:
+        terms += [x * x, y * y, x * y]
+    return np.stack([t.ravel() for t in terms], axis=1)
+
+
+def extract_tiles(image, tile_size, stride, region=None):
+    """Cut a slice (or its region top, bottom, left, right) into square tiles, returns (tiles, N, N) and their top-left corners"""
+    top, left = 0, 0
+    if region is not None:
+        top, bottom, left, right = region
+        image = image[top:bottom, left:right]
+    windows = np.lib.stride_tricks.sliding_window_view(image, (tile_size, tile_size))[::stride, ::stride]
+    rows, cols = np.meshgrid(np.arange(windows.shape[0]) * stride + top,
+                             np.arange(windows.shape[1]) * stride + left, indexing='ij')
+    return windows.reshape(-1, tile_size, tile_size), np.stack([rows.ravel(), cols.ravel()], axis=1)
+
+
+def uniform_tiles(residuals, tolerance):
+    """
+    Mask of the tiles of a uniform background: the tiles whose standard deviation after detrending is at most
+    (1 + tolerance) times the median one. Tiles over the signal edges or other structures are left out,
+    smooth trends such as the heel effect are not.
+    """
+    stds = residuals.std(axis=1)
+    return stds <= (1 + tolerance) * np.median(stds)
+
+
+def radial_average(nps, tile_size, pixel_size):
+    """
+    Radial average of one-sided (rfft) 2D NPS in bins of 1/(N pixel size), the columns that stand for
+    both halves of the spectrum are weighted twice. Returns the bin frequencies and the averages.
+    """
+    fy = fft.fftfreq(tile_size, pixel_size)
+    fx = fft.rfftfreq(tile_size, pixel_size)
+    frequency = np.hypot(fy[:, None], fx[None, :])
+    df = 1 / (tile_size * pixel_size)
+    bins = np.rint(frequency / df).astype(int).ravel()
+
+    weights = np.full(len(fx), 2.0)
+    weights[0] = 1
+    if tile_size % 2 == 0:
+        weights[-1] = 1  # Nyquist column
+    weights = np.broadcast_to(weights, frequency.shape).ravel()
+
+    num_bins = tile_size // 2 + 1
+    keep = bins < num_bins
+    counts = np.bincount(bins[keep], weights=weights[keep], minlength=num_bins)
+    sums = np.bincount(bins[keep], weights=(nps.ravel() * weights)[keep], minlength=num_bins)
+    return np.arange(num_bins) * df, sums / counts
+
+
+class NoisePowerAnalyzer:
+    def __init__(self, tile_size=128, stride=None, detrend='plane', tolerance=0.5, region=None,
+                 pixel_size=DEFAULT_PIXEL_SIZE, threads=4, shape=None, dtype=None):
+        self.tile_size = tile_size
+        self.stride = stride if stride is not None else tile_size  # Non-overlapping tiles by default
+        self.tolerance = tolerance
+        self.region = region  # top, bottom, left, right of the background region, the whole slice by default
+        self.pixel_size = pixel_size  # mm
+        self.threads = threads
+        self.shape = shape  # Slice shape and dtype of the stacks without metadata
+        self.dtype = dtype
+
+        # Least-squares projection on the detrending surfaces, shared by all the tiles
+        self.basis = detrend_basis(tile_size, DETREND_ORDERS[detrend])
+        self.basis_pinv = np.linalg.pinv(self.basis)
+
+    def slice_nps(self, image):
+        """
+        2D NPS of one slice: its uniform tiles are detrended and transformed with one real FFT over all
+        the tiles. Returns the NPS (N, N/2 + 1) in units^2 mm^2 and the slice statistics.
+        """
+        n = self.tile_size
+        tiles, _ = extract_tiles(image, n, self.stride, self.region)
+        flat = tiles.reshape(len(tiles), -1).astype(np.float64)
+        residuals = flat - (flat @ self.basis_pinv.T) @ self.basis.T
+
+        uniform = uniform_tiles(residuals, self.tolerance)
+        if not uniform.any():
+            return None, {'Tiles': 0}
+        mean = flat[uniform].mean()
+        flat = residuals[uniform]
+        tiles = flat.reshape(-1, n, n)
+
+        spectra = fft.rfft2(tiles, axes=(1, 2))
+        nps = (np.abs(spectra) ** 2).mean(axis=0) * self.pixel_size ** 2 / (n * n)
+
+        std = np.sqrt(np.mean(flat * flat))
+        return nps, {'Tiles': len(tiles),
+                     'Mean': mean,
+                     'StdDev': std,
+                     'SNR': mean / std if std > 0 else np.nan}
+
+    def process_stack(self, stack_path):
+        """NPS of every slice of a stack, the slices are processed by a pool of threads"""
+        stack = open_stack(stack_path, self.shape, self.dtype)
+        filename = Path(stack_path).name
+        start = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            slice_results = list(pool.map(self.slice_nps, stack))
+
+        radial, summary, spectra = [], [], np.full((len(stack), self.tile_size, self.tile_size // 2 + 1), np.nan)
+        for i, (nps, stats) in enumerate(slice_results):
+            info = {'Stack': filename,
+                    'Height_Above_Detector_cm': i * 5,  # Each slice is 5cm increment
+                    'Slice': i + 1}
+            if nps is None:
+                logger.warning(f"{filename} slice {i+1}: no uniform tiles found")
+                summary.append({**info, **stats})
+                continue
+            spectra[i] = nps
+            frequency, nps_radial = radial_average(nps, self.tile_size, self.pixel_size)
+            radial.append(pd.DataFrame({**info, 'Frequency_cycles_per_mm': frequency, 'NPS': nps_radial}))
+            summary.append({**info, **stats})
+
+        logger.info(f"{filename}: {len(stack)} slices in {time.perf_counter() - start:.1f} s")
+        radial = pd.concat(radial, ignore_index=True) if radial else pd.DataFrame()
+        return radial, pd.DataFrame(summary), spectra
+
+
+if __name__ == "__main__":
+    # Take arguments
+    parser = argparse.ArgumentParser(description='Noise power spectra of raw image stacks')
+    parser.add_argument('input_directory', type=str, help='Directory containing raw stack (or projection) files')
+    parser.add_argument('--pattern', type=str, default='*.raw',
+                       help='Pattern to match stack files (default: *.raw)')
+    parser.add_argument('--output', type=str, default='nps_results.csv',
+                       help='Output CSV file of the radial NPS, the slice statistics go to <output>_summary.csv (default: nps_results.csv)')
+    parser.add_argument('--tile-size', type=int, default=128,
+                       help='Size of the square tiles in pixels (default: 128)')
+    parser.add_argument('--stride', type=int, default=None,
+                       help='Distance between tiles in pixels, e.g. half the tile size for overlapping tiles (default: tile size)')
+    parser.add_argument('--detrend', type=str, default='plane', choices=list(DETREND_ORDERS),
+                       help='Surface subtracted from every tile (default: plane)')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                       help='Tiles whose detrended standard deviation exceeds the median one by more than this fraction are not uniform (default: 0.5)')
+    parser.add_argument('--region', type=int, nargs=4, default=None,
+                       help='Background region as top bottom left right (default: whole slice)')
+    parser.add_argument('--pixel-size', type=float, default=DEFAULT_PIXEL_SIZE,
+                       help='Detector pixel size in mm (default: 0.085)')
+    parser.add_argument('--threads', type=int, default=4,
+                       help='Number of slices processed in parallel threads (default: 4)')
+    parser.add_argument('--save-2d', type=str, default=None,
+                       help='Folder where the 2D NPS of every stack is saved as <stack>_nps.npy (slices, N, N/2 + 1)')
+    parser.add_argument('--shape', type=int, nargs=2, default=None,
+                       help='Slice shape as height width of the stacks without metadata (default: 2816 3584)')
+    parser.add_argument('--dtype', type=str, default=None, choices=['uint8', 'uint16', 'float32'],
+                       help='Data type of the stacks without metadata (default: float32)')
+    parser.add_argument('--log-level', type=str, default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                       help='Diagnostics level (default: INFO)')
+
+    # parse them
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(message)s')
+
+    data_dir = Path(args.input_directory)
+    if not data_dir.exists():
+        print(f"Directory {data_dir} does not exist")
+        exit(1)
+
+    stack_paths = sorted(data_dir.glob(args.pattern))
+    if not stack_paths:
+        print(f"No files matching {args.pattern} found in {data_dir}")
+        exit(1)
+    print(f"Found {len(stack_paths)} stack files")
+
+    analyzer = NoisePowerAnalyzer(args.tile_size, args.stride, args.detrend, args.tolerance, args.region,
+                                  args.pixel_size, args.threads, tuple(args.shape) if args.shape else None, args.dtype)
+    if args.save_2d:
+        Path(args.save_2d).mkdir(parents=True, exist_ok=True)
+
+    all_radial, all_summary = [], []
+    for stack_path in stack_paths:
+        try:
+            radial, summary, spectra = analyzer.process_stack(stack_path)
+        except Exception as e:
+            print(f"Error processing {stack_path}: {str(e)}")
+            continue
+        all_radial.append(radial)
+        all_summary.append(summary)
+        if args.save_2d:
+            np.save(Path(args.save_2d) / f"{stack_path.stem}_nps.npy", spectra)
+
+    all_radial = [radial for radial in all_radial if not radial.empty]
+    if not all_radial:
+        print("No results were generated")
+        exit(1)
+
+    pd.concat(all_radial, ignore_index=True).to_csv(args.output, index=False)
+    summary_output = str(Path(args.output).with_suffix('')) + '_summary.csv'
+    pd.concat(all_summary, ignore_index=True).to_csv(summary_output, index=False)
+    print(f"Radial NPS saved to {args.output}, slice statistics saved to {summary_output}")
@@ -1,19 +1,132 @@
-# import numpy as np
-import cupy as np   # Now you dont have to change anything but this comment
+import numpy as np   # Host arrays, the computations run on the backend selected with --backend
 from scipy import ndimage
 import pandas as pd
 from pathlib import Path
 import argparse
+import glob
+import re
+import json
+import logging
+import sqlite3
+import datetime
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+from array_backend import BACKENDS, get_backend, to_device, to_host, to_scalar
 
 
 ################################################################
 ###################### EXAMPLE USAGE  ##########################
 # python3 /pathtoscript/stackanalyzer.py /path/to/stack --output '/path/to/output/Mag_5x5_1p9cm.csv'
+# python3 /pathtoscript/stackanalyzer.py /path/to/stack --processes 4 --log-level DEBUG
+# python3 /pathtoscript/stackanalyzer.py /path/to/stack --roi-grid 10x10 20x20 50x50 --roi-offsets 0,0 -10,0 10,0 --grid-output roi_grid.csv
+
+logger = logging.getLogger('stackanalyzer')
+
+# Slice shape and data type of the stacks without metadata (MC-GPU image_pixels 3584 x 2816)
+DEFAULT_SHAPE = (2816, 3584)
+DEFAULT_DTYPE = np.float32
+
+# Stack names written by StackSort, they share the sidecar index <prefix>_Stack_index.json
+STACK_SUFFIXES = ['_Primary_plus_Scatter_Stack.raw', '_Primary_Stack.raw', '_Scatter_Stack.raw']
+# Same element types and parsing as Victre_Tools.read_mhd, which cannot be imported here: the standalone tools
+# run without the Victre package (its __init__ imports the whole pipeline and its dependencies)
+MHD_DTYPES = {'MET_UCHAR': np.uint8, 'MET_CHAR': np.int8, 'MET_USHORT': np.uint16, 'MET_SHORT': np.int16,
+              'MET_UINT': np.uint32, 'MET_INT': np.int32, 'MET_FLOAT': np.float32, 'MET_DOUBLE': np.float64}
+
+
+def read_mhd(filename):
+    """Read an .mhd header as Victre_Tools.read_mhd does, numeric values are converted to int or float"""
+    def _parse(value):
+        if value.replace(".", "").replace("-", "").isnumeric():
+            return float(value) if "." in value else int(value)
+        return value
+
+    data = {}
+    with open(filename, 'r') as f:
+        for line in f:
+            s = re.search("([a-zA-Z]*) = (.*)", line)
+            if s is None:
+                continue
+            data[s[1]] = [_parse(value) for value in s[2].split(' ')] if " " in s[2] else _parse(s[2])
+    return data
+
+
+def stack_metadata(stack_path):
+    """Read (height, width, dtype) of the slices of a stack from the StackSort sidecar index or an .mhd header, None if there is none"""
+    stack_path = Path(stack_path)
+    for suffix in STACK_SUFFIXES:
+        if stack_path.name.endswith(suffix):
+            index_file = stack_path.with_name(stack_path.name[:-len(suffix)] + '_Stack_index.json')
+            if index_file.exists():
+                with open(index_file, 'r') as f:
+                    index = json.load(f)
+                return index['height'], index['width'], np.dtype(index['dtype'])
+            break
+
+    mhd_file = stack_path.with_suffix('.mhd')
+    if mhd_file.exists():
+        header = read_mhd(mhd_file)
+        dim_size = np.atleast_1d(header['DimSize'])
+        return int(dim_size[1]), int(dim_size[0]), np.dtype(MHD_DTYPES[header['ElementType']])
+    return None
+
+
+def open_stack(stack_path, shape=None, dtype=None):
+    """Memory-map a stack as (slices, height, width), the slice shape comes from its metadata, the given shape or the default one"""
+    metadata = stack_metadata(stack_path)
+    if metadata is not None:
+        height, width, dtype = metadata
+    else:
+        height, width = shape if shape is not None else DEFAULT_SHAPE
+        dtype = np.dtype(dtype if dtype is not None else DEFAULT_DTYPE)
+
+    total_pixels = Path(stack_path).stat().st_size // dtype.itemsize
+    num_pixels_per_slice = height * width
+    num_slices = total_pixels // num_pixels_per_slice
+
+    logger.debug(f"\nStack Diagnostics for {Path(stack_path).name}:")
+    logger.debug(f"Total pixels in file: {total_pixels}")
+    logger.debug(f"Pixels per slice: {num_pixels_per_slice}")
+    logger.debug(f"Number of complete slices: {num_slices}")
+    logger.debug(f"Remainder pixels: {total_pixels % num_pixels_per_slice}")
+    if total_pixels % num_pixels_per_slice != 0:
+        logger.warning(f"WARNING: Raw data size of {Path(stack_path).name} is not an exact multiple of slice size!")
+
+    return np.memmap(str(stack_path), dtype=dtype, mode='r', shape=(num_slices, height, width))
+
+
+def integral_images(image, xp):
+    """Summed-area tables of an image and of its square, in float64 and padded with a row and a column of zeros"""
+    image = image.astype(xp.float64)
+    tables = xp.zeros((2, image.shape[0] + 1, image.shape[1] + 1), dtype=xp.float64)
+    tables[0, 1:, 1:] = image.cumsum(axis=0).cumsum(axis=1)
+    tables[1, 1:, 1:] = (image * image).cumsum(axis=0).cumsum(axis=1)
+    return tables
+
+
+def rectangle_sums(tables, top, bottom, left, right):
+    """Sums of the rectangles [top, bottom) x [left, right) from summed-area tables, four lookups per rectangle"""
+    return tables[:, bottom, right] - tables[:, top, right] - tables[:, bottom, left] + tables[:, top, left]
+
+
+def parse_roi_grid(roi_sizes, offsets):
+    """Parse ROI sizes given as HEIGHTxWIDTH and center offsets given as DY,DX"""
+    sizes = [tuple(int(v) for v in size.lower().split('x')) for size in roi_sizes]
+    shifts = [tuple(int(v) for v in offset.split(',')) for offset in offsets]
+    if any(len(size) != 2 for size in sizes) or any(len(shift) != 2 for shift in shifts):
+        raise ValueError("ROI sizes must be given as HEIGHTxWIDTH and offsets as DY,DX")
+    return sizes, shifts
 
 
 class SignalROIAnalyzer:
-    def __init__(self, roi_size=(20, 20)): # ROI is 1cm x 1cm
+    x_center = 1795  # Fixed center in X
+    window_size = 10  # Might need to adjust based on spread
+
+    def __init__(self, roi_size=(20, 20), xp=None, shape=None, dtype=None): # ROI is 1cm x 1cm
         self.roi_size = roi_size
+        self.xp = xp if xp is not None else get_backend()  # NumPy or CuPy
+        self.shape = shape  # Slice shape and dtype of the stacks without metadata
+        self.dtype = dtype
 
     # So we know the image is centered in x because we did so in the in file
     # Find where the signal is max for scatter only and min for Primary and Primary + Scatter
@@ -21,70 +134,70 @@ class SignalROIAnalyzer:
     # it means those x-rays were absorbed and vice versa
     def find_signal_region(self, image, filename):
         """Find the center of the signal region based on slice height and stack type"""
-        x_center = 1795  # Fixed center in X
+        x_center = self.x_center
 
         # Debug section 1: Image stats
-        print(f"\n=== Processing {filename} ===")
-        print(f"Image shape: {image.shape}")
-        print(f"Image value range: {np.min(image):.2f} to {np.max(image):.2f}")
+        logger.debug(f"\n=== Processing {filename} ===")
+        logger.debug(f"Image shape: {image.shape}")
+        logger.debug(f"Image value range: {to_scalar(self.xp.min(image)):.2f} to {to_scalar(self.xp.max(image)):.2f}")
 
         # Get slice number from slice info in filename or data
         # Slice height mapping: 1=5cm, 2=10cm, 3=15cm, 4=20cm, 5=25cm, 6=30cm
 
         # Use intensity profile to center in Y direction
-        window_size = 10  # Might need to adjust based on spread
+        window_size = self.window_size
         y_profile = image[:, x_center-window_size:x_center+window_size].mean(axis=1)
 
-        print(f"\nProfile Analysis:")
-        print(f"Y profile length: {len(y_profile)}")
-        print(f"Y profile range: {np.min(y_profile):.2f} to {np.max(y_profile):.2f}")
+        logger.debug(f"\nProfile Analysis:")
+        logger.debug(f"Y profile length: {len(y_profile)}")
+        logger.debug(f"Y profile range: {to_scalar(self.xp.min(y_profile)):.2f} to {to_scalar(self.xp.max(y_profile)):.2f}")
 
         if filename == "Scatter_Stack.raw":
             # Scatter maintains its peak characteristic across heights
-            y_center = np.argmax(y_profile)
-            print(f"Scatter stack: finding maximum signal at y={y_center}")
+            y_center = int(self.xp.argmax(y_profile))
+            logger.debug(f"Scatter stack: finding maximum signal at y={y_center}")
         else:
             # For Primary and Primary+Scatter:
-            min_val = np.min(y_profile)
-            max_val = np.max(y_profile)
+            min_val = to_scalar(self.xp.min(y_profile))
+            max_val = to_scalar(self.xp.max(y_profile))
             value_range = max_val - min_val
 
-            print(f"\nSignal Detection Values:")
-            print(f"Min value: {min_val:.2f}")
-            print(f"Max value: {max_val:.2f}")
-            print(f"Value range: {value_range:.2f}")
+            logger.debug(f"\nSignal Detection Values:")
+            logger.debug(f"Min value: {min_val:.2f}")
+            logger.debug(f"Max value: {max_val:.2f}")
+            logger.debug(f"Value range: {value_range:.2f}")
 
             # More lenient threshold for higher slices
             if "slice" in locals():  # If we got slice info
-                print(f"Processing slice at height: {slice_height}cm")
+                logger.debug(f"Processing slice at height: {slice_height}cm")
                 if slice_height > 20:  # Slices 5-6
                     threshold = min_val + (value_range * 0.8)
-                    print("Using lenient threshold (80% of range)")
+                    logger.debug("Using lenient threshold (80% of range)")
                 else:  # Slices 1-4
                     threshold = min_val + (value_range * 0.4)
-                    print("Using strict threshold (40% of range)")
+                    logger.debug("Using strict threshold (40% of range)")
             else:
                 # Default if we don't have slice info
                 threshold = min_val + (value_range * 0.6)
-                print("Using default threshold (60% of range)")
+                logger.debug("Using default threshold (60% of range)")
 
-            print(f"Threshold value: {threshold:.2f}")
+            logger.debug(f"Threshold value: {threshold:.2f}")
 
             low_signal_region = y_profile < threshold
-            low_signal_indices = np.where(low_signal_region)[0]
+            low_signal_indices = self.xp.where(low_signal_region)[0]
 
             if len(low_signal_indices) == 0:
-                print("No signal region found!")
+                logger.debug("No signal region found!")
                 return None
 
-            y_start = low_signal_indices[0]
-            y_end = low_signal_indices[-1]
+            y_start = int(low_signal_indices[0])
+            y_end = int(low_signal_indices[-1])
             y_center = (y_start + y_end) // 2
 
-            print(f"\nSignal Region Found:")
-            print(f"Y range: {y_start} to {y_end}")
-            print(f"Y center: {y_center}")
-            print(f"Region size: {y_end - y_start} pixels")
+            logger.debug(f"\nSignal Region Found:")
+            logger.debug(f"Y range: {y_start} to {y_end}")
+            logger.debug(f"Y center: {y_center}")
+            logger.debug(f"Region size: {y_end - y_start} pixels")
 
         return (y_center, x_center)
 
@@ -123,10 +236,10 @@ class SignalROIAnalyzer:
         ]
 
         return {
-            'Mean': np.mean(roi_region),
-            'StdDev': np.std(roi_region),
-            'Min': np.min(roi_region),
-            'Max': np.max(roi_region),
+            'Mean': to_scalar(self.xp.mean(roi_region)),
+            'StdDev': to_scalar(self.xp.std(roi_region)),
+            'Min': to_scalar(self.xp.min(roi_region)),
+            'Max': to_scalar(self.xp.max(roi_region)),
             'Signal_Found': True,
             'ROI_Top': roi_bounds['top'],
             'ROI_Bottom': roi_bounds['bottom'],
@@ -135,37 +248,21 @@ class SignalROIAnalyzer:
         }
 
     def process_stack(self, stack_path):
-        """Process a single stack"""
+        """Process a single stack, one slice at a time"""
         try:
-            # Read raw file with your specific dimensions
-            raw_data = np.fromfile(str(stack_path), dtype=np.float32)
-
-            # Add diagnostic info about raw data
-            total_pixels = len(raw_data)
-            num_pixels_per_slice = 3584 * 2816
-            num_slices = total_pixels // num_pixels_per_slice
-
-            print(f"\nStack Diagnostics for {Path(stack_path).name}:")
-            print(f"Total pixels in file: {total_pixels}")
-            print(f"Pixels per slice: {num_pixels_per_slice}")
-            print(f"Number of complete slices: {num_slices}")
-            print(f"Remainder pixels: {total_pixels % num_pixels_per_slice}")
-
-            if total_pixels % num_pixels_per_slice != 0:
-                print("WARNING: Raw data size is not an exact multiple of slice size!")
-
-            # Reshape the stack to (slices, height, width)
-            stack = raw_data.reshape(num_slices, 2816, 3584)
+            stack = open_stack(stack_path, self.shape, self.dtype)
+            num_slices = stack.shape[0]
 
             results = []
             filename = Path(stack_path).name
 
             for i in range(num_slices):
-                slice_data = stack[i]
+                # Host to backend transfer, one slice at a time
+                slice_data = to_device(stack[i], self.xp)
 
                 # Add per-slice diagnostic info
-                print(f"\nSlice {i+1} shape: {slice_data.shape}")
-                print(f"Slice {i+1} value range: {np.min(slice_data):.2f} to {np.max(slice_data):.2f}")
+                logger.debug(f"\nSlice {i+1} shape: {slice_data.shape}")
+                logger.debug(f"Slice {i+1} value range: {to_scalar(self.xp.min(slice_data)):.2f} to {to_scalar(self.xp.max(slice_data)):.2f}")
 
                 center = self.find_signal_region(slice_data, filename)
                 roi_bounds = self.place_roi_at_center(center, slice_data.shape)
@@ -182,17 +279,197 @@ class SignalROIAnalyzer:
 
             return pd.DataFrame(results)
         except Exception as e:
-            print(f"Error processing {stack_path}: {str(e)}")
+            logger.error(f"Error processing {stack_path}: {str(e)}")
             return pd.DataFrame()
 
-def process_stacks(stack_paths, roi_size=(50, 50)):
-    """Process stacks sequentially"""
-    analyzer = SignalROIAnalyzer(roi_size)
-    all_results = []
+    def find_signal_centers(self, stack, filename):
+        """
+        Vectorized find_signal_region for all the slices of a stack: the y-profiles of every slice are
+        computed with one reduction over the memory-mapped stack. Returns the Y centers and a mask of
+        the slices where the signal was found.
+        """
+        xp = self.xp
+        band = stack[:, :, self.x_center - self.window_size:self.x_center + self.window_size]
+        y_profiles = to_device(band, xp).mean(axis=2)  # (slices, height)
+
+        if filename == "Scatter_Stack.raw":
+            # Scatter maintains its peak characteristic across heights
+            y_centers = xp.argmax(y_profiles, axis=1)
+            found = xp.ones(len(y_centers), dtype=bool)
+        else:
+            # For Primary and Primary+Scatter, default threshold (60% of range) of every profile
+            min_vals = y_profiles.min(axis=1).astype(xp.float64)
+            max_vals = y_profiles.max(axis=1).astype(xp.float64)
+            thresholds = (min_vals + (max_vals - min_vals) * 0.6).astype(y_profiles.dtype)
+
+            low_signal_region = y_profiles < thresholds[:, None]
+            found = low_signal_region.any(axis=1)
+            y_start = xp.argmax(low_signal_region, axis=1)
+            y_end = low_signal_region.shape[1] - 1 - xp.argmax(low_signal_region[:, ::-1], axis=1)
+            y_centers = (y_start + y_end) // 2
+
+            for i in range(len(y_centers)):
+                logger.debug(f"{filename} slice {i+1}: profile range {to_scalar(min_vals[i]):.2f} to {to_scalar(max_vals[i]):.2f}, "
+                             f"threshold {to_scalar(thresholds[i]):.2f}, " +
+                             (f"Y range {int(y_start[i])} to {int(y_end[i])}" if bool(found[i]) else "no signal region found!"))
+
+        return to_host(y_centers), to_host(found)
+
+    def measure_rois(self, stack, y_centers, found):
+        """
+        Vectorized measure_roi for all the slices of a stack: every ROI is extracted with one fancy-index
+        gather from the memory-mapped stack. ROIs cut by the image borders only use their pixels inside.
+        """
+        xp = self.xp
+        num_slices, height, width = stack.shape
+        half_height, half_width = np.array(self.roi_size) // 2
+
+        rows = (y_centers - half_height)[:, None] + np.arange(2 * half_height)[None, :]  # (slices, roi height)
+        cols = self.x_center - half_width + np.arange(2 * half_width)  # (roi width,)
+        valid = ((rows >= 0) & (rows < height))[:, :, None] & ((cols >= 0) & (cols < width))[None, None, :]
+
+        rois = stack[np.arange(num_slices)[:, None, None],
+                     np.clip(rows, 0, height - 1)[:, :, None],
+                     np.clip(cols, 0, width - 1)[None, None, :]]
+        rois = to_device(rois, xp).astype(xp.float64)
+        valid = to_device(valid, xp)
+
+        count = valid.sum(axis=(1, 2))
+        mean = xp.where(valid, rois, 0).sum(axis=(1, 2)) / count
+        std = xp.sqrt(xp.where(valid, (rois - mean[:, None, None]) ** 2, 0).sum(axis=(1, 2)) / count)
+        minimum = xp.where(valid, rois, xp.inf).min(axis=(1, 2))
+        maximum = xp.where(valid, rois, -xp.inf).max(axis=(1, 2))
+
+        def masked(values):
+            # NaN for the slices without signal, integers stay integers when all the slices have signal
+            return values if found.all() else np.where(found, values, np.nan)
+
+        measurements = {'Mean': np.where(found, to_host(mean), np.nan),
+                        'StdDev': np.where(found, to_host(std), np.nan),
+                        'Min': np.where(found, to_host(minimum), np.nan),
+                        'Max': np.where(found, to_host(maximum), np.nan),
+                        'Signal_Found': found.astype(bool),
+                        'ROI_Top': masked(np.maximum(0, y_centers - half_height)),
+                        'ROI_Bottom': masked(np.minimum(height, y_centers + half_height)),
+                        'ROI_Left': masked(np.full(num_slices, max(0, self.x_center - half_width))),
+                        'ROI_Right': masked(np.full(num_slices, min(width, self.x_center + half_width)))}
+        return measurements
+
+    def process_stack_batch(self, stack_path):
+        """Process a single stack, all the slices at once"""
+        try:
+            stack = open_stack(stack_path, self.shape, self.dtype)
+            filename = Path(stack_path).name
+
+            y_centers, found = self.find_signal_centers(stack, filename)
+            measurements = self.measure_rois(stack, y_centers, found)
+            logger.info(f"{filename}: signal found in {int(found.sum())}/{len(found)} slices")
+
+            return pd.DataFrame({
+                                    'Stack': filename,
+                                    'Height_Above_Detector_cm': np.arange(len(found)) * 5,  # Each slice is 5cm increment
+                                    'Slice': np.arange(len(found)) + 1,
+                                    'Center_Y': y_centers if found.all() else np.where(found, y_centers, np.nan),
+                                    'Center_X': np.full(len(found), self.x_center) if found.all() else np.where(found, self.x_center, np.nan),
+                                    **measurements
+                                })
+        except Exception as e:
+            logger.error(f"Error processing {stack_path}: {str(e)}")
+            return pd.DataFrame()
+
+    def measure_roi_grid(self, stack, y_centers, found, roi_sizes, offsets):
+        """
+        Mean and standard deviation of a grid of ROI sizes and center offsets around the signal center
+        of every slice. The summed-area tables of the signal and of its square are built once per slice
+        (over the region covered by the grid), then every ROI costs four lookups in each table.
+        ROIs are placed and cut by the image borders as in place_roi_at_center.
+        """
+        xp = self.xp
+        num_slices, height, width = stack.shape
+
+        # One row per (size, offset) pair of the grid
+        grid = [(size, offset) for size in roi_sizes for offset in offsets]
+        half_sizes = np.array([size for size, _ in grid]) // 2
+        shifts = np.array([offset for _, offset in grid])
+
+        results = []
+        for i in np.flatnonzero(found):
+            y = y_centers[i] + shifts[:, 0]
+            x = self.x_center + shifts[:, 1]
+            top = np.clip(y - half_sizes[:, 0], 0, height)
+            bottom = np.clip(y + half_sizes[:, 0], 0, height)
+            left = np.clip(x - half_sizes[:, 1], 0, width)
+            right = np.clip(x + half_sizes[:, 1], 0, width)
+            bottom, right = np.maximum(bottom, top), np.maximum(right, left)
+
+            # Tables of the bounding box of the grid, the lookups are relative to its corner
+            y0, y1, x0, x1 = top.min(), bottom.max(), left.min(), right.max()
+            tables = integral_images(to_device(stack[i, y0:y1, x0:x1], xp), xp)
+            sums = to_host(rectangle_sums(tables,
+                                          to_device(top - y0, xp), to_device(bottom - y0, xp),
+                                          to_device(left - x0, xp), to_device(right - x0, xp)))
+
+            count = (bottom - top) * (right - left)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = sums[0] / count
+                std = np.sqrt(np.maximum(sums[1] / count - mean * mean, 0))
+
+            results.append(pd.DataFrame({
+                                            'Height_Above_Detector_cm': i * 5,  # Each slice is 5cm increment
+                                            'Slice': i + 1,
+                                            'Center_Y': y_centers[i],
+                                            'Center_X': self.x_center,
+                                            'ROI_Height': half_sizes[:, 0] * 2,
+                                            'ROI_Width': half_sizes[:, 1] * 2,
+                                            'Offset_Y': shifts[:, 0],
+                                            'Offset_X': shifts[:, 1],
+                                            'Mean': mean,
+                                            'StdDev': std,
+                                            'Pixels': count,
+                                            'ROI_Top': top,
+                                            'ROI_Bottom': bottom,
+                                            'ROI_Left': left,
+                                            'ROI_Right': right
+                                        }))
+        return pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+
+    def process_stack_grid(self, stack_path, roi_sizes, offsets):
+        """Measure a grid of ROI sizes and offsets on every slice of a single stack, one row per slice and ROI"""
+        try:
+            stack = open_stack(stack_path, self.shape, self.dtype)
+            filename = Path(stack_path).name
 
-    for stack_path in stack_paths:
-        print(f"Processing {stack_path}")
-        results = analyzer.process_stack(stack_path)
+            y_centers, found = self.find_signal_centers(stack, filename)
+            grid = self.measure_roi_grid(stack, y_centers, found, roi_sizes, offsets)
+            logger.info(f"{filename}: {len(roi_sizes)} ROI sizes x {len(offsets)} offsets in {int(found.sum())}/{len(found)} slices")
+
+            if grid.empty:
+                return grid
+            grid.insert(0, 'Stack', filename)
+            return grid
+        except Exception as e:
+            logger.error(f"Error processing {stack_path}: {str(e)}")
+            return pd.DataFrame()
+
+def _analyze_stack(job):
+    """Analyze one stack in a worker process, the backend is resolved in the process"""
+    stack_path, roi_size, backend, batch, shape, dtype, log_level = job
+    logging.basicConfig(level=log_level, format='%(message)s')
+    analyzer = SignalROIAnalyzer(roi_size, get_backend(backend), shape, dtype)
+    return analyzer.process_stack_batch(stack_path) if batch else analyzer.process_stack(stack_path)
+
+def process_stacks(stack_paths, roi_size=(50, 50), backend=None, batch=True, processes=1, shape=None, dtype=None):
+    """Process stacks, in parallel processes if processes > 1"""
+    jobs = [(stack_path, roi_size, backend, batch, shape, dtype, logger.getEffectiveLevel()) for stack_path in stack_paths]
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            stack_results = list(pool.map(_analyze_stack, jobs))
+    else:
+        stack_results = [_analyze_stack(job) for job in jobs]
+
+    all_results = []
+    for stack_path, results in zip(stack_paths, stack_results):
+        logger.info(f"Processed {stack_path}")
         if not results.empty:
             all_results.append(results)
         else:
@@ -210,6 +487,45 @@ def process_stacks(stack_paths, roi_size=(50, 50)):
         print(f"Error combining results {str(e)}")
         return pd.DataFrame()
 
+def _analyze_stack_grid(job):
+    """Measure the ROI grid of one stack in a worker process, the backend is resolved in the process"""
+    stack_path, roi_sizes, offsets, backend, shape, dtype, log_level = job
+    logging.basicConfig(level=log_level, format='%(message)s')
+    analyzer = SignalROIAnalyzer(xp=get_backend(backend), shape=shape, dtype=dtype)
+    return analyzer.process_stack_grid(stack_path, roi_sizes, offsets)
+
+def process_stack_grids(stack_paths, roi_sizes, offsets=((0, 0),), backend=None, processes=1, shape=None, dtype=None):
+    """Measure a grid of ROI sizes and offsets on all the stacks in one pass, in parallel processes if processes > 1"""
+    jobs = [(stack_path, roi_sizes, offsets, backend, shape, dtype, logger.getEffectiveLevel()) for stack_path in stack_paths]
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            stack_grids = list(pool.map(_analyze_stack_grid, jobs))
+    else:
+        stack_grids = [_analyze_stack_grid(job) for job in jobs]
+
+    stack_grids = [grid for grid in stack_grids if not grid.empty]
+    return pd.concat(stack_grids, ignore_index=True) if stack_grids else pd.DataFrame()
+
+def catalog_stacks(catalog_file, input_directory, pattern):
+    """Query the results catalog for the stacks in the directory matching the pattern, with their ML and CC"""
+    with contextlib.closing(sqlite3.connect(catalog_file)) as db:
+        return db.execute("SELECT path, ml, cc FROM outputs WHERE stage = 'stack' AND path GLOB ? ORDER BY ml, cc, path",
+                          (str(Path(glob.escape(str(Path(input_directory).resolve()))) / pattern),)).fetchall()
+
+def register_results(catalog_file, output_file, stacks, stage='analysis'):
+    """Register a results CSV in the catalog under the given stage ('analysis' for the per-slice results,
+    'roi_grid' for the ROI grid), with the ML and CC of its stacks if they are all the same"""
+    ml_values = set(ml for _, ml, _ in stacks)
+    cc_values = set(cc for _, _, cc in stacks)
+    with contextlib.closing(sqlite3.connect(catalog_file, timeout=60)) as db:
+        with db:  # commits the insertion
+            db.execute("INSERT OR REPLACE INTO outputs (path, stage, ml, cc, size, created) VALUES (?, ?, ?, ?, ?, ?)",
+                       (str(Path(output_file).resolve()), stage,
+                        ml_values.pop() if len(ml_values) == 1 else None,
+                        cc_values.pop() if len(cc_values) == 1 else None,
+                        Path(output_file).stat().st_size,
+                        datetime.datetime.now().isoformat(timespec="seconds")))
+
 if __name__ == "__main__":
     # Take arguments
     parser = argparse.ArgumentParser(description='Process raw image stacks')
@@ -220,9 +536,30 @@ if __name__ == "__main__":
                        help='Output CSV file name (default: analysis_results.csv)')
     parser.add_argument('--roi-size', type=int, nargs=2, default=[20, 20],
                        help='ROI size as height width (default: 20 20)')  # 1cm x 1cm
+    parser.add_argument('--backend', type=str, default=None, choices=BACKENDS,
+                       help='Array backend (default: VICTRE_BACKEND environment variable or numpy)')
+    parser.add_argument('--catalog', type=str, default=None,
+                       help='Results catalog (e.g. results_catalog.db) to find the stacks built by StackSort and register the results')
+    parser.add_argument('--per-slice', action='store_true',
+                       help='Analyze the slices one at a time instead of all at once (batch mode)')
+    parser.add_argument('--processes', type=int, default=1,
+                       help='Number of stacks analyzed in parallel processes (default: 1)')
+    parser.add_argument('--shape', type=int, nargs=2, default=None,
+                       help='Slice shape as height width of the stacks without metadata (default: 2816 3584)')
+    parser.add_argument('--dtype', type=str, default=None, choices=['uint8', 'uint16', 'float32'],
+                       help='Data type of the stacks without metadata (default: float32)')
+    parser.add_argument('--roi-grid', type=str, nargs='+', default=None,
+                       help='ROI sizes as HEIGHTxWIDTH (e.g. 10x10 20x20 50x50) measured in one pass with summed-area tables')
+    parser.add_argument('--roi-offsets', type=str, nargs='+', default=['0,0'],
+                       help='Offsets of the ROI center as DY,DX in pixels for --roi-grid (default: 0,0)')
+    parser.add_argument('--grid-output', type=str, default=None,
+                       help='Output CSV file of --roi-grid (default: <output>_roi_grid.csv)')
+    parser.add_argument('--log-level', type=str, default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                       help='Diagnostics level, DEBUG prints the per-slice diagnostics (default: INFO)')
 
     # parse them
     args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(message)s')
 
     # check for the output directories
     data_dir = Path(args.input_directory)
@@ -230,7 +567,11 @@ if __name__ == "__main__":
         print(f"Directory {data_dir} does not exist")
         exit(1)
 
-    stack_paths = list(data_dir.glob(args.pattern))
+    if args.catalog:
+        stacks = catalog_stacks(args.catalog, data_dir, args.pattern)
+        stack_paths = [Path(path) for path, _, _ in stacks]
+    else:
+        stack_paths = list(data_dir.glob(args.pattern))
     if not stack_paths:
         print(f"No files matching {args.pattern} found in {data_dir}")
         exit(1)
@@ -239,12 +580,28 @@ if __name__ == "__main__":
     print(f"Files to process: {[p.name for p in stack_paths]}")
 
     try:
-        results = process_stacks(stack_paths, tuple(args.roi_size))
+        results = process_stacks(stack_paths, tuple(args.roi_size), args.backend, not args.per_slice, args.processes,
+                                 tuple(args.shape) if args.shape else None, args.dtype)
         if results.empty:
             print("No results were generated")
         else:
             print(f"Processed {len(results)} total slices")
             results.to_csv(args.output, index=False)
             print(f"Results saved to {args.output}")
+            if args.catalog:
+                register_results(args.catalog, args.output, stacks)
+
+        if args.roi_grid:
+            roi_sizes, offsets = parse_roi_grid(args.roi_grid, args.roi_offsets)
+            grid = process_stack_grids(stack_paths, roi_sizes, offsets, args.backend, args.processes,
+                                       tuple(args.shape) if args.shape else None, args.dtype)
+            if grid.empty:
+                print("No ROI grid results were generated")
+            else:
+                grid_output = args.grid_output or str(Path(args.output).with_suffix('')) + '_roi_grid.csv'
+                grid.to_csv(grid_output, index=False)
+                print(f"ROI grid ({len(roi_sizes)} sizes x {len(offsets)} offsets) saved to {grid_output}")
+                if args.catalog:
+                    register_results(args.catalog, grid_output, stacks, 'roi_grid')
     except Exception as e:
         print(f"Error during processing: {str(e)}")
@@ -0,0 +1,187 @@
+import os
+import datetime
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from termcolor import cprint
+
+# arguments_generation keys with the semi-axes of the breast (in cm) along each dimension
+BREAST_SEMIAXES = [["a1b", "a1t"], ["a2l", "a2r"], ["a3"]]
+
+
+def available_memory():
+    """
+        Returns the memory available in the system (in bytes)
+    """
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+
+
+class GenerationRunner:
+    """
+        Object constructor for a batch breast phantom generation runner. The generation (and compression)
+        jobs of several pipelines run concurrently, as many as the CPUs and the memory budget allow.
+        The generation and the compression of a phantom hold the memory of their own estimate while they run.
+        Each job writes its own `output_generation.out` and `output_compression.out` logs in the
+        results folder of its seed, a failed job does not stop the others, and phantoms already
+        recorded in the manifest of their seed are not generated again.
+
+        :param pipelines: List of Pipeline objects, one per phantom to be generated
+        :param compress: If True, the phantoms are compressed after the generation
+        :param thickness: Objective thickness for the compression (in cm), defaults to the one interpolated from the breast height
+        :param processes: Maximum number of concurrent jobs, defaults to the number of CPUs
+        :param memory: Memory budget (in bytes), defaults to the memory available in the system
+        :param bytes_per_voxel: Estimated peak memory of a generation job per voxel of the phantom
+        :param compression_copies: Estimated number of copies of the phantom volume (1 byte per voxel) held by a compression job
+        :param mesh_element_size: Estimated size (in cm) of the elements of the FE mesh of the compression
+        :param bytes_per_element: Estimated memory of the compression per element of the FE mesh
+        :param default_extent: Extent of the breast (in cm) along the dimensions without semi-axes in `arguments_generation`
+        :param generator: Path to the generation binary, it can be replaced by a stand-in for testing
+        :param compressor: Path to the compression binary, it can be replaced by a stand-in for testing
+        :param verbosity: True will output the progress of the jobs
+        :returns: None
+    """
+
+    def __init__(self,
+                 pipelines,
+                 compress=True,
+                 thickness=None,
+                 processes=None,
+                 memory=None,
+                 bytes_per_voxel=2,
+                 compression_copies=3,
+                 mesh_element_size=0.1,
+                 bytes_per_element=1024,
+                 default_extent=[10, 12, 6],
+                 generator="./Victre/generation/build/breastPhantomMain",
+                 compressor="./Victre/compression/build/breastCompressMain",
+                 verbosity=True):
+        self.pipelines = pipelines
+        self.compress = compress
+        self.thickness = thickness
+        self.processes = processes if processes is not None else os.cpu_count()
+        self.memory = memory if memory is not None else available_memory()
+        self.bytes_per_voxel = bytes_per_voxel
+        self.compression_copies = compression_copies
+        self.mesh_element_size = mesh_element_size
+        self.bytes_per_element = bytes_per_element
+        self.default_extent = default_extent
+        self.generator = generator
+        self.compressor = compressor
+        self.verbosity = verbosity
+
+        self.status = {}
+        self._used_memory = 0
+        self._memory_available = threading.Condition()
+
+    def estimate_memory(self, arguments_generation):
+        """
+            Estimates the peak memory of a generation job from the voxel size and dimensions of the phantom
+
+            :param arguments_generation: Arguments of the breast phantom generation
+            :returns: Estimated memory (in bytes)
+        """
+        return self._voxels(arguments_generation, self._voxel_size(arguments_generation)) * self.bytes_per_voxel
+
+    def estimate_compression_memory(self, arguments_generation):
+        """
+            Estimates the peak memory of a compression job: the FE mesh of the breast and
+            several copies of the phantom volume (original, compressed and the resampling buffers)
+
+            :param arguments_generation: Arguments of the breast phantom generation
+            :returns: Estimated memory (in bytes)
+        """
+        volume = self._voxels(arguments_generation, self._voxel_size(arguments_generation))
+        mesh = self._voxels(arguments_generation, self.mesh_element_size)
+        return volume * self.compression_copies + mesh * self.bytes_per_element
+
+    @ staticmethod
+    def _voxel_size(arguments_generation):
+        return float(arguments_generation.get("imgRes", 0.05)) / 10  # mm to cm
+
+    def _voxels(self, arguments_generation, voxel_size):
+        # number of cells of the given size (in cm) covering the extent of the breast
+        voxels = 1
+        for semiaxes, extent in zip(BREAST_SEMIAXES, self.default_extent):
+            if all(key in arguments_generation for key in semiaxes):
+                extent = sum(float(arguments_generation[key])
+                             for key in semiaxes)
+                if len(semiaxes) == 1:
+                    extent = extent * 2
+            voxels *= int(extent / voxel_size) + 1
+        return voxels
+
+    def run(self):
+        """
+            Runs all the jobs and waits for them to finish
+
+            :returns: Dictionary with the status of each job ("done", "skipped" or the error message), indexed by seed
+        """
+        cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Generating {:d} phantoms ({:d} concurrent jobs, {:.1f} GB)...".format(
+            len(self.pipelines), self.processes, self.memory / 1024 ** 3), 'cyan') if self.verbosity else None
+
+        with ThreadPoolExecutor(self.processes) as pool:
+            jobs = {pool.submit(self._run_job, pipeline): pipeline
+                    for pipeline in self.pipelines}
+            for job in as_completed(jobs):
+                pipeline = jobs[job]
+                self.status[pipeline.seed] = job.result()
+                if self.status[pipeline.seed] in ["done", "skipped"]:
+                    cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Phantom {:d} {:s}".format(
+                        pipeline.seed, self.status[pipeline.seed]), 'green') if self.verbosity else None
+                else:
+                    cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Phantom {:d} failed: {:s}".format(
+                        pipeline.seed, self.status[pipeline.seed]), 'red') if self.verbosity else None
+
+        failed = len([s for s in self.status.values()
+                      if s not in ["done", "skipped"]])
+        cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Generation finished! ({:d} failed)".format(failed),
+               'green' if failed == 0 else 'red', attrs=['bold']) if self.verbosity else None
+
+        return self.status
+
+    def _acquire(self, memory):
+        # jobs larger than the budget run alone
+        with self._memory_available:
+            while self._used_memory > 0 and self._used_memory + memory > self.memory:
+                self._memory_available.wait()
+            self._used_memory += memory
+
+    def _release(self, memory):
+        with self._memory_available:
+            self._used_memory -= memory
+            self._memory_available.notify_all()
+
+    def _run_stage(self, memory, stage, *args, **kwargs):
+        self._acquire(memory)
+        try:
+            stage(*args, **kwargs)
+        finally:
+            self._release(memory)
+
+    def _run_job(self, pipeline):
+        folder = "{:s}/{:d}".format(pipeline.results_folder, pipeline.seed)
+        stages = ["generate", "compress"] if self.compress else ["generate"]
+        records = [pipeline.manifest.stages.get(stage) for stage in stages]
+
+        try:
+            # stages already recorded in the manifest of the seed are skipped by the pipeline
+            self._run_stage(self.estimate_memory(pipeline.arguments_generation),
+                            pipeline.generate_phantom, generator=self.generator)
+            if self.compress:
+                self._run_stage(self.estimate_compression_memory(pipeline.arguments_generation),
+                                pipeline.compress_phantom, self.thickness, compressor=self.compressor)
+        except Exception as e:
+            with open("{:s}/output_runner.err".format(folder), "w") as f:
+                f.write(traceback.format_exc())
+            return "{:s} (see the logs in {:s})".format(str(e), folder)
+
+        if all(pipeline.manifest.stages.get(stage) is record for stage, record in zip(stages, records)):
+            return "skipped"
+        return "done"
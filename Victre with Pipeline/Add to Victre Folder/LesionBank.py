@@ -0,0 +1,199 @@
+import os
+import copy
+import json
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import h5py
+import numpy as np
+from termcolor import cprint
+from .Pipeline import Pipeline
+
+LESION_KINDS = ["spiculated", "cluster"]
+
+
+def _generate_lesion(kind, arguments, voxel_size, work_folder):
+    """
+        Generates one lesion volume, used by the worker pool of the LesionBank
+
+        :param kind: Lesion kind, "spiculated" or "cluster"
+        :param arguments: Generator arguments (arguments_spiculated or arguments_cluster)
+        :param voxel_size: Voxel size of the phantom (in cm), only used for clusters
+        :param work_folder: Folder for the temporary breastMass files, only used for spiculated masses
+        :returns: 3D uint8 array with the lesion
+    """
+    if kind == "spiculated":
+        return Pipeline._generate_spiculated_volume(arguments, work_folder)
+    return Pipeline._generate_cluster_volume(arguments, voxel_size)[0]
+
+
+class LesionBank:
+    """
+        Object constructor for a content-addressed lesion bank. Lesions are indexed by a hash
+        of their generator parameters and stored in a single HDF5 file, one group per lesion
+        with a single-chunk `volume` dataset. The file is kept open while the bank is in use.
+
+        :param filename: Path to the HDF5 file of the bank, it will be created if it does not exist
+        :param processes: Number of worker processes used to pre-fill the bank, defaults to the number of CPUs
+        :param work_folder: Folder for the temporary breastMass files, defaults to the folder of the bank
+        :param verbosity: True will output the progress of the generation
+        :returns: None
+    """
+
+    def __init__(self, filename, processes=None, work_folder=None, verbosity=True):
+        self.filename = filename
+        self.processes = processes
+        self.verbosity = verbosity
+        self.work_folder = work_folder
+        if self.work_folder is None:
+            self.work_folder = os.path.dirname(os.path.abspath(filename))
+
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._hf = h5py.File(filename, "a")
+        self._index = set(self._hf.keys())
+        self._pending = {}
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, key):
+        """
+            Returns the lesion volume stored with the given key, waiting for it if it is being generated
+
+            :param key: Key of the lesion (see `key`)
+            :returns: 3D uint8 array with the lesion
+        """
+        pending = self._pending.get(key)
+        if pending is not None:
+            pending[1].wait()
+            pending[0].result()
+        with self._lock:
+            if key not in self._index:
+                raise KeyError(key)
+            return self._hf[key]["volume"][()]
+
+    @staticmethod
+    def key(kind, arguments, voxel_size=None):
+        """
+            Computes the key of a lesion from its generator parameters
+
+            :param kind: Lesion kind, "spiculated" or "cluster"
+            :param arguments: Generator arguments (arguments_spiculated or arguments_cluster)
+            :param voxel_size: Voxel size of the phantom (in cm), required for clusters
+            :returns: Hexadecimal hash identifying the lesion
+        """
+        if kind not in LESION_KINDS:
+            raise ValueError("Unknown lesion kind: {:s}".format(kind))
+        if kind == "cluster" and voxel_size is None:
+            raise ValueError("voxel_size is required for clusters")
+
+        description = {"kind": kind,
+                       "arguments": arguments,
+                       "voxel_size": voxel_size if kind == "cluster" else None}
+        return hashlib.sha1(json.dumps(description, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def get(self, kind, arguments, voxel_size=None):
+        """
+            Returns the lesion generated with the given parameters, generating it if it is not in the bank
+
+            :param kind: Lesion kind, "spiculated" or "cluster"
+            :param arguments: Generator arguments (arguments_spiculated or arguments_cluster)
+            :param voxel_size: Voxel size of the phantom (in cm), required for clusters
+            :returns: Tuple with the key and the 3D uint8 array with the lesion
+        """
+        key = self.key(kind, arguments, voxel_size)
+        if key not in self._index and key not in self._pending:
+            cprint("Lesion {:s} not found in the bank, generating...".format(key),
+                   'cyan') if self.verbosity else None
+            self._store(key, kind, arguments, voxel_size,
+                        _generate_lesion(kind, arguments, voxel_size, self.work_folder))
+        return key, self[key]
+
+    def prefill(self, kind, arguments_list, voxel_size=None):
+        """
+            Generates the missing lesions in the background using a pool of worker processes.
+            The method returns immediately, use `wait` to block until the bank is filled.
+
+            :param kind: Lesion kind, "spiculated" or "cluster"
+            :param arguments_list: List of generator arguments, one per lesion
+            :param voxel_size: Voxel size of the phantom (in cm), required for clusters
+            :returns: List with the keys of the requested lesions
+        """
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.processes)
+
+        keys = []
+        for arguments in arguments_list:
+            arguments = copy.deepcopy(arguments)
+            key = self.key(kind, arguments, voxel_size)
+            keys.append(key)
+            if key in self._index or key in self._pending:
+                continue
+
+            stored = threading.Event()
+            future = self._pool.submit(
+                _generate_lesion, kind, arguments, voxel_size, self.work_folder)
+            self._pending[key] = (future, stored)
+            future.add_done_callback(
+                lambda f, key=key, arguments=arguments, stored=stored: self._done(f, key, kind, arguments, voxel_size, stored))
+
+        cprint("Pre-filling the lesion bank with {:d} lesions...".format(len(self._pending)),
+               'cyan') if self.verbosity and len(self._pending) > 0 else None
+        return keys
+
+    def wait(self):
+        """
+            Blocks until all the lesions requested with `prefill` are in the bank
+        """
+        for future, stored in list(self._pending.values()):
+            stored.wait()
+
+    def close(self):
+        """
+            Waits for the pending lesions and closes the bank
+        """
+        if self._pool is not None:
+            self.wait()
+            self._pool.shutdown()
+            self._pool = None
+        with self._lock:
+            if self._hf:
+                self._hf.close()
+
+    def _done(self, future, key, kind, arguments, voxel_size, stored):
+        try:
+            if future.exception() is None:
+                self._store(key, kind, arguments, voxel_size, future.result())
+            else:
+                cprint("Error generating lesion {:s}: {:s}".format(key, str(future.exception())),
+                       'red') if self.verbosity else None
+        finally:
+            self._pending.pop(key, None)
+            stored.set()
+
+    def _store(self, key, kind, arguments, voxel_size, volume):
+        with self._lock:
+            if key in self._hf:
+                del self._hf[key]
+            group = self._hf.create_group(key)
+            group.create_dataset("volume", data=volume, chunks=volume.shape,
+                                 compression="gzip", track_times=False)
+            group.attrs["kind"] = kind
+            group.attrs["arguments"] = json.dumps(
+                arguments, sort_keys=True, default=str)
+            if voxel_size is not None:
+                group.attrs["voxel_size"] = np.asarray(voxel_size)
+            self._hf.flush()
+            self._index.add(key)
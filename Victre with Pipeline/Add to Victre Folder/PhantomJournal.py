@@ -0,0 +1,57 @@
+class PhantomJournal:
+    """
+        Object constructor for the undo journal of the phantom edits. Every stamped block
+        keeps a copy of the voxels it overwrote, so the edits can be rolled back by restoring
+        only those blocks instead of reloading the phantom.
+
+        :param phantom: Phantom 3-dimensional byte array to be edited in place
+        :returns: None
+    """
+
+    def __init__(self, phantom):
+        self.phantom = phantom
+        self._entries = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def blocks(self):
+        """
+            List of (z, y, x) tuples of slices with the blocks modified since the journal was created or committed
+        """
+        return [entry[0] for entry in self._entries]
+
+    def stamp(self, block, mask, value):
+        """
+            Sets the voxels of the mask inside the given block to the given value, recording the previous contents
+
+            :param block: Tuple of slices with the block of the phantom to be modified
+            :param mask: Boolean array with the shape of the block, True for the voxels to be modified
+            :param value: Value (material) to be set
+        """
+        region = self.phantom[block]
+        self._entries.append((block, region.copy()))
+        region[mask] = value
+
+    def savepoint(self):
+        """
+            Returns the current position of the journal, to be used in `rollback`
+        """
+        return len(self._entries)
+
+    def rollback(self, savepoint=0):
+        """
+            Restores the phantom blocks modified after the given savepoint, newest first
+
+            :param savepoint: Position returned by `savepoint`, defaults to the beginning of the journal
+        """
+        while len(self._entries) > savepoint:
+            block, previous = self._entries.pop()
+            self.phantom[block] = previous
+
+    def commit(self):
+        """
+            Keeps all the edits in the phantom and empties the journal
+        """
+        self._entries = []
@@ -49,17 +49,30 @@ import progressbar
 import h5py
 import subprocess
 from string import Template
-import random
 import time
 from . import Constants, Exceptions
+from .PhantomJournal import PhantomJournal
+from .StageManifest import StageManifest, STAGE_STATE
+from .Victre_Tools import read_raw, read_mhd, ResultsCatalog
 import pydicom
 from pydicom.dataset import FileDataset, FileMetaDataset
 import copy
 import datetime
 import re
 import gzip
+import glob
+import multiprocessing
+import tempfile
+import json
+import hashlib
 from scipy import interpolate
 
+# identifiers of the random streams of each stochastic stage, see Pipeline.get_rng
+RANDOM_STAGES = {"insertion": 0,
+                 "placement": 1,
+                 "absent": 2,
+                 "cluster": 3}
+
 
 class Pipeline:
     """
@@ -81,6 +94,11 @@ class Pipeline:
         :param flatfield_DBT: Path to the flatfield file for the DBT reconstruction
         :param flatfield_DM: Path to the flatfield file for the digital mammography
         :param density: [EXPERIMENTAL] Percentage of dense tissue of the phantom to be generated, this will adjust the compression thickness too
+        :param scratch_folder: Folder where lesion-variant phantoms are materialized for MCGPU, defaults to the system temporary folder. It must be visible from the GPU host.
+        :param variant: Id of the lesion variant of the phantom to load (see `insert_lesions`), defaults to the last one saved for the seed
+        :param incremental: If True, a stage whose inputs and parameters match the ones recorded in `manifest.json` is skipped (see StageManifest)
+        :param catalog: Path to the results catalog where the outputs of every stage are registered, or a ResultsCatalog (e.g. a shared one for workers on several nodes), defaults to `results_catalog.db` in the results folder. False will disable it.
+        :param projection_hooks: List of functions called with every raw MCGPU output file kept with a custom `output_file` and the pipeline, as soon as the projection finishes (e.g. SPRatioHook)
         :param verbosity: True will output the progress of each process and steps
         :returns: None
     """
@@ -103,6 +121,11 @@ class Pipeline:
                  flatfield_DBT=None,
                  flatfield_DM=None,
                  density=None,
+                 scratch_folder=None,
+                 variant=None,
+                 incremental=True,
+                 catalog=None,
+                 projection_hooks=None,
                  verbosity=True):
 
         if seed is None:
@@ -118,19 +141,20 @@ class Pipeline:
         self.roi_sizes = roi_sizes
         self.candidate_locations = None
         self.verbosity = verbosity
+        self.phantom_variant = None
+        self.scratch_folder = scratch_folder
+        self.journal = None
 
-        random.seed(self.seed)
-
-        self.arguments_mcgpu = Constants.VICTRE_DEFAULT_MCGPU
+        self.arguments_mcgpu = copy.deepcopy(Constants.VICTRE_DEFAULT_MCGPU)
         self.arguments_mcgpu["spectrum_file"] = spectrum_file
         self.arguments_mcgpu["phantom_file"] = phantom_file
         self.arguments_mcgpu["output_file"] = "{:s}/{:d}/projection".format(
             self.results_folder, self.seed)
         self.arguments_mcgpu["random_seed"] = self.seed
 
-        self.arguments_spiculated = Constants.VICTRE_DEFAULT_SPICULATED_MASS
+        self.arguments_spiculated = copy.deepcopy(Constants.VICTRE_DEFAULT_SPICULATED_MASS)
         self.arguments_spiculated["seed"] = self.seed
-        self.arguments_cluster = Constants.VICTRE_DEFAULT_CLUSTER
+        self.arguments_cluster = copy.deepcopy(Constants.VICTRE_DEFAULT_CLUSTER)
         self.arguments_cluster["seed"] = self.seed
 
         locations = None
@@ -152,18 +176,37 @@ class Pipeline:
         }
 
         if phantom_file is None:
-            if os.path.exists("{:s}/{:d}/pcl_{:d}.mhd".format(self.results_folder, seed, seed)):
+            if variant is not None:
+                if not os.path.exists(self._variant_file(variant)):
+                    raise Exceptions.VictreError("Lesion variant {:s} not found".format(
+                        self._variant_file(variant)))
+                self.phantom_variant = self._variant_file(variant)
+            else:
+                # the last variant saved, unless the full phantom with lesions was saved after it
+                variants = sorted(self._variant_files(), key=os.path.getmtime)
+                full_phantom = "{:s}/{:d}/pcl_{:d}.mhd".format(self.results_folder, seed, seed)
+                if len(variants) > 0 and (not os.path.exists(full_phantom) or
+                                          os.path.getmtime(variants[-1]) >= os.path.getmtime(full_phantom)):
+                    self.phantom_variant = variants[-1]
+
+            if self.phantom_variant is not None or \
+                    os.path.exists("{:s}/{:d}/pcl_{:d}.mhd".format(self.results_folder, seed, seed)):
                 cprint("Found phantom with lesions information!",
                        'cyan') if self.verbosity else None
-                self.mhd = self._read_mhd(
-                    "{:s}/{:d}/pcl_{:d}.mhd".format(self.results_folder, self.seed, self.seed))
+                if self.phantom_variant is not None:
+                    with h5py.File(self.phantom_variant, "r") as hf:
+                        self.mhd = json.loads(hf.attrs["mhd"])
+                        base_file = hf.attrs["base_file"]
+                        locations = hf["locations"][()].tolist()
+                else:
+                    self.mhd = self._read_mhd(
+                        "{:s}/{:d}/pcl_{:d}.mhd".format(self.results_folder, self.seed, self.seed))
+                    locations = np.loadtxt(
+                        "{:s}/{:d}/pcl_{:d}.loc".format(self.results_folder, self.seed, self.seed)).tolist()
                 self.arguments_mcgpu["number_voxels"] = self.mhd["DimSize"]
                 self.arguments_mcgpu["voxel_size"] = [
                     x / 10 for x in self.mhd["ElementSpacing"]]
 
-                locations = np.loadtxt(
-                    "{:s}/{:d}/pcl_{:d}.loc".format(self.results_folder, self.seed, self.seed)).tolist()
-
                 if os.path.exists("{:s}/{:d}/pc_{:d}_crop.loc".format(self.results_folder, seed, seed)):
                     self.candidate_locations = np.loadtxt(
                         "{:s}/{:d}/pc_{:d}_crop.loc".format(self.results_folder, self.seed, self.seed), delimiter=',').tolist()
@@ -174,6 +217,8 @@ class Pipeline:
 
                 self.arguments_mcgpu["phantom_file"] = "{:s}/{:d}/pcl_{:d}.raw.gz".format(
                     self.results_folder, seed, seed)
+                if self.phantom_variant is not None:
+                    self.arguments_mcgpu["phantom_file"] = base_file
 
             elif os.path.exists("{:s}/{:d}/pc_{:d}_crop.mhd".format(self.results_folder, seed, seed)):
                 cprint("Found cropped phantom information!",
@@ -243,7 +288,7 @@ class Pipeline:
 
         self.materials = materials
         if self.materials is None:
-            self.materials = Constants.VICTRE_DEFAULT_MATERIALS
+            self.materials = copy.deepcopy(Constants.VICTRE_DEFAULT_MATERIALS)
 
         self.arguments_recon = dict(
             number_projections=self.arguments_mcgpu["number_projections"],
@@ -307,7 +352,7 @@ class Pipeline:
 
         self.arguments_recon.update(arguments_recon)
 
-        self.arguments_generation = Constants.VICTRE_DENSE  # dense by default
+        self.arguments_generation = copy.deepcopy(Constants.VICTRE_DENSE)  # dense by default
 
         if density is not None:
             fat = np.max([0.4, np.min([0.95, 1 - density])])
@@ -339,6 +384,19 @@ class Pipeline:
         os.makedirs("{:s}/{:d}".format(self.results_folder,
                                        self.seed), exist_ok=True)
 
+        self.incremental = incremental
+        self.manifest = StageManifest("{:s}/{:d}/manifest.json".format(
+            self.results_folder, self.seed))
+        self._stage_hashes = {}
+        self._insert_calls = 0
+        if catalog is None:
+            catalog = "{:s}/results_catalog.db".format(self.results_folder)
+        if catalog is False:
+            self.catalog = None
+        else:
+            self.catalog = catalog if isinstance(catalog, ResultsCatalog) else ResultsCatalog(catalog)
+        self.projection_hooks = projection_hooks if projection_hooks is not None else []
+
         if phantom_file is not None:
             splitted = phantom_file.split('/')
             path = '/'.join(splitted[:-1])
@@ -399,17 +457,109 @@ class Pipeline:
 
     def _load_phantom_array_from_gzip(self):
         """
-            Loads and returns the phantom byte array using gzip
+            Loads and returns the phantom byte array using gzip. If the phantom is a
+            lesion variant, its voxel blocks are applied over the base phantom.
 
             :returns: Phantom 3-dimensional byte array
         """
         with gzip.GzipFile(filename=self.arguments_mcgpu["phantom_file"], mode='rb') as gz:
             phantom = gz.read()
-        return np.frombuffer(bytearray(phantom), dtype=np.uint8).reshape(
+        phantom = np.frombuffer(bytearray(phantom), dtype=np.uint8).reshape(
             self.arguments_mcgpu["number_voxels"][2],
             self.arguments_mcgpu["number_voxels"][1],
             self.arguments_mcgpu["number_voxels"][0])
 
+        if self.phantom_variant is not None:
+            with h5py.File(self.phantom_variant, "r") as hf:
+                for name in hf["blocks"]:
+                    block = hf["blocks"][name]
+                    offset = block.attrs["offset"]
+                    phantom[offset[0]:offset[0] + block.shape[0],
+                            offset[1]:offset[1] + block.shape[1],
+                            offset[2]:offset[2] + block.shape[2]] = block[()]
+        return phantom
+
+    def _variant_file(self, variant):
+        return "{:s}/{:d}/pcl_{:d}_{:s}.variant.h5".format(self.results_folder, self.seed, self.seed, str(variant))
+
+    def _variant_files(self):
+        # pcl_SEED.variant.h5 is the single variant of the results saved before variants had ids
+        legacy_file = "{:s}/{:d}/pcl_{:d}.variant.h5".format(self.results_folder, self.seed, self.seed)
+        return ([legacy_file] if os.path.exists(legacy_file) else []) + \
+            glob.glob("{:s}/{:d}/pcl_{:d}_*.variant.h5".format(glob.escape(self.results_folder), self.seed, self.seed))
+
+    def _save_phantom_variant(self, phantom, modified, variant=None):
+        """
+            Saves the phantom as a lesion variant of its base phantom: only the modified voxel
+            blocks are stored, together with their offsets, the MHD information and the lesion locations.
+
+            :param phantom: Phantom 3-dimensional byte array with the lesions
+            :param modified: List of (z, y, x) tuples of slices with the blocks modified in the phantom
+            :param variant: Id of the variant, defaults to a hash of the lesion locations
+            :returns: None. The variant is saved in `pcl_SEED_VARIANT.variant.h5`
+        """
+        base_file = os.path.abspath(self.arguments_mcgpu["phantom_file"])
+        blocks = [tuple((int(s.start), int(s.stop)) for s in block)
+                  for block in modified]
+
+        # keep the blocks of the variant this phantom was loaded from
+        if self.phantom_variant is not None:
+            with h5py.File(self.phantom_variant, "r") as hf:
+                base_file = hf.attrs["base_file"]
+                for name in hf["blocks"]:
+                    offset = hf["blocks"][name].attrs["offset"]
+                    shape = hf["blocks"][name].shape
+                    blocks.append(tuple((int(offset[i]), int(offset[i] + shape[i]))
+                                        for i in range(3)))
+
+        if variant is None:
+            variant = hashlib.sha1(np.asarray(self.lesions, dtype=np.int64).tobytes()).hexdigest()[:12]
+        variant_file = self._variant_file(variant)
+
+        with h5py.File(variant_file, "w") as hf:
+            hf.attrs["base_file"] = base_file
+            hf.attrs["variant"] = str(variant)
+            # numpy values (e.g. the DimSize of a cropped phantom) are stored as native numbers, not strings
+            hf.attrs["mhd"] = json.dumps(self.mhd, default=lambda value: value.tolist() if isinstance(
+                value, (np.ndarray, np.generic)) else str(value))
+            hf.create_dataset("locations", data=np.asarray(self.lesions),
+                              track_times=False)
+            hfblocks = hf.create_group("blocks")
+            for idx, block in enumerate(sorted(set(blocks))):
+                dataset = hfblocks.create_dataset("{:04d}".format(idx),
+                                                  data=phantom[block[0][0]:block[0][1],
+                                                               block[1][0]:block[1][1],
+                                                               block[2][0]:block[2][1]],
+                                                  compression="gzip", track_times=False)
+                dataset.attrs["offset"] = [b[0] for b in block]
+
+        self.phantom_variant = variant_file
+        self.arguments_mcgpu["phantom_file"] = base_file
+
+    def materialize_variant(self, scratch_folder=None):
+        """
+            Writes the full lesion-variant phantom as a gzip raw file, to be read by MCGPU
+
+            :param scratch_folder: Folder where the phantom will be written, defaults to the `scratch_folder` of the pipeline
+            :returns: Path to the materialized phantom file, to be removed after use
+        """
+        if scratch_folder is None:
+            scratch_folder = self.scratch_folder
+        if scratch_folder is None:
+            scratch_folder = tempfile.gettempdir()
+
+        os.makedirs(scratch_folder, exist_ok=True)
+        phantom_file = os.path.abspath("{:s}/pcl_{:d}_{:d}.raw.gz".format(
+            scratch_folder, self.seed, os.getpid()))
+
+        cprint("Materializing lesion-variant phantom in {:s}...".format(
+            phantom_file), 'cyan') if self.verbosity else None
+
+        with gzip.GzipFile(filename=phantom_file, mode="wb", mtime=0) as gz:
+            gz.write(self._load_phantom_array_from_gzip())
+
+        return phantom_file
+
     def project(self, flatfield_correction=True, clean=True, do_flatfield=0, for_presentation=False):
         """
             Method that runs MCGPU to project the phantom.
@@ -432,6 +582,43 @@ class Pipeline:
 
             return memory_free_values
 
+        own_flatfield = "{:s}/{:d}/flatfield_DM{:d}.raw".format(
+            self.results_folder, self.seed, self.seed)
+        if do_flatfield == 0 and not for_presentation and flatfield_correction and self.flatfield_DM in [None, own_flatfield]:
+            # the flatfield only depends on the projection geometry and the phantom size
+            flatfield_arguments = copy.deepcopy(self.arguments_mcgpu)
+            for key in ["phantom_file", "output_file"]:
+                flatfield_arguments.pop(key, None)
+            if not self._stage_skipped("flatfield", dict(arguments_mcgpu=flatfield_arguments,
+                                                         repetitions=Constants.FLATFIELD_REPETITIONS)) and \
+                    "flatfield" in self.manifest and self.manifest.stages["flatfield"]["hash"] != self._stage_hashes["flatfield"]:
+                # generated with other parameters, remove it so it is not averaged with the new one
+                # (not when it is only run again because the pipeline is not incremental)
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(own_flatfield)
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove("{:s}/{:d}/flatfield_{:s}pixels_{:d}proj.raw".format(
+                        self.results_folder,
+                        self.seed,
+                        'x'.join(map(str, self.arguments_mcgpu["image_pixels"])),
+                        self.arguments_mcgpu["number_projections"]))
+                self.flatfield_DM = None
+                self.arguments_recon["flatfield_file"] = None
+
+        # only the projections of the phantom are recorded, flatfields are recorded when generated
+        if do_flatfield == 0 and not for_presentation:
+            if self._stage_skipped("project", dict(arguments_mcgpu=self.arguments_mcgpu,
+                                               materials=self.materials,
+                                               flatfield_correction=flatfield_correction,
+                                               flatfield_DM=self.flatfield_DM,
+                                               flatfield_DBT=self.arguments_recon["flatfield_file"],
+                                               lesion_locations=self.lesion_locations,
+                                               # a phantom given by the user has no stage recording it, its contents are checked instead
+                                               phantom_file=None if len(self.manifest.dependencies("project")) > 0 else
+                                               [self._file_signature(self.arguments_mcgpu["phantom_file"]),
+                                                self._file_signature(self.phantom_variant)])):
+                return
+
         if do_flatfield > 0:
             filename = "flatfield"
             empty_phantom = np.zeros(
@@ -444,24 +631,23 @@ class Pipeline:
             prev_flatfield_DBT, prev_flatfield_DM = None, None
 
             if os.path.exists("{:s}/{:d}/{:s}_DM{:d}.raw".format(self.results_folder, self.seed, filename, self.seed)):
-                prev_flatfield_DM = np.fromfile("{:s}/{:d}/{:}_DM{:d}.raw".format(self.results_folder, self.seed, filename, self.seed),
-                                                dtype="float32").reshape(2,
-                                                                         self.arguments_recon["detector_elements_perpendicular"],
-                                                                         self.arguments_recon["detector_elements"])
+                prev_flatfield_DM = read_raw("{:s}/{:d}/{:}_DM{:d}.raw".format(self.results_folder, self.seed, filename, self.seed),
+                                             backend="numpy")
             if os.path.exists("{:s}/{:d}/flatfield_{:s}pixels_{:d}proj.raw".format(
                 self.results_folder,
                 self.seed,
                 'x'.join(map(str, self.arguments_mcgpu["image_pixels"])),
                 self.arguments_mcgpu["number_projections"])
             ):
-                prev_flatfield_DBT = np.fromfile("{:s}/{:d}/flatfield_{:s}pixels_{:d}proj.raw".format(
+                prev_flatfield_DBT = read_raw("{:s}/{:d}/flatfield_{:s}pixels_{:d}proj.raw".format(
                     self.results_folder,
                     self.seed,
                     'x'.join(map(str, self.arguments_mcgpu["image_pixels"])),
                     self.arguments_mcgpu["number_projections"]),
-                    dtype="float32").reshape(self.arguments_mcgpu["number_projections"],
-                                             self.arguments_mcgpu["image_pixels"][0],
-                                             self.arguments_mcgpu["image_pixels"][1])
+                    (self.arguments_mcgpu["number_projections"],
+                     self.arguments_mcgpu["image_pixels"][0],
+                     self.arguments_mcgpu["image_pixels"][1]),
+                    np.float32, backend="numpy")
         elif for_presentation:
             phantom = self._load_phantom_array_from_gzip()
             phantom[phantom != 0] = Constants.PHANTOM_MATERIALS["adipose"]
@@ -501,6 +687,8 @@ class Pipeline:
                 template_arguments["phantom_file"] = "{:s}/{:d}/presentation.raw.gz".format(
                     self.results_folder,
                     self.seed)
+            elif self.phantom_variant is not None:
+                template_arguments["phantom_file"] = self.materialize_variant()
                 # template_arguments["number_projections"] = 1
                 # if self.arguments_mcgpu["number_projections"] > 1:
                 #     template_arguments["number_histories"] = self.arguments_mcgpu["number_histories"] * \
@@ -584,6 +772,10 @@ class Pipeline:
                 f.write(output.encode('utf-8'))
                 f.flush()
 
+        if do_flatfield == 0 and not for_presentation and self.phantom_variant is not None:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(template_arguments["phantom_file"])
+
         if template_arguments["number_projections"] > 1 and completed != template_arguments["number_projections"]:
             cprint("\nError while projecting, check the output_{:s}.out file in the results folder (seed = {:d})".format(filename, self.seed),
                    'red', attrs=['bold'])
@@ -654,10 +846,8 @@ class Pipeline:
                 self.results_folder, self.seed))
 
             if prev_flatfield_DM is not None:
-                curr_flatfield_DM = np.fromfile("{:s}/{:d}/flatfield_DM{:d}.raw".format(self.results_folder, self.seed, self.seed),
-                                                dtype="float32").reshape(2,
-                                                                         self.arguments_recon["detector_elements_perpendicular"],
-                                                                         self.arguments_recon["detector_elements"])
+                curr_flatfield_DM = read_raw("{:s}/{:d}/flatfield_DM{:d}.raw".format(self.results_folder, self.seed, self.seed),
+                                             backend="numpy")
 
                 prev_flatfield_DM += curr_flatfield_DM / \
                     do_flatfield / Constants.FLATFIELD_DOSE_MULTIPLIER
@@ -666,14 +856,15 @@ class Pipeline:
                     "{:s}/{:d}/flatfield_DM{:d}.raw".format(self.results_folder, self.seed, self.seed))
 
             if prev_flatfield_DBT is not None and self.arguments_mcgpu["number_projections"] > 1:
-                curr_flatfield_DBT = np.fromfile("{:s}/{:d}/flatfield_{:s}pixels_{:d}proj.raw".format(
+                curr_flatfield_DBT = read_raw("{:s}/{:d}/flatfield_{:s}pixels_{:d}proj.raw".format(
                     self.results_folder,
                     self.seed,
                     'x'.join(map(str, self.arguments_mcgpu["image_pixels"])),
                     self.arguments_mcgpu["number_projections"]),
-                    dtype="float32").reshape(self.arguments_mcgpu["number_projections"],
-                                             self.arguments_mcgpu["image_pixels"][0],
-                                             self.arguments_mcgpu["image_pixels"][1])
+                    (self.arguments_mcgpu["number_projections"],
+                     self.arguments_mcgpu["image_pixels"][0],
+                     self.arguments_mcgpu["image_pixels"][1]),
+                    np.float32, backend="numpy")
 
                 prev_flatfield_DBT += curr_flatfield_DBT / \
                     do_flatfield / Constants.FLATFIELD_DOSE_MULTIPLIER
@@ -715,19 +906,17 @@ class Pipeline:
                     self.seed,
                     'x'.join(map(str, self.arguments_mcgpu["image_pixels"])),
                     self.arguments_mcgpu["number_projections"])
+                if "flatfield" in self._stage_hashes:
+                    self._record_stage("flatfield", [self.flatfield_DM])
 
         if for_presentation:
             os.remove("{:s}/{:d}/presentation.raw.gz".format(
                 self.results_folder, self.seed))
             self.project(flatfield_correction=False, clean=clean)
-            projection_DM = np.fromfile("{:s}/{:d}/projection_DM{:d}.raw".format(self.results_folder, self.seed, self.seed),
-                                        dtype="float32").reshape(2,
-                                                                 self.arguments_recon["detector_elements_perpendicular"],
-                                                                 self.arguments_recon["detector_elements"])
-            presentation_tmp = np.fromfile("{:s}/{:d}/presentation_DM{:d}.raw".format(self.results_folder, self.seed, self.seed),
-                                           dtype="float32").reshape(2,
-                                                                    self.arguments_recon["detector_elements_perpendicular"],
-                                                                    self.arguments_recon["detector_elements"])
+            projection_DM = read_raw("{:s}/{:d}/projection_DM{:d}.raw".format(self.results_folder, self.seed, self.seed),
+                                     backend="numpy")
+            presentation_tmp = read_raw("{:s}/{:d}/presentation_DM{:d}.raw".format(self.results_folder, self.seed, self.seed),
+                                        backend="numpy")
             os.remove(
                 "{:s}/{:d}/presentation_DM{:d}.raw".format(self.results_folder, self.seed, self.seed))
             # os.rename(
@@ -742,16 +931,16 @@ class Pipeline:
 
         if do_flatfield == 0:
             # normalize with flatfield
-            projection_DM = np.fromfile("{:s}/{:d}/projection_DM{:d}.raw".format(self.results_folder, self.seed, self.seed),
-                                        dtype="float32").reshape(2,
-                                                                 self.arguments_recon["detector_elements_perpendicular"],
-                                                                 self.arguments_recon["detector_elements"])
+            projection_DM = read_raw("{:s}/{:d}/projection_DM{:d}.raw".format(self.results_folder, self.seed, self.seed),
+                                     backend="numpy")
             np.seterr(divide='ignore', invalid='ignore')
             if flatfield_correction and self.flatfield_DM is not None:
-                curr_flatfield_DM = np.fromfile(self.flatfield_DM,
-                                                dtype="float32").reshape(2,
-                                                                         self.arguments_recon["detector_elements_perpendicular"],
-                                                                         self.arguments_recon["detector_elements"])
+                # it may be given without header
+                curr_flatfield_DM = read_raw(self.flatfield_DM,
+                                             (2,
+                                              self.arguments_recon["detector_elements_perpendicular"],
+                                              self.arguments_recon["detector_elements"]),
+                                             np.float32)
 
                 projection_DM = np.true_divide(
                     curr_flatfield_DM, projection_DM)
@@ -766,25 +955,210 @@ class Pipeline:
                 np.savetxt("{:s}/{:d}/projection_DM{:d}.loc".format(self.results_folder, self.seed, self.seed),
                            np.asarray(self.lesion_locations["dm"]), fmt="%d")
 
-    def reconstruct(self):
+            if not for_presentation:
+                outputs = ["{:s}/{:d}/projection_DM{:d}.raw".format(
+                    self.results_folder, self.seed, self.seed)]
+                if self.arguments_mcgpu["number_projections"] > 1:
+                    outputs.append(self.arguments_recon["projection_file"])
+                raw_outputs = []
+                if self.arguments_mcgpu["output_file"] != "{:s}/{:d}/projection".format(self.results_folder, self.seed):
+                    # raw MCGPU outputs kept with a custom output file (e.g. the ones used to build the Z stacks)
+                    raw_outputs = sorted(glob.glob(glob.escape(
+                        self.arguments_mcgpu["output_file"]) + "_*.raw"))
+                self._record_stage("project", outputs + raw_outputs)
+
+                for hook in self.projection_hooks:
+                    for raw_file in raw_outputs:
+                        try:
+                            hook(raw_file, self)
+                        except Exception as e:
+                            # the projection is already recorded, a failed analysis must not lose it
+                            cprint("Projection hook failed for {:s}: {:s}".format(raw_file, str(e)),
+                                   'red') if self.verbosity else None
+
+    def reconstruct(self, rois=None):
         """
             Method that runs the reconstruction code for the DBT volume
+
+            :param rois: If None, the full DBT volume is reconstructed. If True, only the boxes around every
+                         lesion and absent ROI in `lesion_locations["dbt"]` are reconstructed. A list of indices
+                         restricts this to the given entries of `lesion_locations["dbt"]`. ROI reconstructions
+                         are written directly into the ROI store (`ROIs.h5` and the `ROIs` subfolder).
         """
 
+        if rois is not None and rois is not False:
+            self._reconstruct_rois(rois)
+            return
+
+        if self._stage_skipped("reconstruct", dict(arguments_recon=self.arguments_recon,
+                                                   lesion_locations=self.lesion_locations)):
+            return
+
         # %% RECONSTRUCTION
+        self.recon_size = self._get_recon_size(self.arguments_recon)
+
+        cprint("Initializing reconstruction, this may take a few minutes...",
+               'cyan') if self.verbosity else None
+
+        self._run_reconstruction(self.arguments_recon,
+                                 "{:s}/{:d}/input_recon.in".format(
+                                     self.results_folder, self.seed),
+                                 "{:s}/{:d}/output_recon.out".format(
+                                     self.results_folder, self.seed),
+                                 self.recon_size["y"])
+
+        self.mhd["ElementDataFile"] = "reconstruction{:d}.raw".format(
+            self.seed)
+        self.mhd["Offset"] = [0, 0, 0]
+        self.mhd["DimSize"] = [self.recon_size["x"],
+                               self.recon_size["y"],
+                               self.recon_size["z"]]
+        self.mhd["ElementType"] = "MET_DOUBLE"
+        self.mhd["ElementSpacing"] = [self.arguments_recon["recon_pixel_size"] * 10,  # cm to mm
+                                      self.arguments_recon["recon_pixel_size"] * 10,
+                                      self.arguments_recon["recon_thickness"] * 10]
+
+        with open("{:s}/{:d}/reconstruction{:d}.mhd".format(
+                self.results_folder,
+                self.seed,
+                self.seed), "w") as f:
+            src = Template(Constants.MHD_FILE)
+            template_arguments = copy.deepcopy(self.mhd)
+            for key in template_arguments.keys():
+                if type(template_arguments[key]) is list:
+                    template_arguments[key] = ' '.join(
+                        map(str, template_arguments[key]))
+            result = src.substitute(template_arguments)
+            f.write(result)
+
+        if len(self.lesion_locations["dbt"]) > 0:
+            np.savetxt("{:s}/{:d}/reconstruction{:d}.loc".format(self.results_folder, self.seed, self.seed),
+                       np.asarray(self.lesion_locations["dbt"]), fmt="%d")
+
+        cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Reconstruction finished!", 'green',
+               attrs=['bold']) if self.verbosity else None
+
+        self._record_stage("reconstruct", ["{:s}/{:d}/reconstruction{:d}.raw".format(self.results_folder, self.seed, self.seed),
+                                           "{:s}/{:d}/reconstruction{:d}.mhd".format(self.results_folder, self.seed, self.seed)])
+
+    def _reconstruct_rois(self, rois):
+        """
+            Reconstructs only the DBT sub-volumes around the given lesion and absent ROI centers.
+            Each sub-volume uses the geometry of `arguments_recon`: it is centered on the ROI along X
+            with `volume_center_offset_x`, shifted along Z with `detector_offset` and it only covers
+            the ROI thickness (in `recon_thickness` slices). The FBP has no offset along Y, so each
+            sub-volume is reconstructed from the chest wall up to the end of the ROI.
+
+            :param rois: True for all the entries in `lesion_locations["dbt"]` or a list of indices of them
+            :returns: None. The ROIs are saved in the `ROIs` subfolder and in the `dbt` group of `ROIs.h5`,
+                      where only the entries of the given indices are replaced
+        """
+        if len(self.lesion_locations["dbt"]) == 0:
+            cprint("There are no ROIs!", 'red') if self.verbosity else None
+            return
+
+        if rois is True:
+            rois = range(len(self.lesion_locations["dbt"]))
+
+        self.recon_size = self._get_recon_size(self.arguments_recon)
+
+        # phantom voxels per reconstructed pixel and slice
+        ratio_xy = self.arguments_recon["recon_pixel_size"] / \
+            self.arguments_recon["voxel_size"]
+        ratio_z = self.arguments_recon["recon_thickness"] / \
+            self.arguments_recon["voxel_size"]
+
+        os.makedirs("{:s}/{:d}/ROIs/".format(self.results_folder,
+                                             self.seed), exist_ok=True)
+
+        with h5py.File("{:s}/{:d}/ROIs.h5".format(self.results_folder, self.seed), 'a') as hf:
+            # the ROIs saved before (by save_ROIs or a previous call) are kept
+            hfdbt = hf.require_group("dbt")
+            hfdbt_loc = hf.require_group("dbt_locations")
+
+            for idx in rois:
+                lesion = self.lesion_locations["dbt"][idx]
+                roi_size = self.roi_sizes[np.abs(lesion[3])]
+
+                # same ROI bounds as in save_ROIs, one extra pixel of margin around them
+                x_pixels = roi_size[0] + 2
+                y_end = lesion[1] + int(np.floor(roi_size[1] / 2)) + 1
+                z_start = 1 + lesion[2] - int(np.ceil(roi_size[2] / 2))
+
+                arguments_roi = copy.deepcopy(self.arguments_recon)
+                arguments_roi["voxels_x"] = int(np.ceil(x_pixels * ratio_xy))
+                arguments_roi["voxels_y"] = int(np.ceil(y_end * ratio_xy))
+                arguments_roi["voxels_z"] = int(
+                    np.ceil((roi_size[2] + 1) * ratio_z))
+                arguments_roi["volume_center_offset_x"] = self.arguments_recon["volume_center_offset_x"] + \
+                    (lesion[0] - self.recon_size["x"] / 2) * \
+                    self.arguments_recon["recon_pixel_size"]
+                arguments_roi["detector_offset"] = self.arguments_recon["detector_offset"] + \
+                    z_start * ratio_z
+                arguments_roi["reconstruction_file"] = "{:s}/{:d}/ROIs/reconstruction_ROI_{:02d}.raw".format(
+                    self.results_folder, self.seed, idx)
+
+                roi_recon_size = self._get_recon_size(arguments_roi)
+
+                cprint("Reconstructing ROI {:d} ({:d}x{:d}x{:d} pixels)...".format(
+                    idx, roi_recon_size["x"], roi_recon_size["y"], roi_recon_size["z"]), 'cyan') if self.verbosity else None
+
+                self._run_reconstruction(arguments_roi,
+                                         "{:s}/{:d}/ROIs/input_recon_ROI_{:02d}.in".format(
+                                             self.results_folder, self.seed, idx),
+                                         "{:s}/{:d}/output_recon_ROI_{:02d}.out".format(
+                                             self.results_folder, self.seed, idx),
+                                         roi_recon_size["y"])
+
+                pixel_array = read_raw(arguments_roi["reconstruction_file"],
+                                       (roi_recon_size["z"], roi_recon_size["y"], roi_recon_size["x"]),
+                                       np.float64, backend="numpy")
+                os.remove(arguments_roi["reconstruction_file"])
+
+                x_center = int(roi_recon_size["x"] / 2)
+                roi = pixel_array[:roi_size[2],
+                                  lesion[1] - int(np.ceil(roi_size[1] / 2)): lesion[1] + int(np.floor(roi_size[1] / 2)),
+                                  x_center - int(np.ceil(roi_size[0] / 2)): x_center + int(np.floor(roi_size[0] / 2))]
+
+                roi.astype(np.dtype('<f8')).tofile(
+                    "{:s}/{:d}/ROIs/ROI_DBT_{:02d}_type{:d}.raw".format(self.results_folder, self.seed, idx, lesion[3]))
+                for group in [hfdbt, hfdbt_loc]:
+                    if "{:d}".format(idx) in group:
+                        del group["{:d}".format(idx)]
+                hfdbt.create_dataset("{:d}".format(idx),
+                                     data=roi.astype(np.float32), compression="gzip", compression_opts=9, track_times=False)
+                hfdbt_loc.create_dataset("{:d}".format(
+                    idx), data=lesion, track_times=False)
+
+            if "lesion_type" in hfdbt:
+                del hfdbt["lesion_type"]
+            hfdbt.create_dataset("lesion_type",
+                                 data=np.array(self.lesion_locations["dbt"])[:, 3], track_times=False)
+
+        cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] ROI reconstruction finished!", 'green',
+               attrs=['bold']) if self.verbosity else None
+
+    def _run_reconstruction(self, arguments_recon, config_file, output_file, n_slices):
+        """
+            Writes the reconstruction config file and runs the FBP reconstruction, following its progress
+
+            :param arguments_recon: Dictionary with the reconstruction arguments for the template
+            :param config_file: Path to the config file to be written
+            :param output_file: Path to the file where the FBP output will be logged
+            :param n_slices: Number of image slices expected from the FBP (Y dimension of the volume)
+        """
         with open("./Victre/reconstruction/configs/parameters.tpl", "r") as f:
             src = Template(f.read())
-            template_arguments = copy.deepcopy(self.arguments_recon)
+            template_arguments = copy.deepcopy(arguments_recon)
             result = src.substitute(template_arguments)
 
-        with open("{:s}/{:d}/input_recon.in".format(self.results_folder, self.seed), "w") as f:
+        with open(config_file, "w") as f:
             f.write(result)
 
         command = "cd {:s} && \
-            ./Victre/reconstruction/FBP {:s}/{:d}/input_recon.in".format(
+            ./Victre/reconstruction/FBP {:s}".format(
             os.getcwd(),
-            self.results_folder,
-            self.seed
+            config_file
         )
 
         if self.ips["cpu"] == "localhost":
@@ -793,18 +1167,6 @@ class Pipeline:
             ssh_command = "ssh -Y {:s} \"{:s}\"".format(
                 self.ips["cpu"], command)
 
-        self.recon_size = dict(
-            x=np.ceil(self.arguments_recon["voxels_x"] * self.arguments_recon["voxel_size"] /
-                      self.arguments_recon["recon_pixel_size"]).astype(int),
-            y=np.ceil(self.arguments_recon["voxels_y"] * self.arguments_recon["voxel_size"] /
-                      self.arguments_recon["recon_pixel_size"]).astype(int),
-            z=np.ceil(self.arguments_recon["voxels_z"] * self.arguments_recon["voxel_size"] /
-                      self.arguments_recon["recon_thickness"]).astype(int)
-        )
-
-        cprint("Initializing reconstruction, this may take a few minutes...",
-               'cyan') if self.verbosity else None
-
         completed = 0
 
         process = subprocess.Popen(ssh_command, shell=True,
@@ -813,7 +1175,7 @@ class Pipeline:
 
         bar = None
         finished = False
-        with open("{:s}/{:d}/output_recon.out".format(self.results_folder, self.seed), "wb") as f:
+        with open(output_file, "wb") as f:
             while True:
                 output = process.stdout.readline().decode("utf-8")
                 if output == "" and process.poll() is not None:
@@ -823,7 +1185,7 @@ class Pipeline:
                         cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Starting reconstruction...",
                                'cyan') if self.verbosity else None
                         bar = progressbar.ProgressBar(
-                            max_value=self.recon_size["y"]) if self.verbosity else None
+                            max_value=n_slices) if self.verbosity else None
                         bar.update(0) if self.verbosity else None
                     completed += 1
                     bar.update(completed) if self.verbosity else None
@@ -834,43 +1196,29 @@ class Pipeline:
                 f.write(output.encode('utf-8'))
                 f.flush()
 
-        if not finished or completed != self.recon_size["y"]:
-            cprint("\nError while reconstructing, check the output_recon.out file (seed = {:d})".format(self.seed),
+        if not finished or completed != n_slices:
+            cprint("\nError while reconstructing, check the {:s} file (seed = {:d})".format(os.path.basename(output_file), self.seed),
                    'red', attrs=['bold'])
             raise Exceptions.VictreError("Reconstruction error")
 
         bar.finish() if self.verbosity else None
 
-        self.mhd["ElementDataFile"] = "reconstruction{:d}.raw".format(
-            self.seed)
-        self.mhd["Offset"] = [0, 0, 0]
-        self.mhd["DimSize"] = [self.recon_size["x"],
-                               self.recon_size["y"],
-                               self.recon_size["z"]]
-        self.mhd["ElementType"] = "MET_DOUBLE"
-        self.mhd["ElementSpacing"] = [self.arguments_recon["recon_pixel_size"] * 10,  # cm to mm
-                                      self.arguments_recon["recon_pixel_size"] * 10,
-                                      self.arguments_recon["recon_thickness"] * 10]
-
-        with open("{:s}/{:d}/reconstruction{:d}.mhd".format(
-                self.results_folder,
-                self.seed,
-                self.seed), "w") as f:
-            src = Template(Constants.MHD_FILE)
-            template_arguments = copy.deepcopy(self.mhd)
-            for key in template_arguments.keys():
-                if type(template_arguments[key]) is list:
-                    template_arguments[key] = ' '.join(
-                        map(str, template_arguments[key]))
-            result = src.substitute(template_arguments)
-            f.write(result)
-
-        if len(self.lesion_locations["dbt"]) > 0:
-            np.savetxt("{:s}/{:d}/reconstruction{:d}.loc".format(self.results_folder, self.seed, self.seed),
-                       np.asarray(self.lesion_locations["dbt"]), fmt="%d")
+    @ staticmethod
+    def _get_recon_size(arguments_recon):
+        """
+            Computes the size of the reconstructed volume for the given reconstruction arguments
 
-        cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Reconstruction finished!", 'green',
-               attrs=['bold']) if self.verbosity else None
+            :param arguments_recon: Dictionary with the reconstruction arguments
+            :returns: Dictionary with the number of pixels in x, y and z
+        """
+        return dict(
+            x=np.ceil(arguments_recon["voxels_x"] * arguments_recon["voxel_size"] /
+                      arguments_recon["recon_pixel_size"]).astype(int),
+            y=np.ceil(arguments_recon["voxels_y"] * arguments_recon["voxel_size"] /
+                      arguments_recon["recon_pixel_size"]).astype(int),
+            z=np.ceil(arguments_recon["voxels_z"] * arguments_recon["voxel_size"] /
+                      arguments_recon["recon_thickness"]).astype(int)
+        )
 
     def reverse_dm_coordinates(self, dm_location):
         """
@@ -1198,21 +1546,28 @@ class Pipeline:
                     self.results_folder, self.seed, modality, count), ds,
                 write_like_original=False)
 
+        stage = "dicom.{:s}".format(modality)
+        if self._stage_skipped(stage, dict(modality=modality,
+                                           lesion_locations=self.lesion_locations[modality],
+                                           recon_size=self.recon_size)):
+            return
+
         os.makedirs("{:s}/{:d}/DICOM_{:s}/".format(self.results_folder,
                                                    self.seed,
                                                    modality), exist_ok=True)
 
         if modality == "dbt":
-            pixel_array = np.fromfile("{:s}/{:d}/reconstruction{:d}.raw".format(self.results_folder, self.seed, self.seed),
-                                      dtype="float64").reshape(self.recon_size["z"], self.recon_size["x"], self.recon_size["y"])
+            pixel_array = read_raw("{:s}/{:d}/reconstruction{:d}.raw".format(self.results_folder, self.seed, self.seed),
+                                   (self.recon_size["z"], self.recon_size["x"], self.recon_size["y"]),
+                                   np.float64)
             pixel_array = np.clip(((2**16 - 1) * pixel_array), 0, 2**16 - 1)
         else:
             if os.path.exists("{:s}/{:d}/presentation_DM{:d}.raw".format(self.results_folder, self.seed, self.seed)):
-                pixel_array = np.fromfile("{:s}/{:d}/presentation_DM{:d}.raw".format(self.results_folder, self.seed, self.seed),
-                                          dtype="float32").reshape(2, self.arguments_mcgpu["image_pixels"][0], self.arguments_mcgpu["image_pixels"][1])
+                pixel_array = read_raw("{:s}/{:d}/presentation_DM{:d}.raw".format(self.results_folder, self.seed, self.seed),
+                                       (2, self.arguments_mcgpu["image_pixels"][0], self.arguments_mcgpu["image_pixels"][1]))
             else:
-                pixel_array = np.fromfile("{:s}/{:d}/projection_DM{:d}.raw".format(self.results_folder, self.seed, self.seed),
-                                          dtype="float32").reshape(2, self.arguments_mcgpu["image_pixels"][0], self.arguments_mcgpu["image_pixels"][1])
+                pixel_array = read_raw("{:s}/{:d}/projection_DM{:d}.raw".format(self.results_folder, self.seed, self.seed),
+                                       (2, self.arguments_mcgpu["image_pixels"][0], self.arguments_mcgpu["image_pixels"][1]))
             # pixel_array = ((2**16 - 1) * (pixel_array - np.nanmin(pixel_array)) /
             #                (np.nanmax(pixel_array) - np.nanmin(pixel_array))).astype(np.uint16)
             # pixel_array = (scaling["toUInt16"] * (scaling["offset"] + (pixel_array -
@@ -1227,6 +1582,9 @@ class Pipeline:
                 pixel_array[s, :, :]).astype(np.uint16), s)
         bar.finish() if self.verbosity else None
 
+        self._record_stage(stage, ["{:s}/{:d}/DICOM_{:s}/{:03d}.dcm".format(
+            self.results_folder, self.seed, modality, s) for s in range(pixel_array.shape[0])])
+
     def save_ROIs(self, roi_sizes=None, clean=True, save_folder=None):
         """
             Saves the generated ROIs (absent and present) in RAW and HDF5 formats
@@ -1245,25 +1603,39 @@ class Pipeline:
         if save_folder is None:
             save_folder = self.results_folder
 
+        if self._stage_skipped("rois", dict(roi_sizes=self.roi_sizes,
+                                            lesion_locations=self.lesion_locations,
+                                            save_folder=os.path.abspath(save_folder))):
+            return
+
+        full_reconstruction = os.path.exists("{:s}/{:d}/reconstruction{:d}.raw".format(
+            self.results_folder, self.seed, self.seed))
+
         # SAVE DBT ROIs
-        if clean:
+        # without a full reconstruction, keep the DBT ROIs from reconstruct(rois=...)
+        if clean and full_reconstruction:
             shutil.rmtree(
                 "{:s}/{:d}/ROIs".format(save_folder, self.seed), ignore_errors=True)
+        elif clean:
+            for name in glob.glob("{:s}/{:d}/ROIs/ROI_DM_*.raw".format(save_folder, self.seed)):
+                os.remove(name)
 
         os.makedirs("{:s}/{:d}/ROIs/".format(save_folder,
                                              self.seed), exist_ok=True)
 
         hf = h5py.File(
-            "{:s}/{:d}/ROIs.h5".format(save_folder, self.seed), 'w')
+            "{:s}/{:d}/ROIs.h5".format(save_folder, self.seed), 'w' if full_reconstruction else 'a')
+        for group in ["dm", "dm_locations"]:
+            if group in hf:
+                del hf[group]
 
-        if os.path.exists("{:s}/{:d}/reconstruction{:d}.raw".format(self.results_folder, self.seed, self.seed)):
-            mhd = self._read_mhd(
-                "{:s}/{:d}/reconstruction{:d}.mhd".format(self.results_folder, self.seed, self.seed))
+        if full_reconstruction:
             hfdbt = hf.create_group("dbt")
             hfdbt_loc = hf.create_group("dbt_locations")
 
-            pixel_array = np.fromfile("{:s}/{:d}/reconstruction{:d}.raw".format(self.results_folder, self.seed, self.seed),
-                                      dtype="float64").reshape(int(mhd["DimSize"][2]), int(mhd["DimSize"][1]), int(mhd["DimSize"][0]))
+            # only the ROIs are read from disk
+            pixel_array = read_raw("{:s}/{:d}/reconstruction{:d}.raw".format(
+                self.results_folder, self.seed, self.seed))
 
             for idx, lesion in enumerate(self.lesion_locations["dbt"]):
                 lesion_type = np.abs(lesion[3])
@@ -1282,10 +1654,8 @@ class Pipeline:
                                  data=np.array(self.lesion_locations["dbt"])[:, 3], track_times=False)
 
         # SAVE DM ROIs
-        pixel_array = np.fromfile("{:s}/{:d}/projection_DM{:d}.raw".format(self.results_folder, self.seed, self.seed),
-                                  dtype="float32").reshape(2,
-                                                           self.arguments_recon["detector_elements_perpendicular"],
-                                                           self.arguments_recon["detector_elements"])
+        pixel_array = read_raw("{:s}/{:d}/projection_DM{:d}.raw".format(
+            self.results_folder, self.seed, self.seed))
 
         hfdm = hf.create_group("dm")
         hfdm_loc = hf.create_group("dm_locations")
@@ -1310,6 +1680,9 @@ class Pipeline:
 
         hf.close()
 
+        self._record_stage(
+            "rois", ["{:s}/{:d}/ROIs.h5".format(save_folder, self.seed)])
+
         cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] ROIs saved!", 'green', attrs=[
                'bold']) if self.verbosity else None
 
@@ -1327,44 +1700,13 @@ class Pipeline:
         if size is not None:
             self.arguments_spiculated["alpha"] = size
 
-        with open("./Victre/breastMass/configs/spiculated.tpl", "r") as f:
-            src = Template(f.read())
-            result = src.substitute(self.arguments_spiculated)
-
-        os.makedirs("{:s}/lesions/".format(self.results_folder), exist_ok=True)
-        os.makedirs(
-            "{:s}/lesions/spiculated/".format(self.results_folder), exist_ok=True)
-
-        with open("{:s}/lesions/spiculated/input_breastMass_{:d}.in".format(self.results_folder, seed), "w") as f:
-            f.write(result)
-
-        command = "cd {:s}/lesions/spiculated/ && {:s}/Victre/breastMass/build/breastMass -c input_breastMass_{:d}.in".format(
-            self.results_folder,
-            os.getcwd(),
-            self.arguments_spiculated["seed"])
-
         cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Generating mass (seed={:d}, size={:.2f})...".format(
             self.arguments_spiculated["seed"], self.arguments_spiculated["alpha"]), 'cyan') if self.verbosity else None
-        os.system(command)
 
-        generated_files = self.get_folder_contents(
+        lesion_raw = self._generate_spiculated_volume(
+            self.arguments_spiculated,
             "{:s}/lesions/spiculated/".format(self.results_folder))
 
-        side = None
-        for name in generated_files:
-            s = re.search(
-                ".*\/mass_{:d}_([0-9]*)\.raw".format(self.arguments_spiculated["seed"]), name)
-            if s is not None:
-                side = int(s[1])
-
-        lesion_raw = np.fromfile("{:s}/lesions/spiculated/mass_{:d}_{:d}.raw".format(self.results_folder, self.arguments_spiculated["seed"], side),
-                                 dtype=np.uint8).reshape(side, side, side)
-
-        # clean files
-        for name in generated_files:
-            if ".raw" in name or ".cfg" in name or ".vti" in name or ".in" in name or "core" in name:
-                os.remove(name)
-
         # save in HDF
         with h5py.File("{:s}/lesions/spiculated/mass_{:d}_size{:.2f}.h5".format(
                 self.results_folder,
@@ -1385,6 +1727,55 @@ class Pipeline:
         cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Generation finished!", 'green', attrs=[
                'bold']) if self.verbosity else None
 
+    @ staticmethod
+    def _generate_spiculated_volume(arguments_spiculated, work_folder):
+        """
+            Runs breastMass in its own temporary subfolder and returns the generated mass.
+            The subfolder is removed afterwards, so several masses can be generated at the same time.
+
+            :param arguments_spiculated: Dictionary with the breastMass arguments
+            :param work_folder: Folder where the temporary subfolder will be created
+            :returns: 3D uint8 array with the spiculated mass
+        """
+        os.makedirs(work_folder, exist_ok=True)
+        folder = tempfile.mkdtemp(prefix="mass_{:d}_".format(arguments_spiculated["seed"]),
+                                  dir=os.path.abspath(work_folder))
+
+        with open("./Victre/breastMass/configs/spiculated.tpl", "r") as f:
+            src = Template(f.read())
+            result = src.substitute(arguments_spiculated)
+
+        with open("{:s}/input_breastMass_{:d}.in".format(folder, arguments_spiculated["seed"]), "w") as f:
+            f.write(result)
+
+        command = "cd {:s} && {:s}/Victre/breastMass/build/breastMass -c input_breastMass_{:d}.in".format(
+            folder,
+            os.getcwd(),
+            arguments_spiculated["seed"])
+
+        try:
+            subprocess.run(command, shell=True,
+                           stdout=subprocess.PIPE,
+                           stderr=subprocess.STDOUT)
+
+            side = None
+            for name in os.listdir(folder):
+                s = re.search(
+                    "mass_{:d}_([0-9]*)\.raw".format(arguments_spiculated["seed"]), name)
+                if s is not None:
+                    side = int(s[1])
+
+            if side is None:
+                raise Exceptions.VictreError(
+                    "Spiculated mass generation error")
+
+            lesion_raw = read_raw("{:s}/mass_{:d}_{:d}.raw".format(folder, arguments_spiculated["seed"], side),
+                                  (side, side, side), np.uint8, backend="numpy")
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+        return lesion_raw
+
     def generate_cluster(self, seed=None, size=None, nmin=None, nmax=None, smin=None, smax=None):
         """
             Generates a random calcification cluster
@@ -1413,60 +1804,8 @@ class Pipeline:
         cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Generating calcification cluster (seed={:d}, size={:d})...".format(
             self.arguments_cluster["seed"], self.arguments_cluster["size"]), 'cyan') if self.verbosity else None
 
-        np.random.seed(self.arguments_cluster["seed"])
-
-        size_px = (int(self.arguments_cluster["size"] /
-                       (self.arguments_mcgpu["voxel_size"][0] * 10)),
-                   int(self.arguments_cluster["size"] /
-                       (self.arguments_mcgpu["voxel_size"][1] * 10)),
-                   int(self.arguments_cluster["size"] /
-                       (self.arguments_mcgpu["voxel_size"][2] * 10)))
-
-        lesion_raw = np.zeros(size_px, dtype=np.uint8)
-
-        n = np.random.randint(
-            self.arguments_cluster["nmin"], self.arguments_cluster["nmax"])
-
-        def sphere(shape, radius, position):
-            """Generate an n-dimensional spherical mask."""
-            # assume shape and position have the same length and contain ints
-            # the units are pixels / voxels (px for short)
-            # radius is a int or float in px
-            assert len(position) == len(shape)
-            n = len(shape)
-            semisizes = (radius,) * len(shape)
-
-            # genereate the grid for the support points
-            # centered at the position indicated by position
-            grid = [slice(-x0, dim - x0) for x0, dim in zip(position, shape)]
-            position = np.ogrid[grid]
-            # calculate the distance of all points from `position` center
-            # scaled by the radius
-            arr = np.zeros(shape, dtype=float)
-            for x_i, semisize in zip(position, semisizes):
-                # this can be generalized for exponent != 2
-                # in which case `(x_i / semisize)`
-                # would become `np.abs(x_i / semisize)`
-                arr += (x_i / semisize) ** 2 if semisize > 0 else 0
-
-            # the inner part of the sphere will have distance below or equal to 1
-            return arr <= 1.0
-
-        for lesion in range(n):
-            # calc between 50um and 150um radius (included)
-            # which is 5.23e4um3 and 1.41e7um3
-            size_calc = np.random.randint(
-                self.arguments_cluster["smin"] /
-                (self.arguments_mcgpu["voxel_size"][0] * 10),
-                self.arguments_cluster["smax"] / (self.arguments_mcgpu["voxel_size"][0] * 10) + 1)
-            x = np.random.randint(
-                size_calc, size_px[0] - size_calc)
-            y = np.random.randint(
-                size_calc, size_px[1] - size_calc)
-            z = np.random.randint(
-                size_calc, size_px[2] - size_calc)
-            calc = sphere(size_px, size_calc, (x, y, z))
-            lesion_raw += calc
+        lesion_raw, n = self._generate_cluster_volume(
+            self.arguments_cluster, self.arguments_mcgpu["voxel_size"])
 
         os.makedirs("{:s}/lesions/".format(self.results_folder), exist_ok=True)
         os.makedirs(
@@ -1487,17 +1826,138 @@ class Pipeline:
             n)
         return n
 
-    def insert_lesions(self, lesion_type=None, n=-1, lesion_file=None, lesion_size=None, locations=None, roi_sizes=None, save_phantom=True, seed=None):
+    def generate_clusters(self, seeds, library_file=None, processes=None):
+        """
+            Generates a batch of random calcification clusters in parallel and saves all of them in
+            a single HDF5 lesion library. Every cluster uses the current `arguments_cluster` with its own seed.
+
+            :param seeds: List of seeds, one per cluster to be generated, or number of clusters to derive the seeds from the phantom seed
+            :param library_file: Path to the HDF5 lesion library. Defaults to `lesions/cluster/calcs_library.h5` in the results folder.
+                                 Existing clusters in the library are overwritten.
+            :param processes: Number of worker processes, defaults to the number of CPUs
+            :returns: Dictionary with the number of calcifications of each generated cluster, indexed by seed.
+                      Each cluster is stored in the group `SEED` of the library, use `insert_lesions(lesion_file=library_file, lesion_key=str(SEED))` to insert it.
+        """
+        if library_file is None:
+            library_file = "{:s}/lesions/cluster/calcs_library.h5".format(
+                self.results_folder)
+
+        os.makedirs(os.path.dirname(os.path.abspath(
+            library_file)), exist_ok=True)
+
+        if isinstance(seeds, int):
+            seeds = self.get_rng("cluster").integers(0, 2 ** 31 - 1, size=seeds)
+
+        jobs = []
+        for seed in seeds:
+            arguments_cluster = copy.deepcopy(self.arguments_cluster)
+            arguments_cluster["seed"] = int(seed)
+            jobs.append((arguments_cluster, self.arguments_mcgpu["voxel_size"]))
+
+        cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Generating {:d} calcification clusters (size={:d})...".format(
+            len(jobs), self.arguments_cluster["size"]), 'cyan') if self.verbosity else None
+
+        generated = {}
+        bar = progressbar.ProgressBar(
+            max_value=len(jobs)) if self.verbosity else None
+        with multiprocessing.Pool(processes) as pool, h5py.File(library_file, "a") as hf:
+            for job, (lesion_raw, n) in zip(jobs, pool.imap(Pipeline._generate_cluster_volume_job, jobs)):
+                key = "{:d}".format(job[0]["seed"])
+                if key in hf:
+                    del hf[key]
+                group = hf.create_group(key)
+                group.create_dataset("volume", data=lesion_raw,
+                                     compression="gzip", track_times=False)
+                group.create_dataset(
+                    "seed", data=job[0]["seed"], track_times=False)
+                group.create_dataset("n", data=n, track_times=False)
+                generated[job[0]["seed"]] = n
+                bar.update(len(generated)) if self.verbosity else None
+        bar.finish() if self.verbosity else None
+
+        cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Generation finished!", 'green', attrs=[
+               'bold']) if self.verbosity else None
+
+        return generated
+
+    @ staticmethod
+    def _generate_cluster_volume_job(job):
+        """
+            Unpacks a (arguments_cluster, voxel_size) tuple for the worker pool
+        """
+        return Pipeline._generate_cluster_volume(*job)
+
+    @ staticmethod
+    def _generate_cluster_volume(arguments_cluster, voxel_size):
+        """
+            Rasterizes a random calcification cluster. Each calcification is only evaluated
+            inside its own bounding box and overlapping calcifications keep the value 1.
+
+            :param arguments_cluster: Dictionary with the cluster arguments (seed, size, nmin, nmax, smin, smax)
+            :param voxel_size: Voxel size of the phantom (in cm)
+            :returns: Tuple with the 3D uint8 cluster volume and the number of calcifications
+        """
+        rng = np.random.RandomState(arguments_cluster["seed"])
+
+        size_px = (int(arguments_cluster["size"] /
+                       (voxel_size[0] * 10)),
+                   int(arguments_cluster["size"] /
+                       (voxel_size[1] * 10)),
+                   int(arguments_cluster["size"] /
+                       (voxel_size[2] * 10)))
+
+        lesion_raw = np.zeros(size_px, dtype=np.uint8)
+
+        n = rng.randint(
+            arguments_cluster["nmin"], arguments_cluster["nmax"])
+
+        spheres = {}
+        for lesion in range(n):
+            # calc between 50um and 150um radius (included)
+            # which is 5.23e4um3 and 1.41e7um3
+            size_calc = rng.randint(
+                arguments_cluster["smin"] /
+                (voxel_size[0] * 10),
+                arguments_cluster["smax"] / (voxel_size[0] * 10) + 1)
+            x = rng.randint(
+                size_calc, size_px[0] - size_calc)
+            y = rng.randint(
+                size_calc, size_px[1] - size_calc)
+            z = rng.randint(
+                size_calc, size_px[2] - size_calc)
+
+            if size_calc not in spheres:
+                grid = np.ogrid[-size_calc:size_calc + 1,
+                                -size_calc:size_calc + 1,
+                                -size_calc:size_calc + 1]
+                spheres[size_calc] = grid[0] ** 2 + grid[1] ** 2 + \
+                    grid[2] ** 2 <= size_calc ** 2
+
+            lesion_raw[x - size_calc:x + size_calc + 1,
+                       y - size_calc:y + size_calc + 1,
+                       z - size_calc:z + size_calc + 1][spheres[size_calc]] = 1
+
+        return lesion_raw, n
+
+    def insert_lesions(self, lesion_type=None, n=-1, lesion_file=None, lesion_size=None, locations=None, roi_sizes=None, save_phantom=True, seed=None, lesion_key=None, save_variant=False, variant=None, placement="sequential"):
         """
             Inserts the specified number of lesions in the phantom.
 
             :param lesion_type: Constant with the desired lesion type. Check available lesion types and materials in the Constants file.
             :param n: Number of lesions to be added
-            :param lesion_file: Path to file including the lesion to be inserted (in HDF5 format). If specified, it will overrite the lesion file specified in the constructor.
+            :param lesion_file: Path to file including the lesion to be inserted (in HDF5 format), or an open LesionBank. If specified, it will overrite the lesion file specified in the constructor.
             :param lesion_size: If lesion_file is a raw file, lesion_size indicates the size of this file
             :param locations: List of coordinates in the voxel/phantom space where the lesions will be inserted. If not specified, random locations will be generated.
             :param roi_sizes: Size of the region of interest to be calculated to avoid overlapping with other tissues and check out of bounds locations
             :param seed: Specific seed for randomized insertion, defaults to phantom seed, set to -1 to randomize every insertion
+            :param lesion_key: If lesion_file is an HDF5 lesion library (see `generate_clusters`), name of the group containing the lesion to be inserted.
+                               If lesion_file is a LesionBank, key of the lesion in the bank (see `LesionBank.key`).
+            :param save_variant: If True, only the voxel blocks modified by the lesions are saved in `pcl_SEED_VARIANT.variant.h5`, relative to the current phantom,
+                                 instead of the full `pcl_SEED.raw.gz` and `pcl_SEED.mhd`. The full phantom is only materialized when projecting.
+            :param variant: With save_variant, id of the lesion variant, so several variants of the same phantom can be kept (see the `variant` of the constructor).
+                            Defaults to a hash of the lesion locations.
+            :param placement: How random locations are chosen. "sequential" tries the candidates one by one and restarts when too many are rejected.
+                              "blue_noise" pre-filters the candidates and draws n mutually non-overlapping lesions in a single pass (see `_place_lesions`).
 
             :returns: None. A phantom file will be saved inside the results folder with the corresponding raw phantom. Three files will be generated: `pcl_SEED.raw.gz` with the raw data, `pcl_SEED.mhd` with the information about the raw data, and `pcl_SEED.loc` with the voxel coordinates of the lesion centers.
 
@@ -1508,227 +1968,547 @@ class Pipeline:
             # raise Exceptions.VictreError("No lesion file has been specified")
 
         lesion, phantom = None, None
+        own_journal = self.journal is None
+        start = None
+
+        # on errors the lesions of this call are rolled back, and the journal opened by this call is closed
+        try:
+            if lesion_file is not None:
+                self.lesion_file = lesion_file
+
+            # only the insertions that save a phantom outside of an open transaction are recorded
+            stage = None
+            if save_phantom and own_journal and (seed is None or seed >= 0):
+                stage = "insert.{:d}".format(self._insert_calls)
+                self._insert_calls += 1
+                if self._stage_skipped(stage, dict(lesion_type=lesion_type,
+                                                   n=n,
+                                                   lesion_file=self._file_signature(self.lesion_file) if isinstance(
+                                                       self.lesion_file, str) or self.lesion_file is None else None,
+                                                   lesion_size=lesion_size,
+                                                   lesion_key=lesion_key,
+                                                   locations=locations,
+                                                   roi_sizes=roi_sizes,
+                                                   seed=seed,
+                                                   save_variant=save_variant,
+                                                   variant=variant,
+                                                   placement=placement,
+                                                   phantom_file=self.arguments_mcgpu["phantom_file"] if len(self.manifest.dependencies(stage)) > 0 else
+                                                   self._file_signature(self.arguments_mcgpu["phantom_file"]))):
+                    if roi_sizes is not None:
+                        self.roi_sizes = roi_sizes
+                    return
+
+            # read self.arguments_mcgpu compressed, or keep editing the phantom of the open journal
+            if save_phantom or locations is None:
+                start = self.savepoint()
+                phantom = self.journal.phantom
+
+            if self.lesion_file is not None:
+                if n == -1:
+                    if locations is not None:
+                        n = len(locations)
+                    else:
+                        n = 1
 
-        if lesion_file is not None:
-            self.lesion_file = lesion_file
-
-        # read self.arguments_mcgpu compressed
-        if save_phantom or locations is None:
-            phantom = self._load_phantom_array_from_gzip()
-
-        if self.lesion_file is not None:
-            if n == -1:
-                if locations is not None:
-                    n = len(locations)
+                if save_phantom:
+                    cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Inserting {:d} non-overlapping lesions...".format(n),
+                           'cyan') if self.verbosity else None
                 else:
-                    n = 1
-
-            if save_phantom:
-                cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Inserting {:d} non-overlapping lesions...".format(n),
-                       'cyan') if self.verbosity else None
-            else:
-                cprint("Retrieving {:d} lesion locations...".format(
-                    n), 'cyan') if self.verbosity else None
-
-            if "h5" in self.lesion_file:
-                with h5py.File(self.lesion_file, "r") as hf:
-                    lesion = hf["volume"][()]
-            else:  # raw
-                with open(self.lesion_file, "rb") as f:
-                    lesion = f.read()
-                lesion = np.frombuffer(
-                    bytearray(lesion), dtype=np.uint8).reshape(lesion_size)
-
-        if roi_sizes is None and lesion is not None:
-            roi_shape = lesion.shape
-        elif roi_sizes is not None:
-            self.roi_sizes = roi_sizes
-
-        if locations is not None:
-            for cand in locations:
-                cand_type = lesion_type
-                if cand_type is None:
-                    cand_type = cand[3]
-                    if cand_type == 0:
-                        cand_type = 2
-
-                if lesion is None:
-                    lesion_shape = self.roi_sizes[np.abs(cand_type)]
-
-                if lesion is not None and save_phantom:
-                    lesion_shape = lesion.shape
-                    roi = phantom[int(cand[0] - lesion_shape[0] / 2):int(cand[0] + lesion_shape[0] / 2),
-                                  int(cand[2] - lesion_shape[2] / 2):int(cand[2] + lesion_shape[2] / 2),
-                                  int(cand[1] - lesion_shape[1] / 2):int(cand[1] + lesion_shape[1] / 2)]
-                    phantom[int(cand[0] - lesion_shape[0] / 2):int(cand[0] + lesion_shape[0] / 2),
-                            int(cand[2] - lesion_shape[2] / 2):int(cand[2] + lesion_shape[2] / 2),
-                            int(cand[1] - lesion_shape[1] / 2):int(cand[1] + lesion_shape[1] / 2)][lesion == 1] = Constants.LESION_MATERIALS[np.abs(cand_type)]
-
-                self.lesions.append(np.array([cand[0],
-                                              cand[1],
-                                              cand[2],
-                                              cand_type
-                                              ]))
+                    cprint("Retrieving {:d} lesion locations...".format(
+                        n), 'cyan') if self.verbosity else None
+
+                if not isinstance(self.lesion_file, str):  # LesionBank
+                    lesion = self.lesion_file[lesion_key]
+                elif "h5" in self.lesion_file:
+                    with h5py.File(self.lesion_file, "r") as hf:
+                        if lesion_key is not None:
+                            lesion = hf[lesion_key]["volume"][()]
+                        else:
+                            lesion = hf["volume"][()]
+                else:  # raw
+                    with open(self.lesion_file, "rb") as f:
+                        lesion = f.read()
+                    lesion = np.frombuffer(
+                        bytearray(lesion), dtype=np.uint8).reshape(lesion_size)
+
+            if roi_sizes is None and lesion is not None:
+                roi_shape = lesion.shape
+            elif roi_sizes is not None:
+                self.roi_sizes = roi_sizes
+
+            if locations is not None:
+                for cand in locations:
+                    cand_type = lesion_type
+                    if cand_type is None:
+                        cand_type = cand[3]
+                        if cand_type == 0:
+                            cand_type = 2
+
+                    if lesion is None:
+                        lesion_shape = self.roi_sizes[np.abs(cand_type)]
+
+                    if lesion is not None and save_phantom:
+                        lesion_shape = lesion.shape
+                        self.journal.stamp((slice(int(cand[0] - lesion_shape[0] / 2), int(cand[0] + lesion_shape[0] / 2)),
+                                            slice(int(cand[2] - lesion_shape[2] / 2), int(cand[2] + lesion_shape[2] / 2)),
+                                            slice(int(cand[1] - lesion_shape[1] / 2), int(cand[1] + lesion_shape[1] / 2))),
+                                           lesion == 1, Constants.LESION_MATERIALS[np.abs(cand_type)])
+
+                    self.lesions.append(np.array([cand[0],
+                                                  cand[1],
+                                                  cand[2],
+                                                  cand_type
+                                                  ]))
 
-                loc = {"dm": self.get_coordinates_dm([
-                    cand[1],
-                    cand[2],
-                    cand[0]]),
-                    "dbt": self.get_coordinates_dbt([
+                    loc = {"dm": self.get_coordinates_dm([
                         cand[1],
                         cand[2],
-                        cand[0]])}
-
-                self.lesion_locations["dm"].append(
-                    list(np.round([loc["dm"][0], loc["dm"][1], cand_type]).astype(int)))
+                        cand[0]]),
+                        "dbt": self.get_coordinates_dbt([
+                            cand[1],
+                            cand[2],
+                            cand[0]])}
 
-                self.lesion_locations["dbt"].append(
-                    list(np.round([loc["dbt"][0], loc["dbt"][1], loc["dbt"][2], cand_type]).astype(int)))
-        else:
-            current_seed = self.seed
+                    self.lesion_locations["dm"].append(
+                        list(np.round([loc["dm"][0], loc["dm"][1], cand_type]).astype(int)))
 
-            if seed is not None:
-                current_seed = seed if seed >= 0 else int(
-                    datetime.datetime.now().timestamp())
+                    self.lesion_locations["dbt"].append(
+                        list(np.round([loc["dbt"][0], loc["dbt"][1], loc["dbt"][2], cand_type]).astype(int)))
+            elif placement == "blue_noise":
+                current_seed = self.seed
 
-            np.random.seed(current_seed)
+                if seed is not None:
+                    current_seed = seed if seed >= 0 else int(
+                        datetime.datetime.now().timestamp())
 
-            if self.candidate_locations is not None:
-                Constants.INSERTION_MAX_TRIES = len(self.candidate_locations)
-                Constants.INSERTION_MAX_TOTAL_ATTEMPTS = 1000
-                np.random.shuffle(self.candidate_locations)
-                # current_candidate = 0
+                rng = self.get_rng("placement", current_seed, len(self.lesions))
 
-            roi_shape = self.roi_sizes[lesion_type]
-            c = 0
+                roi_shape = self.roi_sizes[lesion_type]
 
-            max_attempts = Constants.INSERTION_MAX_TOTAL_ATTEMPTS
-            while c < n and max_attempts >= 0:
-                found = False
-                roi = None
-                cand = None
-                loc = None
-                attempts = 0
-                bar = progressbar.ProgressBar(
-                    max_value=Constants.INSERTION_MAX_TRIES) if self.verbosity else None
-                while not found and max_attempts > 0:
-                    attempts += 1
-                    bar.update(attempts) if self.verbosity else None
-                    if attempts == Constants.INSERTION_MAX_TRIES:  # if too many attempts
-                        bar.finish() if self.verbosity else None
-                        attempts = 0
-                        max_attempts -= 1
-
-                        cprint(
-                            "Too many attempts at inserting, restarting the insertion! ({:d} remaining)".format(max_attempts), 'red') if self.verbosity else None
-                        phantom = self._load_phantom_array_from_gzip()
-
-                        current_seed += 1
-                        random.seed(current_seed)  # try with a different seed
-
-                        # rollback
-                        self.lesions = self.lesions[:-c]
-                        self.lesion_locations["dm"] = self.lesion_locations["dm"][:-c]
-                        self.lesion_locations["dbt"] = self.lesion_locations["dbt"][:-c]
-
-                        c = 0
+                for cand, loc in self._place_lesions(phantom, lesion.shape, roi_shape, n, rng):
+                    self.journal.stamp((slice(cand[0], cand[0] + lesion.shape[0]),
+                                        slice(cand[2], cand[2] + lesion.shape[2]),
+                                        slice(cand[1], cand[1] + lesion.shape[1])),
+                                       lesion == 1, Constants.LESION_MATERIALS[lesion_type])
 
-                        if self.candidate_locations is not None:
-                            np.random.shuffle(self.candidate_locations)
+                    self.lesions.append(np.array([int(cand[0] + lesion.shape[0] / 2),
+                                                  int(cand[1] +
+                                                      lesion.shape[1] / 2),
+                                                  int(cand[2] +
+                                                      lesion.shape[2] / 2),
+                                                  lesion_type
+                                                  ]))
 
-                        if max_attempts == 0:
-                            raise Exceptions.VictreError(
-                                "Insertion attempts exceeded")
+                    self.lesion_locations["dm"].append(
+                        list(np.round([loc["dm"][0], loc["dm"][1], lesion_type]).astype(int)))
 
-                        bar = progressbar.ProgressBar(
-                            max_value=bar.max_value) if self.verbosity else None
-                        continue
+                    self.lesion_locations["dbt"].append(
+                        list(np.round([loc["dbt"][0], loc["dbt"][1], loc["dbt"][2], lesion_type]).astype(int)))
+            else:
+                current_seed = self.seed
+
+                if seed is not None:
+                    current_seed = seed if seed >= 0 else int(
+                        datetime.datetime.now().timestamp())
+
+                # the number of lesions already inserted keeps successive insertions independent
+                stream = len(self.lesions)
+                rng = self.get_rng("insertion", current_seed, stream)
+
+                if self.candidate_locations is not None:
+                    Constants.INSERTION_MAX_TRIES = len(self.candidate_locations)
+                    Constants.INSERTION_MAX_TOTAL_ATTEMPTS = 1000
+                    rng.shuffle(self.candidate_locations)
+                    # current_candidate = 0
+
+                roi_shape = self.roi_sizes[lesion_type]
+                c = 0
+
+                max_attempts = Constants.INSERTION_MAX_TOTAL_ATTEMPTS
+                while c < n and max_attempts >= 0:
+                    found = False
+                    roi = None
+                    cand = None
+                    loc = None
+                    attempts = 0
+                    bar = progressbar.ProgressBar(
+                        max_value=Constants.INSERTION_MAX_TRIES) if self.verbosity else None
+                    while not found and max_attempts > 0:
+                        attempts += 1
+                        bar.update(attempts) if self.verbosity else None
+                        if attempts == Constants.INSERTION_MAX_TRIES:  # if too many attempts
+                            bar.finish() if self.verbosity else None
+                            attempts = 0
+                            max_attempts -= 1
+
+                            cprint(
+                                "Too many attempts at inserting, restarting the insertion! ({:d} remaining)".format(max_attempts), 'red') if self.verbosity else None
+                            current_seed += 1
+                            rng = self.get_rng(
+                                "insertion", current_seed, stream)  # try with a different seed
+
+                            # rollback the lesions inserted in this call
+                            self.rollback(start)
+
+                            c = 0
+
+                            if self.candidate_locations is not None:
+                                rng.shuffle(self.candidate_locations)
+
+                            if max_attempts == 0:
+                                raise Exceptions.VictreError(
+                                    "Insertion attempts exceeded")
+
+                            bar = progressbar.ProgressBar(
+                                max_value=bar.max_value) if self.verbosity else None
+                            continue
 
-                    if self.candidate_locations is not None:
-                        cand = (
-                            self.candidate_locations[attempts] - np.array(lesion.shape) / 2).astype(int)
-                    else:
-                        cand = [
-                            random.randint(0, phantom.shape[0] - roi_shape[0]),
-                            random.randint(0, phantom.shape[2] - roi_shape[2]),
-                            random.randint(0, phantom.shape[1] - roi_shape[1])]
+                        if self.candidate_locations is not None:
+                            cand = (
+                                self.candidate_locations[attempts] - np.array(lesion.shape) / 2).astype(int)
+                        else:
+                            cand = [
+                                rng.integers(0, phantom.shape[0] - roi_shape[0] + 1),
+                                rng.integers(0, phantom.shape[2] - roi_shape[2] + 1),
+                                rng.integers(0, phantom.shape[1] - roi_shape[1] + 1)]
 
-                    loc = {"dm": self.get_coordinates_dm([
-                        cand[1] + lesion.shape[1] / 2,
-                        cand[2] + lesion.shape[2] / 2,
-                        cand[0] + lesion.shape[0] / 2]),
-                        "dbt": self.get_coordinates_dbt([
+                        loc = {"dm": self.get_coordinates_dm([
                             cand[1] + lesion.shape[1] / 2,
                             cand[2] + lesion.shape[2] / 2,
-                            cand[0] + lesion.shape[0] / 2])}
+                            cand[0] + lesion.shape[0] / 2]),
+                            "dbt": self.get_coordinates_dbt([
+                                cand[1] + lesion.shape[1] / 2,
+                                cand[2] + lesion.shape[2] / 2,
+                                cand[0] + lesion.shape[0] / 2])}
+
+                        # check if the locations in DM and DBT are inside the ROI
+                        if np.any(np.array(loc["dm"]) < np.array(roi_shape[:2])) or \
+                           np.any(np.array(loc["dbt"]) < np.array(roi_shape)):
+                            continue
+
+                        roi = phantom[cand[0]:cand[0] + lesion.shape[0],
+                                      cand[2]:cand[2] + lesion.shape[2],
+                                      cand[1]:cand[1] + lesion.shape[1]]
+
+                        # check if lesion volume is too close to air, skin, nipple and muscle
+                        if not np.any(np.array(roi.shape) < lesion.shape) and \
+                            not (np.any([np.any(roi == x) for x in np.append(Constants.FORBIDDEN_OVERLAP,
+                                                                             list(Constants.LESION_MATERIALS.values()))])):
+                            found = True
+
+                    self.journal.stamp((slice(cand[0], cand[0] + lesion.shape[0]),
+                                        slice(cand[2], cand[2] + lesion.shape[2]),
+                                        slice(cand[1], cand[1] + lesion.shape[1])),
+                                       lesion == 1, Constants.LESION_MATERIALS[lesion_type])
+
+                    self.lesions.append(np.array([int(cand[0] + lesion.shape[0] / 2),
+                                                  int(cand[1] +
+                                                      lesion.shape[1] / 2),
+                                                  int(cand[2] +
+                                                      lesion.shape[2] / 2),
+                                                  lesion_type
+                                                  ]))
+
+                    self.lesion_locations["dm"].append(
+                        list(np.round([loc["dm"][0], loc["dm"][1], lesion_type]).astype(int)))
+
+                    self.lesion_locations["dbt"].append(
+                        list(np.round([loc["dbt"][0], loc["dbt"][1], loc["dbt"][2], lesion_type]).astype(int)))
+
+                    c += 1
+
+                    bar.finish() if self.verbosity else None
+
+            if lesion is not None:
+                np.savetxt("{:s}/{:d}/pcl_{:d}.loc".format(self.results_folder, self.seed, self.seed),
+                           np.asarray(self.lesions), fmt="%d")
+
+                if save_phantom and save_variant:
+                    cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Saving lesion-variant phantom...",
+                           'cyan') if self.verbosity else None
+
+                    self._save_phantom_variant(phantom, self.journal.blocks, variant)
+
+                    cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Insertion finished!", 'green', attrs=[
+                           'bold']) if self.verbosity else None
+
+                # save new phantom file
+                elif save_phantom:
+                    cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Saving new phantom...",
+                           'cyan') if self.verbosity else None
+
+                    # We save the phantom in gzip to reduce needed disk space
+                    with gzip.GzipFile(filename="{:s}/{:d}/pcl_{:d}.raw.gz".format(self.results_folder, self.seed, self.seed), mode="wb", mtime=0) as gz:
+                        gz.write(phantom)
+
+                    self.arguments_mcgpu["phantom_file"] = "{:s}/{:d}/pcl_{:d}.raw.gz".format(
+                        self.results_folder, self.seed, self.seed)
+
+                    self.phantom_variant = None
+                    # the variants saved over the previous full phantom are no longer valid
+                    for variant_file in self._variant_files():
+                        with h5py.File(variant_file, "r") as hf:
+                            stale = hf.attrs["base_file"] == os.path.abspath(self.arguments_mcgpu["phantom_file"])
+                        if stale:
+                            with contextlib.suppress(FileNotFoundError):
+                                os.remove(variant_file)
+
+                    with open("{:s}/{:d}/pcl_{:d}.mhd".format(self.results_folder, self.seed, self.seed), "w") as f:
+                        src = Template(Constants.MHD_FILE)
+                        template_arguments = copy.deepcopy(self.mhd)
+                        template_arguments["ElementDataFile"] = "pcl_{:d}.raw.gz".format(
+                            self.seed)
+                        for key in template_arguments.keys():
+                            if type(template_arguments[key]) is list:
+                                template_arguments[key] = ' '.join(
+                                    map(str, template_arguments[key]))
+                        result = src.substitute(template_arguments)
+                        f.write(result)
+
+                    cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Insertion finished!", 'green', attrs=[
+                           'bold']) if self.verbosity else None
+
+                if stage is not None:
+                    outputs = ["{:s}/{:d}/pcl_{:d}.loc".format(self.results_folder, self.seed, self.seed)]
+                    if self.phantom_variant is not None:
+                        outputs.append(self.phantom_variant)
+                    else:
+                        outputs.append(self.arguments_mcgpu["phantom_file"])
+                    self._record_stage(stage, outputs)
+        except BaseException:
+            # the lesion locations must not outlive the phantom edits dropped with the journal
+            if start is not None:
+                self.rollback(start)
+            raise
+        finally:
+            if own_journal:
+                self.commit()
+
+    def _stage_skipped(self, stage, parameters):
+        """
+            Checks the manifest before running a stage. If the stage was already run with the same
+            parameters and dependencies, the pipeline state it set is restored.
 
-                    # check if the locations in DM and DBT are inside the ROI
-                    if np.any(np.array(loc["dm"]) < np.array(roi_shape[:2])) or \
-                       np.any(np.array(loc["dbt"]) < np.array(roi_shape)):
-                        continue
+            :param stage: Name of the stage (see STAGE_DEPENDENCIES)
+            :param parameters: Dictionary with the parameters of the stage
+            :returns: True if the stage can be skipped
+        """
+        self._stage_hashes[stage] = self.manifest.hash(stage, parameters)
 
-                    roi = phantom[cand[0]:cand[0] + lesion.shape[0],
-                                  cand[2]:cand[2] + lesion.shape[2],
-                                  cand[1]:cand[1] + lesion.shape[1]]
+        if not self.incremental or not self.manifest.matches(stage, self._stage_hashes[stage]):
+            return False
 
-                    # check if lesion volume is too close to air, skin, nipple and muscle
-                    if not np.any(np.array(roi.shape) < lesion.shape) and \
-                        not (np.any([np.any(roi == x) for x in np.append(Constants.FORBIDDEN_OVERLAP,
-                                                                         list(Constants.LESION_MATERIALS.values()))])):
-                        found = True
+        for key, value in copy.deepcopy(self.manifest.state(stage)).items():
+            if "." in key:
+                attribute, item = key.split(".")
+                getattr(self, attribute)[item] = value
+            else:
+                setattr(self, key, value)
 
-                phantom[cand[0]:cand[0] + lesion.shape[0],
-                        cand[2]:cand[2] + lesion.shape[2],
-                        cand[1]:cand[1] + lesion.shape[1]][lesion == 1] = Constants.LESION_MATERIALS[lesion_type]
+        cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Skipping {:s}, inputs have not changed".format(stage),
+               'cyan') if self.verbosity else None
+        return True
 
-                self.lesions.append(np.array([int(cand[0] + lesion.shape[0] / 2),
-                                              int(cand[1] +
-                                                  lesion.shape[1] / 2),
-                                              int(cand[2] +
-                                                  lesion.shape[2] / 2),
-                                              lesion_type
-                                              ]))
+    def _record_stage(self, stage, outputs):
+        """
+            Records a stage that has just been run in the manifest, invalidating the stages that depend on it
 
-                self.lesion_locations["dm"].append(
-                    list(np.round([loc["dm"][0], loc["dm"][1], lesion_type]).astype(int)))
+            :param stage: Name of the stage, `_stage_skipped` must have been called before running it
+            :param outputs: List of output files of the stage, they are also registered in the results catalog
+        """
+        state = {}
+        for key in STAGE_STATE[StageManifest.base(stage)]:
+            if "." in key:
+                attribute, item = key.split(".")
+                state[key] = getattr(self, attribute)[item]
+            else:
+                state[key] = getattr(self, key)
+        self.manifest.record(stage, self._stage_hashes.pop(stage), outputs, state)
+
+        if self.catalog is not None:
+            self.catalog.add(outputs,
+                             seed=self.seed,
+                             stage=stage,
+                             results_folder=self.results_folder,
+                             phantom_file=self.arguments_mcgpu["phantom_file"],
+                             z=self.arguments_mcgpu.get(
+                                 "voxel_geometry_offset", [0, 0, 0])[2],
+                             spectrum=self.arguments_mcgpu["spectrum_file"],
+                             number_histories=self.arguments_mcgpu["number_histories"],
+                             parameters=dict(number_voxels=self.arguments_mcgpu["number_voxels"],
+                                             voxel_size=self.arguments_mcgpu["voxel_size"],
+                                             number_projections=self.arguments_mcgpu["number_projections"],
+                                             image_pixels=self.arguments_mcgpu["image_pixels"]))
 
-                self.lesion_locations["dbt"].append(
-                    list(np.round([loc["dbt"][0], loc["dbt"][1], loc["dbt"][2], lesion_type]).astype(int)))
+    @ staticmethod
+    def _file_signature(filename):
+        """
+            Returns the path, size and modification time of a file, to be used as a stage parameter
+        """
+        if filename is None or not os.path.exists(filename):
+            return filename
+        return [os.path.abspath(filename), os.path.getsize(filename), os.path.getmtime(filename)]
 
-                c += 1
+    def get_rng(self, stage, seed=None, *keys):
+        """
+            Returns an independent random generator for a stochastic stage of the pipeline.
+            Generators are derived from the seed with a seed sequence tree: the stage and the
+            given keys select the branch, so the same stage, seed and keys always give the same
+            stream, whatever the order in which the stages run or the worker that runs them.
+
+            :param stage: Name of the stage, one of RANDOM_STAGES
+            :param seed: Seed of the tree, defaults to the pipeline seed
+            :param keys: Additional non-negative integers to select the stream (e.g. batch or worker number)
+            :returns: numpy.random.Generator for the stage
+        """
+        if seed is None:
+            seed = self.seed
+        return np.random.default_rng(np.random.SeedSequence(
+            int(seed), spawn_key=(RANDOM_STAGES[stage],) + tuple(int(k) for k in keys)))
 
-                bar.finish() if self.verbosity else None
+    def _place_lesions(self, phantom, lesion_shape, roi_shape, n, rng):
+        """
+            Draws n mutually non-overlapping lesion locations by dart throwing. The candidates
+            (from the location files or random) are first filtered, all of them, with the same checks
+            as the sequential insertion; the valid ones are then visited in random order and accepted
+            only if their bounding box does not overlap an occupied one. Occupied boxes, including the lesions
+            already in the phantom, are kept in a spatial hash with cells of the minimum spacing.
+
+            :param phantom: Phantom 3-dimensional byte array
+            :param lesion_shape: Shape of the lesion to be inserted
+            :param roi_shape: Size of the ROI for the lesion type (in DBT pixels), used to derive the minimum spacing
+            :param n: Number of locations to be drawn
+            :param rng: Random generator of the placement stage
+            :returns: List of (corner, location) tuples, with the corner of the lesion in the phantom and its DM and DBT coordinates
+        """
+        # minimum distance between lesion centers, in phantom voxels (cand[0], cand[1], cand[2]).
+        # roi_shape is [x, y, z] in DBT pixels and get_coordinates_dbt maps cand[0] to the DBT z,
+        # cand[1] to the DBT y and cand[2] to the DBT x
+        ratio_xy = self.arguments_recon["recon_pixel_size"] / \
+            self.arguments_recon["voxel_size"]
+        ratio_z = self.arguments_recon["recon_thickness"] / \
+            self.arguments_recon["voxel_size"]
+        spacing = np.maximum(np.array(lesion_shape),
+                             np.ceil([roi_shape[2] * ratio_z,
+                                      roi_shape[1] * ratio_xy,
+                                      roi_shape[0] * ratio_xy])).astype(int)
 
-        if lesion is not None:
-            np.savetxt("{:s}/{:d}/pcl_{:d}.loc".format(self.results_folder, self.seed, self.seed),
-                       np.asarray(self.lesions), fmt="%d")
+        if self.candidate_locations is not None:
+            candidates = [(np.array(c) - np.array(lesion_shape) / 2).astype(int)
+                          for c in self.candidate_locations]
+        else:
+            candidates = [[rng.integers(0, phantom.shape[0] - roi_shape[0] + 1),
+                           rng.integers(0, phantom.shape[2] - roi_shape[2] + 1),
+                           rng.integers(0, phantom.shape[1] - roi_shape[1] + 1)]
+                          for _ in range(max(Constants.INSERTION_MAX_TRIES, 10 * n))]
+
+        forbidden = np.append(Constants.FORBIDDEN_OVERLAP,
+                              list(Constants.LESION_MATERIALS.values()))
+
+        grid = {}
+
+        def cell(center):
+            return tuple((np.array(center) // spacing).astype(int))
+
+        def overlaps(center):
+            c = cell(center)
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    for dz in (-1, 0, 1):
+                        for other in grid.get((c[0] + dx, c[1] + dy, c[2] + dz), []):
+                            if np.all(np.abs(np.array(center) - other) < spacing):
+                                return True
+            return False
+
+        for lesion in self.lesions:
+            grid.setdefault(cell(lesion[:3]), []).append(
+                np.array(lesion[:3]))
+
+        # valid candidates, the checks that do not depend on the other lesions being placed
+        valid = []
+        for cand in candidates:
+            center = np.array(cand) + np.array(lesion_shape) / 2
+
+            if np.any(np.array(cand) < 0):
+                continue
+
+            loc = {"dm": self.get_coordinates_dm([center[1], center[2], center[0]]),
+                   "dbt": self.get_coordinates_dbt([center[1], center[2], center[0]])}
+
+            # check if the locations in DM and DBT are inside the ROI
+            if np.any(np.array(loc["dm"]) < np.array(roi_shape[:2])) or \
+               np.any(np.array(loc["dbt"]) < np.array(roi_shape)):
+                continue
+
+            roi = phantom[cand[0]:cand[0] + lesion_shape[0],
+                          cand[2]:cand[2] + lesion_shape[2],
+                          cand[1]:cand[1] + lesion_shape[1]]
+
+            # check if lesion volume is too close to air, skin, nipple, muscle or other lesions
+            if np.any(np.array(roi.shape) < lesion_shape) or np.any(np.isin(roi, forbidden)):
+                continue
+
+            valid.append((cand, center, loc))
+
+        placed = []
+        for idx in rng.permutation(len(valid)):
+            if len(placed) == n:
+                break
 
-            # save new phantom file
-            if save_phantom:
-                cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Saving new phantom...",
-                       'cyan') if self.verbosity else None
+            cand, center, loc = valid[idx]
+            if overlaps(center):
+                continue
 
-                # We save the phantom in gzip to reduce needed disk space
-                with gzip.GzipFile(filename="{:s}/{:d}/pcl_{:d}.raw.gz".format(self.results_folder, self.seed, self.seed), mode="wb", mtime=0) as gz:
-                    gz.write(phantom)
+            grid.setdefault(cell(center), []).append(center)
+            placed.append((cand, loc))
 
-                self.arguments_mcgpu["phantom_file"] = "{:s}/{:d}/pcl_{:d}.raw.gz".format(
-                    self.results_folder, self.seed, self.seed)
+        if len(placed) < n:
+            raise Exceptions.VictreError(
+                "Only {:d} of {:d} non-overlapping lesion locations found".format(len(placed), n))
+
+        return placed
+
+    def savepoint(self):
+        """
+            Opens the undo journal of the phantom edits (loading the phantom) if needed and returns a savepoint.
+            While the journal is open, `insert_lesions` keeps editing the phantom in memory, so multi-stage
+            insertions (masses, clusters, absent ROIs) can be rolled back stage by stage.
+
+            :returns: Savepoint to be used in `rollback`
+        """
+        if self.journal is None:
+            self.journal = PhantomJournal(
+                self._load_phantom_array_from_gzip())
+        return dict(journal=self.journal.savepoint(),
+                    lesions=len(self.lesions),
+                    dm=len(self.lesion_locations["dm"]),
+                    dbt=len(self.lesion_locations["dbt"]))
+
+    def rollback(self, savepoint=None):
+        """
+            Restores the phantom blocks and the lesion locations to the given savepoint.
+            Files saved after the savepoint are not modified, the next insertion will overwrite them.
 
-                with open("{:s}/{:d}/pcl_{:d}.mhd".format(self.results_folder, self.seed, self.seed), "w") as f:
-                    src = Template(Constants.MHD_FILE)
-                    template_arguments = copy.deepcopy(self.mhd)
-                    template_arguments["ElementDataFile"] = "pcl_{:d}.raw.gz".format(
-                        self.seed)
-                    for key in template_arguments.keys():
-                        if type(template_arguments[key]) is list:
-                            template_arguments[key] = ' '.join(
-                                map(str, template_arguments[key]))
-                    result = src.substitute(template_arguments)
-                    f.write(result)
-
-                cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Insertion finished!", 'green', attrs=[
-                       'bold']) if self.verbosity else None
+            :param savepoint: Savepoint returned by `savepoint`, defaults to the opening of the journal
+        """
+        if self.journal is None:
+            return
+        if savepoint is None:
+            savepoint = dict(journal=0, lesions=0, dm=0, dbt=0)
+
+        self.journal.rollback(savepoint["journal"])
+        self.lesions = self.lesions[:savepoint["lesions"]]
+        self.lesion_locations["dm"] = self.lesion_locations["dm"][:savepoint["dm"]]
+        self.lesion_locations["dbt"] = self.lesion_locations["dbt"][:savepoint["dbt"]]
+
+    def commit(self):
+        """
+            Keeps the phantom edits and closes the undo journal, the next insertion will load the phantom again
+        """
+        if self.journal is not None:
+            self.journal.commit()
+        self.journal = None
 
     def add_absent_ROIs(self, lesion_type, n=1, locations=None, roi_sizes=None, save_locations=True):
         """
@@ -1740,7 +2520,10 @@ class Pipeline:
             :param roi_sizes: Size of the region of interest to be calculated to avoid overlapping with other tissues and check out of bounds locations
             :returns: None. A location file will be saved inside the `phantom` folder with the corresponding seed. Negative lesion type means absent ROI.
         """
-        phantom = self._load_phantom_array_from_gzip()
+        if self.journal is not None:
+            phantom = self.journal.phantom
+        else:
+            phantom = self._load_phantom_array_from_gzip()
 
         if roi_sizes is not None:
             self.roi_sizes = roi_sizes
@@ -1773,6 +2556,7 @@ class Pipeline:
                 self.lesion_locations["dbt"].append(
                     list(np.round([loc["dbt"][0], loc["dbt"][1], loc["dbt"][2], -lesion_type]).astype(int)))
         else:
+            rng = self.get_rng("absent", None, len(self.lesions))
             c = 0
             while c < n:
                 found = False
@@ -1781,9 +2565,9 @@ class Pipeline:
                 loc = None
                 while not found:
                     cand = [
-                        random.randint(0, phantom.shape[0] - roi_shape[0]),
-                        random.randint(0, phantom.shape[2] - roi_shape[2]),
-                        random.randint(0, phantom.shape[1] - roi_shape[1])]
+                        rng.integers(0, phantom.shape[0] - roi_shape[0] + 1),
+                        rng.integers(0, phantom.shape[2] - roi_shape[2] + 1),
+                        rng.integers(0, phantom.shape[1] - roi_shape[1] + 1)]
 
                     loc = {"dm": self.get_coordinates_dm([cand[1] + roi_shape[1] / 2,
                                                           cand[2] +
@@ -1825,12 +2609,47 @@ class Pipeline:
             np.savetxt("{:s}/{:d}/pcl_{:d}.loc".format(self.results_folder, self.seed, self.seed),
                        self.lesions, fmt="%d")
 
-    def generate_phantom(self):
+    def generate_phantom(self, generator="./Victre/generation/build/breastPhantomMain"):
         """
             Runs breast phantom generation.
 
+            :param generator: Path to the generation binary, relative to the working directory
             :returns: None. A phantom file will be saved inside the results folder with the corresponding raw phantom. Two files will be generated: `p_SEED.raw.gz` with the raw data, and `p_SEED.mhd` with the information about the raw data.
         """
+        if self._stage_skipped("generate", dict(arguments_generation=self.arguments_generation)):
+            self._insert_calls = 0
+            return
+
+        ssh_command = self._generation_command(generator)
+
+        cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Starting phantom generation (seed = {:d}), this will take some time...".format(
+            self.seed), 'cyan') if self.verbosity else None
+
+        self._run_logged(ssh_command,
+                         "{:s}/{:d}/output_generation.out".format(
+                             self.results_folder, self.seed),
+                         "Error extracting eigenfunctions")
+
+        if not os.path.exists("{:s}/{:d}/p_{:d}.mhd".format(self.results_folder, self.seed, self.seed)):
+            cprint("\nError while generating, check the output_generation.out file in the results folder",
+                   'red', attrs=['bold'])
+            raise Exceptions.VictreError("Generation error")
+
+        cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Generation finished!", 'green', attrs=[
+               'bold']) if self.verbosity else None
+
+        self._load_generated_phantom()
+
+        self._record_stage("generate", ["{:s}/{:d}/p_{:d}.mhd".format(self.results_folder, self.seed, self.seed),
+                                        "{:s}/{:d}/p_{:d}.raw.gz".format(self.results_folder, self.seed, self.seed)])
+
+    def _generation_command(self, generator="./Victre/generation/build/breastPhantomMain"):
+        """
+            Writes the generation config file and returns the command to run the breast phantom generation
+
+            :param generator: Path to the generation binary, relative to the working directory
+            :returns: Command to be run in a shell
+        """
         generation_config = "{:s}/{:d}/input_generation.in".format(
             self.results_folder, self.seed)
 
@@ -1844,46 +2663,59 @@ class Pipeline:
 
         full_path = os.path.abspath(generation_config)
 
-        command = "cd {:s} && ./Victre/generation/build/breastPhantomMain -c {:s}".format(
+        command = "cd {:s} && {:s} -c {:s}".format(
             os.getcwd(),
+            generator,
             full_path
         )
 
         if self.ips["cpu"] == "localhost":
-            ssh_command = command
-        else:
-            ssh_command = "ssh -Y {:s} \"{:s}\"".format(
-                self.ips["cpu"], command)
+            return command
+        return "ssh -Y {:s} \"{:s}\"".format(self.ips["cpu"], command)
 
-        cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Starting phantom generation (seed = {:d}), this will take some time...".format(
-            self.seed), 'cyan') if self.verbosity else None
+    @ staticmethod
+    def _run_logged(command, log_file, stop=None):
+        """
+            Runs a command in a shell writing its output to a log file
 
+            :param command: Command to be run
+            :param log_file: Path to the log file, it will be overwritten
+            :param stop: If this text appears in the output, the command is considered failed and is killed
+            :returns: Number of lines of output, 0 if the command was stopped
+        """
         completed = 0
 
-        process = subprocess.Popen(ssh_command, shell=True,
+        process = subprocess.Popen(command, shell=True,
                                    stdout=subprocess.PIPE,
                                    stderr=subprocess.STDOUT)
 
-        with open("{:s}/{:d}/output_generation.out".format(self.results_folder, self.seed), "wb") as f:
+        with open(log_file, "wb") as f:
             while True:
                 output = process.stdout.readline().decode("utf-8")
-                f.write(output.encode('utf-8'))
-                f.flush()
                 if output == "" and process.poll() is not None:
                     break
-                elif "Error extracting eigenfunctions" in output:
+
+                f.write(output.encode('utf-8'))
+                f.flush()
+
+                if stop is not None and stop in output:
+                    completed = 0
+                    process.kill()
                     break
+
                 completed += 1
 
-        if not os.path.exists("{:s}/{:d}/p_{:d}.mhd".format(self.results_folder, self.seed, self.seed)):
-            cprint("\nError while generating, check the output_generation.out file in the results folder",
-                   'red', attrs=['bold'])
-            raise Exceptions.VictreError("Generation error")
+        process.wait()
 
-        cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Generation finished!", 'green', attrs=[
-               'bold']) if self.verbosity else None
+        return completed
+
+    def _load_generated_phantom(self):
+        """
+            Updates the pipeline with the phantom generated in the results folder (`p_SEED.mhd`)
+        """
         self.arguments_mcgpu["phantom_file"] = "{:s}/{:d}/p_{:d}.raw.gz".format(
             self.results_folder, self.seed, self.seed)
+        self.phantom_variant = None
 
         self.mhd = self._read_mhd(
             "{:s}/{:d}/p_{:d}.mhd".format(self.results_folder, self.seed, self.seed))
@@ -1909,17 +2741,54 @@ class Pipeline:
             self.arguments_mcgpu["voxel_size"][1] / 2
 
         self.lesions = []
+        self._insert_calls = 0
 
         self.candidate_locations = self._mm_to_voxels(np.loadtxt(
             "{:s}/{:d}/p_{:d}.loc".format(self.results_folder, self.seed, self.seed), delimiter=',').tolist())
 
-    def compress_phantom(self, thickness=None):
+    def compress_phantom(self, thickness=None, compressor="./Victre/compression/build/breastCompressMain"):
         """
             Runs the FEBio compression.
 
             :param thickness: Specifies the objective thickness for the phantom to be compressed (in cm)
+            :param compressor: Path to the compression binary, relative to the working directory
             :returns: None. A phantom file will be saved inside the results folder with the corresponding raw phantom. Two files will be generated: `pc_SEED.raw.gz` with the raw data, and `pc_SEED.mhd` with the information about the raw data.
         """
+        if self._stage_skipped("compress", dict(thickness=thickness)):
+            self._insert_calls = 0
+            return
+
+        ssh_command = self._compression_command(thickness, compressor)
+
+        cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Starting phantom compression, this will take some time...",
+               'cyan') if self.verbosity else None
+
+        completed = self._run_logged(ssh_command,
+                                     "{:s}/{:d}/output_compression.out".format(
+                                         self.results_folder, self.seed),
+                                     "fault")
+
+        if completed == 0 or not os.path.exists("{:s}/{:d}/pc_{:d}.mhd".format(self.results_folder, self.seed, self.seed)):
+            cprint("\nError while compressing, check the output_compression.out file in the results folder",
+                   'red', attrs=['bold'])
+            raise Exceptions.VictreError("Compression error")
+
+        cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Compression finished!", 'green', attrs=[
+               'bold']) if self.verbosity else None
+
+        self._load_compressed_phantom()
+
+        self._record_stage("compress", ["{:s}/{:d}/pc_{:d}.mhd".format(self.results_folder, self.seed, self.seed),
+                                        "{:s}/{:d}/pc_{:d}.raw.gz".format(self.results_folder, self.seed, self.seed)])
+
+    def _compression_command(self, thickness=None, compressor="./Victre/compression/build/breastCompressMain"):
+        """
+            Returns the command to run the compression of the generated phantom
+
+            :param thickness: Specifies the objective thickness for the phantom to be compressed (in cm), defaults to the one interpolated from the breast height
+            :param compressor: Path to the compression binary, relative to the working directory
+            :returns: Command to be run in a shell
+        """
         if thickness is None:
             # thickness = int(self.arguments_generation["compressionThickness"])
             interp = interpolate.interp1d(
@@ -1929,8 +2798,9 @@ class Pipeline:
             thickness = np.round(float(interp(
                 self.arguments_mcgpu["number_voxels"][2] * self.arguments_mcgpu["voxel_size"][2] * 10)), 2)
 
-        command = "cd {:s} && ./Victre/compression/build/breastCompressMain -s {:d} -t {:f} -d {:s}/{:d}".format(
+        command = "cd {:s} && {:s} -s {:d} -t {:f} -d {:s}/{:d}".format(
             os.getcwd(),
+            compressor,
             self.seed,
             thickness,
             self.results_folder,
@@ -1938,44 +2808,17 @@ class Pipeline:
         )
 
         if self.ips["cpu"] == "localhost":
-            ssh_command = command
-        else:
-            ssh_command = "ssh -Y {:s} \"{:s}\"".format(
-                self.ips["cpu"], command)
-
-        cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Starting phantom compression, this will take some time...",
-               'cyan') if self.verbosity else None
-
-        completed = 0
-
-        process = subprocess.Popen(ssh_command, shell=True,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
-
-        with open("{:s}/{:d}/output_compression.out".format(self.results_folder, self.seed), "wb") as f:
-            while True:
-                output = process.stdout.readline().decode("utf-8")
-                if output == "" and process.poll() is not None:
-                    break
-
-                completed += 1
-
-                f.write(output.encode('utf-8'))
-                f.flush()
-
-                if "fault" in output:
-                    completed = 0
-                    break
-
-        if completed == 0 or not os.path.exists("{:s}/{:d}/pc_{:d}.mhd".format(self.results_folder, self.seed, self.seed)):
-            cprint("\nError while compressing, check the output_compression.out file in the results folder",
-                   'red', attrs=['bold'])
-            raise Exceptions.VictreError("Compression error")
+            return command
+        return "ssh -Y {:s} \"{:s}\"".format(self.ips["cpu"], command)
 
-        cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] Compression finished!", 'green', attrs=[
-               'bold']) if self.verbosity else None
+    def _load_compressed_phantom(self):
+        """
+            Updates the pipeline with the compressed phantom in the results folder (`pc_SEED.mhd`)
+        """
         self.arguments_mcgpu["phantom_file"] = "{:s}/{:d}/pc_{:d}.raw.gz".format(
             self.results_folder, self.seed, self.seed)
+        self.phantom_variant = None
+        self._insert_calls = 0
 
         self.mhd = self._read_mhd(
             "{:s}/{:d}/pc_{:d}.mhd".format(self.results_folder, self.seed, self.seed))
@@ -2006,6 +2849,9 @@ class Pipeline:
 
             :returns: None. A phantom file will be saved inside the results folder with the corresponding raw phantom. Two files will be generated: `pc_SEED_crop.raw.gz` with the raw data, and `pc_SEED_crop.mhd` with the information about the raw data.
         """
+        self._insert_calls = 0
+        if self._stage_skipped("crop", dict(size=size)):
+            return
 
         cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") +
                "] Cropping phantom...", 'cyan') if self.verbosity else None
@@ -2065,6 +2911,7 @@ class Pipeline:
             gz.write(np.ascontiguousarray(phantom))
 
         self.arguments_mcgpu["phantom_file"] = gzip_file
+        self.phantom_variant = None
 
         self.mhd["ElementDataFile"] = os.path.basename(gzip_file)
         self.mhd["CompressedData"] = True  # because of gzip
@@ -2109,6 +2956,9 @@ class Pipeline:
             self.candidate_locations = self._mm_to_voxels(
                 self.candidate_locations)
 
+        self._record_stage("crop", [gzip_file,
+                                    "{:s}/{:d}/pc_{:d}_crop.mhd".format(self.results_folder, self.seed, self.seed)])
+
     def get_dm_segmentation(self, roi=None, selected_materials=[]):
         phantom = self._load_phantom_array_from_gzip()
 
@@ -2187,28 +3037,7 @@ class Pipeline:
             :param filename: File name of the MHD file to be parsed
             :returns: Dictionary containing the values of the MHD file
         """
-        data = {}
-        with open(filename, "r") as f:
-            for line in f:
-                s = re.search(
-                    "([a-zA-Z]*) = (.*)", line)
-                data[s[1]] = s[2]
-
-                if " " in data[s[1]]:
-                    data[s[1]] = data[s[1]].split(' ')
-                    for i in range(len(data[s[1]])):
-                        if data[s[1]][i].replace(".", "").replace("-", "").isnumeric():
-                            if "." in data[s[1]][i]:
-                                data[s[1]][i] = float(data[s[1]][i])
-                            else:
-                                data[s[1]][i] = int(data[s[1]][i])
-                else:
-                    if data[s[1]].replace(".", "").replace("-", "").isnumeric():
-                        if "." in data[s[1]]:
-                            data[s[1]] = float(data[s[1]])
-                        else:
-                            data[s[1]] = int(data[s[1]])
-        return data
+        return read_mhd(filename)
 
     def _mm_to_voxels(self, locations):
         """
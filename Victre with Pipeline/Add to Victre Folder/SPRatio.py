@@ -0,0 +1,157 @@
+import os
+import re
+import datetime
+from fnmatch import fnmatch
+import numpy as np
+from termcolor import cprint
+from .Victre_Tools import extract_phantom_value, check_database_path, connect_database
+
+SP_COLUMNS = ["path", "seed", "ml", "cc", "z",
+              "center_y", "center_x", "roi_top", "roi_bottom", "roi_left", "roi_right", "signal_found",
+              "mean_total", "std_total", "mean_primary", "std_primary", "mean_scatter", "std_scatter",
+              "sp_ratio", "created"]
+
+
+def sp_statistics(raw_file, image_pixels=(3584, 2816), roi_size=(20, 20), x_center=1795, window_size=10, threshold=0.6):
+    """
+        Computes the primary, scatter and S/P ROI statistics of a MCGPU output with two images (Primary+Scatter
+        and Primary), as stackanalyzer does on the stacks built by StackSort. The signal is found in the y-profile
+        of the primary image around `x_center` (region below `threshold` of its range) and the same ROI is used
+        for the three images. Only the profile band and the ROI are read from the file.
+
+        :param raw_file: Path to the MCGPU output (e.g. ..._Z[20]_0002.raw)
+        :param image_pixels: Width and height of the images (MCGPU `image_pixels`)
+        :param roi_size: Height and width of the ROI in pixels
+        :param x_center: Column of the center of the signal
+        :param window_size: Half width of the band used for the y-profile
+        :param threshold: Fraction of the profile range below which the pixels belong to the signal
+        :returns: Dictionary with the ROI and the mean and standard deviation of the images, None values if no signal was found
+    """
+    width, height = image_pixels
+    images = np.memmap(raw_file, dtype=np.float32, mode="r",
+                       shape=(2, height, width))
+
+    profile = images[1, :, x_center - window_size:x_center + window_size].mean(axis=1, dtype=np.float64)
+    signal = profile < profile.min() + (profile.max() - profile.min()) * threshold
+    stats = dict(center_x=x_center, signal_found=bool(signal.any()))
+    if not stats["signal_found"]:
+        return stats
+
+    y_center = (np.argmax(signal) + len(signal) - 1 - np.argmax(signal[::-1])) // 2
+    half_height, half_width = np.array(roi_size) // 2
+    top, bottom = max(0, int(y_center - half_height)), min(height, int(y_center + half_height))
+    left, right = max(0, int(x_center - half_width)), min(width, int(x_center + half_width))
+
+    total = images[0, top:bottom, left:right].astype(np.float64)
+    primary = images[1, top:bottom, left:right].astype(np.float64)
+    scatter = total - primary
+
+    stats.update(center_y=int(y_center), roi_top=top, roi_bottom=bottom, roi_left=left, roi_right=right,
+                 mean_total=total.mean(), std_total=total.std(),
+                 mean_primary=primary.mean(), std_primary=primary.std(),
+                 mean_scatter=scatter.mean(), std_scatter=scatter.std())
+    stats["sp_ratio"] = stats["mean_scatter"] / stats["mean_primary"] if stats["mean_primary"] != 0 else None
+    return stats
+
+
+class SPRatioHook:
+    """
+        Object constructor for the projection hook that computes the S/P ratio of every MCGPU output as soon
+        as it is written (see the `projection_hooks` of Pipeline), so the S/P curves do not need the Z stacks
+        to be built and analyzed. The statistics are appended to the `sp_ratios` table of an SQLite database,
+        one row per output file (see `sp_statistics`). As the other SQLite databases, it has to be on a
+        node-local path when the workers run on several nodes, unless it is `shared`.
+
+        :param table: Path to the SQLite database, defaults to the results catalog of the pipeline
+        :param roi_size: Height and width of the ROI in pixels
+        :param x_center: Column of the center of the signal
+        :param window_size: Half width of the band used for the y-profile
+        :param pattern: Only the output files matching this pattern are analyzed
+        :param shared: True if the database is used by workers on several nodes (see `connect_database`), the shared results catalog of the pipeline is always used as such
+        :param verbosity: True will output the S/P ratio of every file
+        :returns: None
+    """
+
+    def __init__(self,
+                 table=None,
+                 roi_size=(20, 20),
+                 x_center=1795,
+                 window_size=10,
+                 pattern="*_0002.raw",
+                 shared=False,
+                 verbosity=True):
+        self.table = table
+        self.roi_size = roi_size
+        self.x_center = x_center
+        self.window_size = window_size
+        self.pattern = pattern
+        self.shared = shared
+        self.verbosity = verbosity
+        self.checked = set()
+
+    def _connect(self, table, shared):
+        return connect_database(table, 60, shared)
+
+    def _table(self, pipeline):
+        if self.table is not None:
+            return self.table
+        if pipeline is not None and pipeline.catalog is not None:
+            return pipeline.catalog.filename
+        return "{:s}/results_catalog.db".format(pipeline.results_folder if pipeline is not None else ".")
+
+    def __call__(self, raw_file, pipeline=None):
+        """
+            Analyzes an output file and appends its statistics to the table
+
+            :param raw_file: Path to the MCGPU output
+            :param pipeline: Pipeline that projected it, its seed, phantom and Z offset are stored with the statistics
+            :returns: Dictionary with the row added, None if the file does not match the pattern
+        """
+        if not fnmatch(os.path.basename(raw_file), self.pattern):
+            return None
+
+        if pipeline is not None:
+            image_pixels = pipeline.arguments_mcgpu["image_pixels"]
+            seed = pipeline.seed
+            cc, ml, _ = extract_phantom_value(os.path.basename(pipeline.arguments_mcgpu["phantom_file"]))
+            z = pipeline.arguments_mcgpu.get("voxel_geometry_offset", [0, 0, 0])[2]
+        else:
+            # everything from the file name (e.g. ..._ML[20]cm_CC[3]cm_..._Z[20]_0002.raw)
+            image_pixels = (3584, 2816)
+            seed = None
+            cc, ml, _ = extract_phantom_value(os.path.basename(raw_file))
+            z_match = re.search(r"_Z\[(\d+(\.\d+)?)\]", os.path.basename(raw_file))
+            z = float(z_match.group(1)) if z_match else None
+
+        row = dict(path=os.path.abspath(raw_file), seed=seed,
+                   ml=ml if ml > 0 else None, cc=cc if cc > 0 else None, z=z,
+                   created=datetime.datetime.now().isoformat(timespec="seconds"))
+        row.update(sp_statistics(raw_file, image_pixels, self.roi_size, self.x_center, self.window_size))
+
+        table = self._table(pipeline)
+        shared = self.shared or (pipeline is not None and pipeline.catalog is not None and
+                                 table == pipeline.catalog.filename and pipeline.catalog.shared)
+        self.add(row, table, shared)
+        if row["signal_found"]:
+            cprint("S/P ratio of {:s}: {:.4f}".format(os.path.basename(raw_file), row["sp_ratio"]),
+                   'cyan') if self.verbosity else None
+        else:
+            cprint("No signal found in {:s}".format(os.path.basename(raw_file)),
+                   'yellow') if self.verbosity else None
+        return row
+
+    def add(self, row, table, shared=False):
+        """
+            Adds (or replaces) the row of an output file
+        """
+        if not shared and table not in self.checked:
+            check_database_path(table)
+            self.checked.add(table)
+        with self._connect(table, shared) as db:
+            db.execute("CREATE TABLE IF NOT EXISTS sp_ratios (path TEXT PRIMARY KEY, seed INTEGER, ml REAL, cc REAL, z REAL, "
+                       "center_y INTEGER, center_x INTEGER, roi_top INTEGER, roi_bottom INTEGER, roi_left INTEGER, "
+                       "roi_right INTEGER, signal_found INTEGER, mean_total REAL, std_total REAL, mean_primary REAL, "
+                       "std_primary REAL, mean_scatter REAL, std_scatter REAL, sp_ratio REAL, created TEXT)")
+            db.execute("CREATE INDEX IF NOT EXISTS sp_ratios_size ON sp_ratios (ml, cc, z)")
+            db.execute("INSERT OR REPLACE INTO sp_ratios VALUES ({:s})".format(", ".join("?" * len(SP_COLUMNS))),
+                       [row.get(column) for column in SP_COLUMNS])
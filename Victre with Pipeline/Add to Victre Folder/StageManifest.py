@@ -0,0 +1,194 @@
+import os
+import json
+import hashlib
+import datetime
+import numpy as np
+
+# direct dependencies of every stage of the pipeline, insertions are chained as insert.0, insert.1...
+STAGE_DEPENDENCIES = {"generate": [],
+                      "compress": ["generate"],
+                      "crop": ["compress"],
+                      "insert": ["generate", "compress", "crop"],
+                      "flatfield": [],
+                      "project": ["insert"],
+                      "reconstruct": ["project", "flatfield"],
+                      "dicom": ["project", "reconstruct"],
+                      "rois": ["project", "reconstruct"]}
+
+# pipeline attributes (or attribute.key) set by every stage, restored when the stage is skipped
+PHANTOM_STATE = ["arguments_mcgpu.phantom_file",
+                 "arguments_mcgpu.number_voxels",
+                 "arguments_mcgpu.voxel_size",
+                 "arguments_mcgpu.source_position",
+                 "arguments_recon.voxels_x",
+                 "arguments_recon.voxels_y",
+                 "arguments_recon.voxels_z",
+                 "arguments_recon.voxel_size",
+                 "mhd",
+                 "recon_size",
+                 "candidate_locations",
+                 "lesions",
+                 "phantom_variant"]
+STAGE_STATE = {"generate": PHANTOM_STATE,
+               "compress": PHANTOM_STATE,
+               "crop": PHANTOM_STATE,
+               "insert": ["arguments_mcgpu.phantom_file",
+                          "lesions",
+                          "lesion_locations",
+                          "phantom_variant"],
+               "flatfield": ["flatfield_DM",
+                             "arguments_recon.flatfield_file"],
+               "project": [],
+               "reconstruct": ["mhd",
+                               "recon_size"],
+               "dicom": [],
+               "rois": []}
+
+
+def _signature(filename):
+    if not os.path.exists(filename):
+        return None
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+class StageManifest:
+    """
+        Object constructor for the manifest of the stages run for a phantom. Every stage is
+        recorded with a hash of its parameters and of the hashes of the stages it depends on,
+        its output files and the pipeline state it set. A stage whose hash matches its record
+        (and whose outputs have not been modified since) can be skipped; recording a stage invalidates all the stages
+        that depend on it, make-style.
+
+        :param filename: Path to the JSON manifest, it will be created if it does not exist
+        :returns: None
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.stages = {}
+        if os.path.exists(filename):
+            with open(filename, "r") as f:
+                self.stages = json.load(f)
+
+    def __contains__(self, stage):
+        return stage in self.stages
+
+    @ staticmethod
+    def base(stage):
+        """
+            Returns the stage without its index or modality (e.g. insert.1 -> insert)
+        """
+        return stage.split(".")[0]
+
+    def dependencies(self, stage):
+        """
+            Returns the recorded stages the given stage depends on
+
+            :param stage: Name of the stage
+            :returns: List of stage names
+        """
+        base = self.base(stage)
+        if base == "insert" and stage != "insert.0":
+            # every insertion works on the phantom of the previous one
+            previous = "insert.{:d}".format(int(stage.split(".")[1]) - 1)
+            return [previous] if previous in self.stages else []
+        if base == "project":
+            # the projection uses the phantom of the last insertion, or the last phantom stage
+            inserts = [s for s in self.stages if self.base(s) == "insert"]
+            if len(inserts) > 0:
+                return [max(inserts, key=lambda s: int(s.split(".")[1]))]
+            for phantom_stage in ["crop", "compress", "generate"]:
+                if phantom_stage in self.stages:
+                    return [phantom_stage]
+            return []
+        return [s for s in self.stages if self.base(s) in STAGE_DEPENDENCIES[base]]
+
+    def dependents(self, stage):
+        """
+            Returns the recorded stages that depend, directly or not, on the given stage
+
+            :param stage: Name of the stage
+            :returns: Set of stage names
+        """
+        found = set()
+        changed = True
+        while changed:
+            changed = False
+            for other in self.stages:
+                if other not in found and other != stage and \
+                        any(s == stage or s in found for s in self.dependencies(other)):
+                    found.add(other)
+                    changed = True
+        if self.base(stage) == "insert":
+            index = int(stage.split(".")[1])
+            found.update(s for s in self.stages
+                         if self.base(s) == "insert" and int(s.split(".")[1]) > index)
+        return found
+
+    def hash(self, stage, parameters):
+        """
+            Computes the hash of a stage from its parameters and the hashes of its dependencies
+
+            :param stage: Name of the stage
+            :param parameters: JSON-serializable dictionary with the parameters of the stage
+            :returns: Hexadecimal hash
+        """
+        description = {"stage": stage,
+                       "parameters": parameters,
+                       "dependencies": {s: self.stages[s]["hash"] for s in self.dependencies(stage)}}
+        return hashlib.sha1(json.dumps(description, sort_keys=True, default=_to_json).encode("utf-8")).hexdigest()
+
+    def matches(self, stage, stage_hash):
+        """
+            Returns True if the stage was recorded with the given hash and its outputs have not been modified
+        """
+        record = self.stages.get(stage)
+        return record is not None and record["hash"] == stage_hash and \
+            all(_signature(output) == signature for output, signature in record["outputs"].items())
+
+    def state(self, stage):
+        """
+            Returns the pipeline state recorded for the stage
+        """
+        return self.stages[stage]["state"]
+
+    def record(self, stage, stage_hash, outputs, state):
+        """
+            Records a stage that has just been run and invalidates its dependents
+
+            :param stage: Name of the stage
+            :param stage_hash: Hash of the stage (see `hash`)
+            :param outputs: List of output files of the stage
+            :param state: Dictionary with the pipeline state set by the stage
+        """
+        self.invalidate(stage)
+        self.stages[stage] = {"hash": stage_hash,
+                              "outputs": {output: _signature(output) for output in outputs},
+                              "state": json.loads(json.dumps(state, default=_to_json)),
+                              "time": datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S")}
+        self.save()
+
+    def invalidate(self, stage):
+        """
+            Removes the records of the stage and all its dependents
+        """
+        for other in self.dependents(stage) | {stage}:
+            self.stages.pop(other, None)
+        self.save()
+
+    def save(self):
+        """
+            Writes the manifest atomically
+        """
+        with open(self.filename + ".tmp", "w") as f:
+            json.dump(self.stages, f, indent=4, sort_keys=True)
+        os.replace(self.filename + ".tmp", self.filename)
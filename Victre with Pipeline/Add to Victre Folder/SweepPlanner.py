@@ -0,0 +1,166 @@
+import os
+import glob
+import json
+import hashlib
+import itertools
+from .Victre_Tools import extract_phantom_value
+
+
+def load_spec(filename):
+    """
+        Loads a sweep specification from a JSON or YAML file
+
+        :param filename: Path to the specification, YAML is used for the .yaml and .yml extensions
+        :returns: Dictionary with the specification
+    """
+    with open(filename, "r") as f:
+        if filename.endswith((".yaml", ".yml")):
+            import yaml  # optional, only needed for YAML specifications
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def _axis_values(axis):
+    # a list of values, a single value or a {"start", "stop", "step"} range (stop included)
+    if isinstance(axis, dict):
+        values = []
+        value = axis["start"]
+        while value <= axis["stop"]:
+            values.append(value)
+            value += axis.get("step", 1)
+        return values
+    if isinstance(axis, list):
+        return axis
+    return [axis]
+
+
+class SweepPlanner:
+    """
+        Object constructor for a parameter sweep planner. The specification declares the phantoms
+        and the axes of the sweep; the planner expands the grid into jobs, removes duplicated
+        configurations, skips the jobs already finished and splits the rest across workers.
+
+        Specification keys:
+
+        - `phantoms`: glob pattern (or list of patterns) of the phantom files. The ML group is the name
+          of the folder of each phantom, and its CC, ML and PA sizes are read from the file name.
+        - `axes`: dictionary of axis name to a list of values, a single value or a {"start", "stop", "step"} range.
+          `z` is the voxel geometry offset, `materials` the name of an entry in `material_sets`, and any other
+          axis overrides the MCGPU argument with the same name (e.g. `number_histories`, `spectrum_file`).
+        - `filters` (optional): dictionary with the allowed values of `ML_group`, `cc`, `ml` or `pa`.
+        - `results_folder`: results folder of each job, formatted with the job values and their truncated
+          integer values as `<name>_int` (e.g. "./results/{ML_group}/{cc_int}", where a CC of 3.5 cm gives 3).
+        - `state_folder` (optional): folder where finished jobs are recorded, defaults to `sweep_state` in the working directory.
+        - `seeds` (optional): seed registry shared by the workers (see SeedRegistry), it can be on the shared folder.
+
+        :param spec: Dictionary with the specification or path to a JSON/YAML file
+        :returns: None
+    """
+
+    def __init__(self, spec):
+        if isinstance(spec, str):
+            spec = load_spec(spec)
+        self.spec = spec
+        self.state_folder = spec.get("state_folder", "./sweep_state")
+
+    @ staticmethod
+    def job_key(config):
+        """
+            Returns the key of a job, a hash of its configuration
+        """
+        return hashlib.sha1(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+    def expand(self):
+        """
+            Expands the grid of the specification into jobs, identical configurations are only kept once
+
+            :returns: List of jobs, each one a dictionary with its `key`, `config` (phantom and axis values) and `results_folder`
+        """
+        patterns = self.spec["phantoms"]
+        if isinstance(patterns, str):
+            patterns = [patterns]
+
+        phantoms = []
+        for phantom_file in sorted(set(f for pattern in patterns for f in glob.glob(pattern))):
+            cc, ml, pa = extract_phantom_value(phantom_file)
+            phantom = dict(phantom_file=os.path.normpath(phantom_file),
+                           ML_group=os.path.basename(
+                               os.path.dirname(phantom_file)),
+                           cc=cc, ml=ml, pa=pa)
+            if all(phantom[key] in values for key, values in self.spec.get("filters", {}).items()):
+                phantoms.append(phantom)
+        phantoms.sort(key=lambda p: (p["ML_group"], p["cc"], p["phantom_file"]))
+
+        axes = self.spec.get("axes", {})
+        names = sorted(axes.keys())
+
+        jobs = {}
+        for phantom in phantoms:
+            for values in itertools.product(*[_axis_values(axes[name]) for name in names]):
+                config = dict(phantom)
+                config.update(zip(names, values))
+                key = self.job_key(config)
+                if key not in jobs:
+                    jobs[key] = dict(key=key,
+                                     config=config,
+                                     results_folder=self.results_folder(config))
+        return list(jobs.values())
+
+    def results_folder(self, config):
+        """
+            Returns the results folder of a job configuration, numeric values are also available
+            truncated as `<name>_int` (as int(cc) did in the original scripts, rounding would move 3.5 to 4)
+        """
+        values = dict(config)
+        values.update({"{:s}_int".format(key): int(value) for key, value in config.items()
+                       if isinstance(value, (int, float)) and not isinstance(value, bool)})
+        return self.spec["results_folder"].format(**values)
+
+    def _state_file(self, job):
+        return "{:s}/{:s}.json".format(self.state_folder, job["key"])
+
+    def is_done(self, job):
+        """
+            Returns True if the job was recorded as finished and all its outputs still exist
+        """
+        if not os.path.exists(self._state_file(job)):
+            return False
+        with open(self._state_file(job), "r") as f:
+            state = json.load(f)
+        return all(len(glob.glob(output)) > 0 for output in state["outputs"])
+
+    def mark_done(self, job, seed, outputs):
+        """
+            Records a job as finished
+
+            :param job: Job returned by `expand`
+            :param seed: Seed used by the job
+            :param outputs: List of output files (or glob patterns) of the job, checked by `is_done`
+        """
+        os.makedirs(self.state_folder, exist_ok=True)
+        with open(self._state_file(job) + ".tmp", "w") as f:
+            json.dump(dict(job, seed=seed, outputs=outputs), f, indent=4)
+        os.replace(self._state_file(job) + ".tmp", self._state_file(job))
+
+    def pending(self, jobs=None):
+        """
+            Returns the jobs that have not been finished yet
+
+            :param jobs: List of jobs, defaults to the whole grid
+        """
+        if jobs is None:
+            jobs = self.expand()
+        return [job for job in jobs if not self.is_done(job)]
+
+    @ staticmethod
+    def shard(jobs, index, count):
+        """
+            Returns the jobs of a worker, jobs are dealt round-robin so that every worker gets a similar mix
+
+            :param jobs: List of jobs
+            :param index: Index of the worker (from 0 to count - 1)
+            :param count: Number of workers
+        """
+        if not 0 <= index < count:
+            raise ValueError("Worker index {:d} out of range for {:d} workers".format(index, count))
+        return jobs[index::count]
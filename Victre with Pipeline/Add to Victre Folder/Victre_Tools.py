@@ -1,49 +1,260 @@
 import os
+import glob
 import random
-from typing import Set
+import hashlib
+import json
+import time
+import socket
+import sqlite3
+import datetime
+import warnings
+import contextlib
+from pathlib import Path
+from typing import List, Optional
 import numpy as np
 import re
 
-def random_number_generator(min_val: int = 1, max_digits: int = None) -> int:
-    import os, random
-    from typing import Set
+# filesystem types (as in /proc/mounts) shared between nodes, where SQLite locking is unreliable
+NETWORK_FILESYSTEMS = ("nfs", "nfs4", "cifs", "smb3", "smbfs", "lustre", "gpfs", "beegfs", "ceph",
+                       "glusterfs", "fuse.glusterfs", "fuse.sshfs", "9p")
 
-    # If no max_digits is provided, choose one randomly between 1 and 9.
-    if max_digits is None:
-        max_digits = random.randint(1, 9)
-    max_val = int('1' + '0' * max_digits)  # e.g., max_digits=3 gives max_val=1000
 
-    def _load_used_numbers(filename: str = "used_seeds.csv") -> Set[int]:
+def network_filesystem(path: str) -> Optional[str]:
+    """
+    Returns the type of the filesystem the path is on if it is a network filesystem, None otherwise
+    (or if the mounts cannot be read, e.g. outside Linux)
+    """
+    path = os.path.realpath(path)
+    if not os.path.exists(path):
+        path = os.path.dirname(path)
+    try:
+        with open("/proc/mounts", 'r') as f:
+            mounts = [line.split()[1:3] for line in f if len(line.split()) > 2]
+    except OSError:
+        return None
+    # the longest mount point containing the path, spaces are escaped as \040 in /proc/mounts
+    fs_type = None
+    best = ""
+    for mount_point, mount_type in mounts:
+        mount_point = mount_point.replace("\\040", " ")
+        if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) and len(mount_point) >= len(best):
+            best, fs_type = mount_point, mount_type
+    return fs_type if fs_type in NETWORK_FILESYSTEMS else None
+
+
+def check_database_path(filename: str) -> None:
+    """
+    Warns if an SQLite database is on a network filesystem. Its locks are not reliable there, so workers
+    on different nodes can corrupt it or read stale data (e.g. allocate the same seed twice): the seed
+    registry, the results catalog and the S/P table have to be on a node-local path when the workers of
+    a sweep run on several nodes.
+    """
+    fs_type = network_filesystem(filename)
+    if fs_type is not None:
+        warnings.warn(f"The SQLite database {filename} is on a {fs_type} filesystem, where its locking is "
+                      f"unreliable for workers on different nodes; use a node-local path instead", stacklevel=3)
+
+
+@contextlib.contextmanager
+def file_lock(path: str, timeout: float = 600, stale: float = 300):
+    """
+    Exclusive lock between processes on any node sharing a folder: the lock is the directory `path`,
+    created atomically with mkdir (also on network filesystems, unlike the POSIX locks SQLite relies on).
+    A lock older than `stale` seconds, left by a crashed process, is broken. Ages are measured with
+    the clock of the filesystem.
+    """
+    start = time.time()
+    while True:
         try:
-            with open(filename, 'r') as f:
-                # split on commas, filter out any empty strings, and convert to int.
-                return set(int(num) for num in f.read().strip().split(',') if num)
+            os.mkdir(path)
+            break
+        except FileExistsError:
+            pass
+        clock_file = f"{path}.clock.{socket.gethostname()}.{os.getpid()}"
+        try:
+            with open(clock_file, 'a'):
+                os.utime(clock_file)
+            age = os.stat(clock_file).st_mtime - os.stat(path).st_mtime
         except FileNotFoundError:
-            return set()
+            continue  # released in the meantime
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(clock_file)
+        if age > stale:
+            # only one process wins the rename of a stale lock
+            broken = f"{path}.stale.{socket.gethostname()}.{os.getpid()}"
+            with contextlib.suppress(OSError):
+                os.rename(path, broken)
+                os.rmdir(broken)
+            continue
+        if time.time() - start > timeout:
+            raise TimeoutError(f"Could not acquire the lock {path} in {timeout} s")
+        time.sleep(random.uniform(0.01, 0.1))
+    try:
+        yield
+    finally:
+        os.rmdir(path)
 
-    def _append_number(number: int, filename: str = "used_seeds.csv") -> None:
-        if os.path.exists(filename) and os.path.getsize(filename) > 0:
-            with open(filename, 'a') as f:
-                f.write(f",{number}")
-        else:
-            with open(filename, 'w') as f:
-                f.write(f"{number}")
 
-    # total candidates available
-    possible_space = max_val - min_val + 1
-    attempts = 0
+@contextlib.contextmanager
+def connect_database(filename: str, timeout: float = 60, shared: bool = False):
+    """
+    Opens an SQLite database in autocommit mode (transactions are opened explicitly). A `shared` database
+    can be on a network filesystem and used from several nodes: every connection holds the `file_lock`
+    FILENAME.lockdir and SQLite uses dot-file locking (FILENAME.lock). The connection is opened after the
+    lock is taken and closed before it is released, so every node sees the changes of the previous one.
+    """
+    if not shared:
+        with contextlib.closing(sqlite3.connect(filename, timeout=timeout, isolation_level=None)) as db:
+            yield db
+        return
+    with file_lock(filename + ".lockdir", timeout=timeout):
+        # nobody else can hold the SQLite lock now, a leftover one belongs to a crashed process
+        if os.path.isdir(filename + ".lock"):
+            os.rmdir(filename + ".lock")
+        uri = Path(os.path.abspath(filename)).as_uri() + "?vfs=unix-dotfile"
+        with contextlib.closing(sqlite3.connect(uri, uri=True, timeout=timeout, isolation_level=None)) as db:
+            yield db
 
-    # Try out unique seed candidates until a unique one is found or possibilities are exhausted.
-    while attempts < possible_space:
-        used_numbers = _load_used_numbers()  # re-read used seeds on every attempt
-        new_seed = random.randint(min_val, max_val)
-        if new_seed not in used_numbers:
-            _append_number(new_seed)
-            return new_seed
-        attempts += 1
 
-    # If we have tried all possible seeds, then raise an error.
-    raise ValueError("All possible numbers have been used!")
+class SeedRegistry:
+    """
+    Registry of the seeds used by the simulations, stored in an SQLite database so that
+    parallel workers can allocate seeds without duplicates. Membership checks use the
+    primary key index, allocations run in a single write transaction, and every seed keeps
+    the results folder and parameters it was used for. Seeds from a legacy `used_seeds.csv`
+    are imported the first time the database is created. A `shared` registry can be used by workers
+    on several nodes (see `connect_database`), otherwise it has to be on a node-local path (see
+    `check_database_path`). Workers can take their seeds from blocks reserved at once (see `take`).
+    """
+
+    def __init__(self, filename: str = "used_seeds.db", legacy_file: str = "used_seeds.csv", timeout: float = 60,
+                 shared: bool = False):
+        if not shared:
+            check_database_path(filename)
+        self.filename = filename
+        self.timeout = timeout
+        self.shared = shared
+        self.block = []  # seeds reserved by this process and not used yet
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            exists = db.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'seeds'").fetchone()
+            if exists is None:
+                db.execute("CREATE TABLE seeds (seed INTEGER PRIMARY KEY, results_folder TEXT, "
+                           "parameters TEXT, worker TEXT, created TEXT)")
+                if legacy_file is not None and os.path.exists(legacy_file):
+                    with open(legacy_file, 'r') as f:
+                        legacy = set(int(num) for num in f.read().strip().split(',') if num)
+                    db.executemany("INSERT OR IGNORE INTO seeds (seed) VALUES (?)",
+                                   [(num,) for num in legacy])
+            db.execute("COMMIT")
+
+    def _connect(self) -> sqlite3.Connection:
+        return connect_database(self.filename, self.timeout, self.shared)
+
+    def __contains__(self, seed: int) -> bool:
+        with self._connect() as db:
+            return db.execute("SELECT 1 FROM seeds WHERE seed = ?", (int(seed),)).fetchone() is not None
+
+    def __len__(self) -> int:
+        with self._connect() as db:
+            return db.execute("SELECT COUNT(*) FROM seeds").fetchone()[0]
+
+    def allocate(self, min_val: int = 1, max_val: int = 10 ** 9, results_folder: str = None,
+                 parameters: dict = None) -> int:
+        """
+        Atomically allocates a new unused seed in [min_val, max_val]
+        """
+        return self.reserve(1, min_val, max_val, results_folder, parameters)[0]
+
+    def reserve(self, count: int, min_val: int = 1, max_val: int = 10 ** 9, results_folder: str = None,
+                parameters: dict = None, worker: str = None) -> List[int]:
+        """
+        Atomically reserves a block of `count` new unused seeds in [min_val, max_val],
+        e.g. all the seeds of a sweep worker, and returns them
+        """
+        rng = random.SystemRandom()  # independent of the (possibly shared) global random state
+        if worker is None:
+            worker = f"{socket.gethostname()}:{os.getpid()}"
+        info = (results_folder, json.dumps(parameters, sort_keys=True, default=str) if parameters is not None else None,
+                worker, datetime.datetime.now().isoformat(timespec="seconds"))
+
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                used = db.execute("SELECT COUNT(*) FROM seeds WHERE seed BETWEEN ? AND ?",
+                                  (min_val, max_val)).fetchone()[0]
+                if max_val - min_val + 1 - used < count:
+                    raise ValueError("All possible numbers have been used!")
+
+                seeds = []
+                while len(seeds) < count:
+                    candidates = set(rng.randint(min_val, max_val) for _ in range(count - len(seeds)))
+                    for seed in candidates:
+                        if db.execute("INSERT OR IGNORE INTO seeds VALUES (?, ?, ?, ?, ?)",
+                                      (seed,) + info).rowcount == 1:
+                            seeds.append(seed)
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        return seeds
+
+    def take(self, results_folder: str = None, parameters: dict = None, block: int = 16, min_val: int = 1,
+             max_val: int = 10 ** 9) -> int:
+        """
+        Returns a seed of the block reserved by this process and registers the results folder and parameters
+        it is used for, a new block of `block` seeds is reserved when it runs out. Seeds left in the block when
+        the process ends stay reserved (with the name of the worker).
+        """
+        if len(self.block) == 0:
+            self.block = self.reserve(block, min_val, max_val)
+        seed = self.block.pop(0)
+        self.register(seed, results_folder, parameters)
+        return seed
+
+    def register(self, seed: int, results_folder: str = None, parameters: dict = None) -> None:
+        """
+        Registers a seed chosen by the user, or updates the folder and parameters of a reserved seed
+        """
+        with self._connect() as db:
+            db.execute("INSERT OR IGNORE INTO seeds (seed) VALUES (?)", (int(seed),))
+            if results_folder is not None:
+                db.execute("UPDATE seeds SET results_folder = ? WHERE seed = ?", (results_folder, int(seed)))
+            if parameters is not None:
+                db.execute("UPDATE seeds SET parameters = ? WHERE seed = ?",
+                           (json.dumps(parameters, sort_keys=True, default=str), int(seed)))
+
+    def info(self, seed: int) -> Optional[dict]:
+        """
+        Returns the results folder, parameters, worker and creation time of a seed, None if it is not used
+        """
+        with self._connect() as db:
+            row = db.execute("SELECT results_folder, parameters, worker, created FROM seeds WHERE seed = ?",
+                             (int(seed),)).fetchone()
+        if row is None:
+            return None
+        return {"results_folder": row[0],
+                "parameters": json.loads(row[1]) if row[1] is not None else None,
+                "worker": row[2],
+                "created": row[3]}
+
+
+def random_number_generator(min_val: int = 1, max_digits: int = None, results_folder: str = None,
+                            parameters: dict = None, registry: SeedRegistry = None) -> int:
+    """
+    Returns a new seed that has never been used, registering it (and the results folder and
+    parameters it is used for) in the seed registry
+    """
+    # If no max_digits is provided, choose one randomly between 1 and 9.
+    if max_digits is None:
+        max_digits = random.randint(1, 9)
+    max_val = int('1' + '0' * max_digits)  # e.g., max_digits=3 gives max_val=1000
+
+    if registry is None:
+        registry = SeedRegistry()
+    return registry.allocate(min_val, max_val, results_folder, parameters)
 
 
 def extract_phantom_value(filename):
@@ -61,18 +272,217 @@ def extract_phantom_value(filename):
 
     return cc, ml, pa
 
-def read_raw_file(file_path, width=3584, height=2816, dtype=np.float32):
+
+class ResultsCatalog:
     """
-    Read a raw file and return it as a 2D numpy array
+    Catalog of the simulation outputs, stored in an SQLite database so that the stack building,
+    analysis and plotting tools can find the results by phantom size, Z offset or stage instead
+    of walking the results folders and parsing file names. Every output keeps the seed, stage,
+    phantom and projection parameters it was produced with, its size and its checksum.
+    A `shared` catalog can be written by workers on several nodes (see `connect_database`),
+    otherwise it has to be on a node-local path (see `check_database_path`).
     """
-    try:
+
+    COLUMNS = ["path", "seed", "stage", "results_folder", "phantom_file", "pa", "ml", "cc", "z",
+               "spectrum", "number_histories", "size", "checksum", "parameters", "created"]
+
+    def __init__(self, filename: str = "results_catalog.db", timeout: float = 60, shared: bool = False):
+        if not shared:
+            check_database_path(filename)
+        self.filename = filename
+        self.timeout = timeout
+        self.shared = shared
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS outputs (path TEXT PRIMARY KEY, seed INTEGER, stage TEXT, "
+                       "results_folder TEXT, phantom_file TEXT, pa REAL, ml REAL, cc REAL, z REAL, spectrum TEXT, "
+                       "number_histories INTEGER, size INTEGER, checksum TEXT, parameters TEXT, created TEXT)")
+            db.execute("CREATE INDEX IF NOT EXISTS outputs_size ON outputs (ml, cc, z)")
+            db.execute("CREATE INDEX IF NOT EXISTS outputs_seed ON outputs (seed)")
+            db.execute("CREATE INDEX IF NOT EXISTS outputs_stage ON outputs (stage)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return connect_database(self.filename, self.timeout, self.shared)
+
+    def __len__(self) -> int:
+        with self._connect() as db:
+            return db.execute("SELECT COUNT(*) FROM outputs").fetchone()[0]
+
+    @staticmethod
+    def checksum(file_path: str, chunk_size: int = 2 ** 24) -> str:
+        """
+        Returns the SHA-1 checksum of a file, read in chunks
+        """
+        digest = hashlib.sha1()
         with open(file_path, 'rb') as f:
-            if hasattr(np, '__name__') and np.__name__ == 'cupy':
-                import numpy as cpu_np
-                data = np.asarray(cpu_np.fromfile(f, dtype=dtype))
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def add(self, paths: List[str], seed: int = None, stage: str = None, results_folder: str = None,
+            phantom_file: str = None, z: float = None, spectrum: str = None, number_histories: int = None,
+            parameters: dict = None, checksums: bool = True) -> None:
+        """
+        Adds (or updates) the given output files, the PA, ML and CC sizes are read from the phantom file name
+        """
+        pa = ml = cc = None
+        if phantom_file is not None:
+            cc, ml, pa = [value if value > 0 else None for value in extract_phantom_value(os.path.basename(phantom_file))]
+        created = datetime.datetime.now().isoformat(timespec="seconds")
+        rows = []
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            rows.append((os.path.abspath(path), seed, stage, results_folder, phantom_file, pa, ml, cc, z,
+                         spectrum, number_histories, os.path.getsize(path),
+                         self.checksum(path) if checksums else None,
+                         json.dumps(parameters, sort_keys=True, default=str) if parameters is not None else None,
+                         created))
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            db.executemany(f"INSERT OR REPLACE INTO outputs VALUES ({', '.join('?' * len(self.COLUMNS))})", rows)
+            db.execute("COMMIT")
+
+    def query(self, stage: str = None, folder: str = None, pattern: str = None, **filters) -> List[dict]:
+        """
+        Returns the outputs of a stage, inside a folder and/or whose file name matches a glob pattern,
+        filtered by any other column (e.g. ml=20, cc=3), sorted by ML, CC and Z
+        """
+        conditions, values = [], []
+        if stage is not None:
+            conditions.append("stage = ?")
+            values.append(stage)
+        if folder is not None:
+            conditions.append("path GLOB ?")
+            values.append(os.path.join(glob.escape(os.path.abspath(folder)), '*'))
+        if pattern is not None:
+            conditions.append("path GLOB ?")
+            values.append(os.path.join('*', pattern))
+        for column, value in filters.items():
+            if column not in self.COLUMNS:
+                raise ValueError(f"Unknown catalog column: {column}")
+            conditions.append(f"{column} = ?")
+            values.append(value)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._connect() as db:
+            rows = db.execute(f"SELECT {', '.join(self.COLUMNS)} FROM outputs{where} ORDER BY ml, cc, z, path",
+                              values).fetchall()
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+    def remove_missing(self) -> int:
+        """
+        Removes the outputs whose files no longer exist and returns how many were removed
+        """
+        with self._connect() as db:
+            missing = [(path,) for (path,) in db.execute("SELECT path FROM outputs") if not os.path.exists(path)]
+            db.executemany("DELETE FROM outputs WHERE path = ?", missing)
+        return len(missing)
+
+
+# MetaImage element types
+MHD_DTYPES = {"MET_UCHAR": np.uint8,
+              "MET_CHAR": np.int8,
+              "MET_USHORT": np.uint16,
+              "MET_SHORT": np.int16,
+              "MET_UINT": np.uint32,
+              "MET_INT": np.int32,
+              "MET_FLOAT": np.float32,
+              "MET_DOUBLE": np.float64}
+
+
+def read_mhd(filename: str) -> dict:
+    """
+    Reads and parses an MHD header, numeric values are converted to int or float
+    """
+    def _parse(value):
+        if value.replace(".", "").replace("-", "").isnumeric():
+            return float(value) if "." in value else int(value)
+        return value
+
+    data = {}
+    with open(filename, "r") as f:
+        for line in f:
+            s = re.search("([a-zA-Z]*) = (.*)", line)
+            if s is None:
+                continue
+            data[s[1]] = s[2]
+            if " " in data[s[1]]:
+                data[s[1]] = [_parse(value) for value in data[s[1]].split(' ')]
             else:
-                data = np.fromfile(f, dtype=dtype)
-        return data.reshape((height, width))
-    except Exception as e:
-        print(f"Error reading file {file_path}: {e}")
-        return None
+                data[s[1]] = _parse(data[s[1]])
+    return data
+
+
+def _header_file(file_path: str) -> str:
+    # image.raw, image.raw.gz or image -> image.mhd
+    base = str(file_path)
+    for extension in [".gz", ".raw"]:
+        if base.endswith(extension):
+            base = base[:-len(extension)]
+    return base + ".mhd"
+
+
+def raw_info(file_path: str, shape: tuple = None, dtype=None, spacing: tuple = None, header: str = None) -> dict:
+    """
+    Returns the shape (slowest dimension first), dtype and spacing (in mm, same order as the
+    shape) of a raw image. Values not given explicitly are taken from the .mhd header next to
+    the file, or from `header`. If the file holds several images of the header size (e.g. the
+    two DM images), a first dimension with the number of images is added.
+    """
+    if header is None:
+        header = _header_file(file_path)
+    mhd = read_mhd(header) if os.path.exists(header) else {}
+
+    if shape is None:
+        if "DimSize" not in mhd:
+            raise ValueError(f"No shape given and no header found for {file_path}")
+        shape = tuple(int(x) for x in np.atleast_1d(mhd["DimSize"])[::-1])
+    if dtype is None:
+        dtype = MHD_DTYPES[mhd["ElementType"]] if "ElementType" in mhd else np.float32
+    if spacing is None and "ElementSpacing" in mhd:
+        spacing = tuple(float(x) for x in np.atleast_1d(mhd["ElementSpacing"])[::-1])
+
+    shape = tuple(int(x) for x in shape)
+    image_size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    n_images = os.path.getsize(file_path) // image_size
+    if n_images > 1 and n_images * image_size == os.path.getsize(file_path):
+        shape = (n_images,) + shape
+        spacing = (None,) + tuple(spacing) if spacing is not None else None
+
+    return {"shape": shape, "dtype": np.dtype(dtype), "spacing": spacing}
+
+
+def to_backend(array, backend: str = None):
+    """
+    Transfers an array to the given backend: None keeps it as is, "numpy" loads it in
+    memory and "cupy" copies it to the GPU
+    """
+    if backend is None:
+        return array
+    if backend == "numpy":
+        return np.array(array)
+    if backend == "cupy":
+        import cupy
+        return cupy.asarray(array)
+    raise ValueError(f"Unknown array backend: {backend}")
+
+
+def read_raw(file_path: str, shape: tuple = None, dtype=None, header: str = None, backend: str = None,
+             mode: str = "r"):
+    """
+    Opens a raw image as a lazy memory map, shape and dtype are taken from the adjacent .mhd
+    header unless given explicitly (see `raw_info`). Slices are only read when accessed,
+    e.g. `read_raw(file)[z]`. Use `backend` to load the whole image in memory or on the GPU.
+    """
+    info = raw_info(file_path, shape, dtype, header=header)
+    data = np.memmap(file_path, dtype=info["dtype"], mode=mode, shape=info["shape"])
+    return to_backend(data, backend)
+
+
+def read_raw_file(file_path, width=None, height=None, dtype=None, backend=None):
+    """
+    Read a raw file and return it as a 2D array, the size and dtype are taken from the
+    adjacent .mhd header unless width and height are given. Errors (missing file or header,
+    size mismatch) are raised to the caller
+    """
+    shape = (height, width) if width is not None and height is not None else None
+    return read_raw(file_path, shape, dtype, backend=backend)
@@ -0,0 +1,323 @@
+import os
+import json
+import time
+import socket
+import contextlib
+import hashlib
+import datetime
+import threading
+import traceback
+from termcolor import cprint
+from . import Exceptions
+
+QUEUE_STATES = ["pending", "running", "done", "failed"]
+
+
+def run_pipeline_job(payload):
+    """
+        Default job handler, creates a Pipeline and runs its stages
+
+        :param payload: Dictionary with the `pipeline` constructor arguments and the `stages` to run,
+            a list of [method, {arguments}] pairs (e.g. [["project", {}], ["save_DICOM", {"modality": "dbt"}]])
+        :returns: Dictionary with the seed and results folder of the pipeline
+    """
+    from .Pipeline import Pipeline
+    pline = Pipeline(**payload["pipeline"])
+    for method, arguments in payload.get("stages", []):
+        getattr(pline, method)(**arguments)
+    return {"seed": pline.seed, "results_folder": pline.results_folder}
+
+
+class WorkQueue:
+    """
+        Object constructor for a serverless work queue on a (shared) filesystem. Every job is a JSON file
+        that moves between the `pending`, `running`, `done` and `failed` folders of the queue by atomic
+        renames, so only one worker can claim it even if the workers run on different nodes. A running job
+        is named after its worker (`running/KEY@WORKER.json`), so a worker can only finish the job it claimed.
+        While a job runs, its worker keeps touching the job file (heartbeat); jobs whose lease expires, e.g.
+        because their node crashed or stalled, are put back in `pending` by any other worker, and the late
+        worker can no longer finish them. Ages are measured with the clock of the filesystem, not the one of the node.
+
+        :param folder: Folder of the queue, usually inside the shared results folder
+        :param lease: Seconds without heartbeat after which a running job is reclaimed
+        :param heartbeat: Seconds between heartbeats, defaults to a third of the lease
+        :param max_attempts: Number of times a job is claimed before it is considered failed
+        :param worker: Name of this worker, defaults to host name and process id
+        :param verbosity: True will output the progress of the worker
+        :returns: None
+    """
+
+    def __init__(self,
+                 folder,
+                 lease=300,
+                 heartbeat=None,
+                 max_attempts=3,
+                 worker=None,
+                 verbosity=True):
+        self.folder = folder
+        self.lease = lease
+        self.heartbeat = heartbeat if heartbeat is not None else lease / 3
+        self.max_attempts = max_attempts
+        self.worker = worker if worker is not None else "{:s}.{:d}".format(
+            socket.gethostname(), os.getpid())
+        self.verbosity = verbosity
+        # set while a job runs if its lease is lost, handlers can check it before publishing results
+        self.lease_lost = threading.Event()
+
+        for state in QUEUE_STATES:
+            os.makedirs("{:s}/{:s}".format(folder, state), exist_ok=True)
+
+    def _file(self, state, key):
+        return "{:s}/{:s}/{:s}.json".format(self.folder, state, key)
+
+    def _running_file(self, key, worker=None):
+        # the owner is part of the name, the rename of another worker's job fails
+        return "{:s}/running/{:s}@{:s}.json".format(self.folder, key, worker if worker is not None else self.worker)
+
+    @ staticmethod
+    def _running_key(filename):
+        # KEY@WORKER.json -> (KEY, WORKER), worker names do not contain @
+        key, _, worker = filename[:-5].rpartition("@")
+        return key, worker
+
+    def _write(self, filename, content):
+        # written next to the destination and renamed, readers never see partial files
+        temp_file = "{:s}.{:s}.tmp".format(filename, self.worker)
+        with open(temp_file, "w") as f:
+            json.dump(content, f, indent=4)
+        os.replace(temp_file, filename)
+
+    def _read(self, filename):
+        with open(filename, "r") as f:
+            return json.load(f)
+
+    def _now(self):
+        # filesystem clock, the nodes sharing the folder may not be synchronized
+        clock_file = "{:s}/.clock.{:s}".format(self.folder, self.worker)
+        with open(clock_file, "a"):
+            os.utime(clock_file)
+        return os.stat(clock_file).st_mtime
+
+    def _log(self, message, color="cyan"):
+        cprint("[" + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] [{:s}] {:s}".format(
+            self.worker, message), color) if self.verbosity else None
+
+    def state(self, key):
+        """
+            Returns the state of a job ("pending", "running", "done" or "failed"), or None if it is not in the queue
+        """
+        for state in QUEUE_STATES:
+            if os.path.exists(self._file(state, key)):
+                return state
+        if any(self._running_key(f)[0] == key for f in os.listdir("{:s}/running".format(self.folder))
+               if f.endswith(".json")):
+            return "running"
+        return None
+
+    def put(self, payload, key=None):
+        """
+            Adds a job to the queue, jobs already in the queue (in any state) are not added again
+
+            :param payload: JSON-serializable dictionary passed to the job handler
+            :param key: Key of the job, defaults to a hash of the payload
+            :returns: Key of the job
+        """
+        if key is None:
+            key = hashlib.sha1(json.dumps(
+                payload, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        if self.state(key) is None:
+            self._write(self._file("pending", key),
+                        {"key": key, "payload": payload, "attempts": 0})
+            # new work, the queue has to be finalized again once it is drained
+            with contextlib.suppress(FileNotFoundError):
+                os.rmdir("{:s}/finalized".format(self.folder))
+        return key
+
+    def status(self):
+        """
+            Returns the number of jobs in each state
+        """
+        return {state: len([f for f in os.listdir("{:s}/{:s}".format(self.folder, state))
+                            if f.endswith(".json")])
+                for state in QUEUE_STATES}
+
+    def reclaim(self):
+        """
+            Puts back in the queue the running jobs whose lease has expired, or moves them to `failed`
+            if they have been claimed `max_attempts` times
+
+            :returns: Number of reclaimed jobs
+        """
+        now = self._now()
+        reclaimed = 0
+        for filename in os.listdir("{:s}/running".format(self.folder)):
+            if not filename.endswith(".json"):
+                continue
+            key, worker = self._running_key(filename)
+            running_file = self._running_file(key, worker)
+            try:
+                if now - os.stat(running_file).st_mtime < self.lease:
+                    continue
+                # only one worker can win the rename of an expired job
+                claimed_file = "{:s}.reclaimed.{:s}".format(
+                    running_file, self.worker)
+                os.rename(running_file, claimed_file)
+            except FileNotFoundError:
+                continue
+
+            job = self._read(claimed_file)
+            if job["attempts"] >= self.max_attempts:
+                job["error"] = "Lease expired after {:d} attempts".format(
+                    job["attempts"])
+                self._write(self._file("failed", key), job)
+            else:
+                self._write(self._file("pending", key), job)
+            os.remove(claimed_file)
+            reclaimed += 1
+            self._log("Reclaimed expired job {:s} (worker {:s})".format(
+                key, job.get("worker", "unknown")), "yellow")
+        return reclaimed
+
+    def claim(self):
+        """
+            Claims the next pending job, expired jobs are reclaimed first
+
+            :returns: Job dictionary (with its `key` and `payload`), or None if there are no pending jobs
+        """
+        self.reclaim()
+        for filename in sorted(os.listdir("{:s}/pending".format(self.folder))):
+            if not filename.endswith(".json"):
+                continue
+            key = filename[:-5]
+            try:
+                # the rename keeps the modification time, the lease starts with the touch
+                os.utime(self._file("pending", key))
+                os.rename(self._file("pending", key),
+                          self._running_file(key))
+            except FileNotFoundError:
+                continue  # claimed by another worker
+
+            job = self._read(self._running_file(key))
+            job["attempts"] += 1
+            job["worker"] = self.worker
+            self._write(self._running_file(key), job)
+            return job
+        return None
+
+    def touch(self, key):
+        """
+            Renews the lease of a running job
+
+            :raises VictreError: if the job is no longer running (it was reclaimed by another worker)
+        """
+        try:
+            os.utime(self._running_file(key))
+        except FileNotFoundError:
+            raise Exceptions.VictreError("Lease of job {:s} lost".format(key))
+
+    def _finish(self, key, state, **fields):
+        # only the running file named after this worker can be moved, once the lease expires
+        # the file is renamed by the worker that reclaims it and this rename fails
+        try:
+            os.rename(self._running_file(key), self._file(state, key))
+        except FileNotFoundError:
+            self._log("Lease of job {:s} lost, result discarded".format(key), "red")
+            return False
+        job = self._read(self._file(state, key))
+        job.update(fields)
+        job["finished"] = datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+        self._write(self._file(state, key), job)
+        return True
+
+    def complete(self, key, result=None):
+        """
+            Moves a running job to `done`
+
+            :param key: Key of the job
+            :param result: JSON-serializable result of the job
+            :returns: False if the lease was lost before finishing
+        """
+        return self._finish(key, "done", result=result)
+
+    def fail(self, key, error):
+        """
+            Moves a running job to `failed`
+
+            :param key: Key of the job
+            :param error: Error message
+            :returns: False if the lease was lost before finishing
+        """
+        return self._finish(key, "failed", error=error)
+
+    def _heartbeat(self, key, stop):
+        while not stop.wait(self.heartbeat):
+            try:
+                self.touch(key)
+            except Exceptions.VictreError:
+                self.lease_lost.set()
+                self._log("Lease of job {:s} lost while running, its result will be discarded".format(key), "red")
+                return
+
+    def finalize(self):
+        """
+            Claims the finalization of the queue (e.g. sorting the results of all the jobs). It is only
+            granted once, to a single worker, when there are no pending or running jobs left, and again
+            after new jobs are added.
+
+            :returns: True if this worker has to finalize the queue
+        """
+        status = self.status()
+        if status["pending"] > 0 or status["running"] > 0:
+            return False
+        try:
+            # mkdir is atomic, also on network filesystems, only one worker creates the folder
+            os.mkdir("{:s}/finalized".format(self.folder))
+        except FileExistsError:
+            return False
+        return True
+
+    def work(self, handler=run_pipeline_job, max_jobs=None):
+        """
+            Claims and runs jobs until there are no pending jobs left. While other workers still run jobs,
+            it keeps polling every heartbeat to reclaim and run those whose lease expires. If the lease of
+            the running job is lost, `lease_lost` is set so the handler can stop before publishing its results.
+
+            :param handler: Function that runs a job, it receives the payload and returns a JSON-serializable result
+            :param max_jobs: Maximum number of jobs to run, defaults to no limit
+            :returns: Dictionary with the number of jobs done and failed by this worker
+        """
+        counts = {"done": 0, "failed": 0}
+        while max_jobs is None or counts["done"] + counts["failed"] < max_jobs:
+            job = self.claim()
+            if job is None:
+                if self.status()["running"] == 0:
+                    break
+                time.sleep(self.heartbeat)
+                continue
+
+            self._log("Running job {:s} (attempt {:d})...".format(
+                job["key"], job["attempts"]))
+            self.lease_lost.clear()
+            stop = threading.Event()
+            heartbeat = threading.Thread(target=self._heartbeat,
+                                         args=(job["key"], stop),
+                                         daemon=True)
+            heartbeat.start()
+            try:
+                result = handler(job["payload"])
+            except Exception:
+                stop.set()
+                heartbeat.join()
+                if self.fail(job["key"], traceback.format_exc()):
+                    counts["failed"] += 1
+                    self._log("Job {:s} failed".format(job["key"]), "red")
+                continue
+            stop.set()
+            heartbeat.join()
+            if self.complete(job["key"], result):
+                counts["done"] += 1
+                self._log("Job {:s} done".format(job["key"]), "green")
+
+        self._log("No jobs left ({:d} done, {:d} failed)".format(
+            counts["done"], counts["failed"]), "green")
+        return counts
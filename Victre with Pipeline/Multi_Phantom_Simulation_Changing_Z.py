@@ -1,14 +1,18 @@
 import glob
 import os
 import re
+import argparse
 from Victre import Pipeline
 from Victre import Constants
 from Victre.Constants import PHANTOM_MATERIALS
 from Victre import Lesions
-from Victre.Victre_Tools import read_raw_file, extract_phantom_value, random_number_generator
+from Victre.Victre_Tools import SeedRegistry, ResultsCatalog
+from Victre.SweepPlanner import SweepPlanner
+from Victre.WorkQueue import WorkQueue
+from Victre.SPRatio import SPRatioHook
 import subprocess
 
-def run_stack_sort():
+def run_stack_sort(catalog=None):
     # Define the parameters
     input_root = "./results/Lucite/Mag_W_Lesions/Main"  # Adjust this path to match your results directory
     output_root = "./results/Lucite/Mag_W_Lesions/Stacks"  # Where you want the stacked images to be saved
@@ -21,7 +25,7 @@ def run_stack_sort():
     # Construct the command
     cmd = [
         "python",
-        "./Tools/StackSort2.py",
+        "./Tools/StackSort.py",
         input_root,
         output_root,
         "--width", str(width),
@@ -29,181 +33,270 @@ def run_stack_sort():
         "--dtype", dtype,
         "--patterns", pattern
     ]
+    if catalog is not None:
+        cmd += ["--catalog", catalog]
 
     try:
         print("Starting stack sorting...")
         result = subprocess.run(cmd, check=True)
         print("Stack sorting completed successfully")
     except subprocess.CalledProcessError as e:
-        print(f"Error running StackSort2.py: {e}")
+        print(f"Error running StackSort.py: {e}")
     except Exception as e:
         print(f"Unexpected error: {e}")
 
+
+# Material sets that can be selected with the "materials" axis of the sweep specification
+MATERIAL_SETS = {
+    "lucite": [
+        {"material": "./Victre/projection/material/Air_dry_near_s__5-120keV.mcgpu.gz",
+         "density": 0.0012,
+         "voxel_id": [PHANTOM_MATERIALS["air"]]
+         },
+        {"material": "./Victre/projection/material/adipose__5-120keV.mcgpu.gz",
+         "density": 0.92,
+         "voxel_id": [PHANTOM_MATERIALS["adipose"]]
+         },
+        {"material": "./Victre/projection/material/Polymethyl_met__5-120keV.mcgpu.gz",
+         "density": 1.190,
+         "voxel_id": [PHANTOM_MATERIALS["Lucite"]]
+         },
+        {"material": "./Victre/projection/material/Polymethyl_met__5-120keV.mcgpu.gz",
+         "density": 1.1543,
+         "voxel_id": [PHANTOM_MATERIALS["Lucite_lower_density"]]
+         },
+        {"material": "./Victre/projection/material/Polymethyl_met__5-120keV.mcgpu.gz",
+         "density": 1.190,
+         "voxel_id": [PHANTOM_MATERIALS["Lucite"]]
+         },
+        {"material": "./Victre/projection/material/Polymethyl_met__5-120keV.mcgpu.gz",
+         "density": 1.190,
+         "voxel_id": [PHANTOM_MATERIALS["Lucite"]]
+         },
+        {"material": "./Victre/projection/material/Polymethyl_met__5-120keV.mcgpu.gz",
+         "density": 1.190,
+         "voxel_id": [PHANTOM_MATERIALS["Lucite"]]
+         },
+        {"material": "./Victre/projection/material/Polymethyl_met__5-120keV.mcgpu.gz",
+         "density": 1.190,
+         "voxel_id": [PHANTOM_MATERIALS["Lucite"]]
+         },
+        {"material": "./Victre/projection/material/Polymethyl_met__5-120keV.mcgpu.gz",
+         "density": 1.190,
+         "voxel_id": [PHANTOM_MATERIALS["Lucite"]]
+         },
+        {"material": "./Victre/projection/material/Polymethyl_met__5-120keV.mcgpu.gz",
+         "density": (0.95 * 1.190),
+         "voxel_id": [PHANTOM_MATERIALS["Lucite_lower_density"]]
+         }
+    ]
+}
+
+
+# Configuration keys of a sweep job that are not MC-GPU arguments (the phantom and the axes handled by run_job)
+JOB_KEYS = ["phantom_file", "ML_group", "cc", "ml", "pa", "z", "materials"]
+# MC-GPU arguments computed from the phantom and z, they cannot be swept
+DERIVED_ARGUMENTS = ["voxel_geometry_offset", "number_voxels", "output_file"]
+
+
+def mcgpu_arguments(config, output_file):
+    """
+    Builds the MC-GPU arguments of a sweep job, axis values other than z and materials
+    override the MC-GPU argument with the same name (e.g. spectrum_file). Any other axis
+    raises a ValueError instead of being ignored.
+    """
+    cc, ml, pa, z = config["cc"], config["ml"], config["pa"], config["z"]
+
+    n_voxels_pa = int(pa / 0.05)
+    n_voxels_ml = int(ml / 0.05)
+    n_voxels_cc = int(cc / 0.05)
+
+    arguments = {
+        "number_histories": int((5.51e10) * (2.718281828459045 ** (0.4758 * (cc - 2)))),
+        "selected_gpu": 0,
+        "number_gpus": 1,
+        "gpu_threads": 128,
+        "histories_per_thread": 20433,
+        "source_position": [0.00001, ml / 2, 73.80141],
+        "source_direction": [0.0, 0.0, -1.0],
+        "fam_beam_aperture": [-15.0, 11.203],
+        "euler_angles": [90.0, -90.0, 180.0],
+        "focal_spot": 0.0300,
+        "angular_blur": 0.18,
+        "collimate_beam": "YES",
+        "output_file": output_file,
+        "image_pixels": [3584, 2816],
+        "image_size": [30.464, 23.936],
+        "distance_source": 76.24441,
+        "image_offset": [0, 0],
+        "detector_thickness": 0.02,
+        "mean_free_path": 0.004027,
+        "k_edge_energy": [12658.0, 11223.0, 0.596, 0.00593],
+        "detector_gain": [50.0, 0.99],
+        "additive_noise": 5200.0,
+        "cover_thickness": [0.10, 1.9616],
+        "antiscatter_grid_ratio": [0, 0, 0],
+        "antiscatter_strips": [0.00089945, 1.9616],
+        "antiscatter_grid_lines": 0,
+        "number_projections": 2,
+        "rotation_axis_distance": 73.80141,
+        "projections_angle": 5.0,
+        "angular_rotation_first": -5.0,
+        "rotation_axis": [1.0, 0.0, 0.0],
+        "axis_translation": 0,
+        "detector_fixed": "YES",
+        "simulate_both": "NO",
+        "tally_material_dose": "YES",
+        "tally_voxel_dose": "NO",
+        "output_dose_filename": "mc-gpu_dose.dat",
+        "voxel_geometry_offset": [0, 0, z],
+        "number_voxels": [n_voxels_pa, n_voxels_ml, n_voxels_cc],
+        "voxel_size": [0.05, 0.05, 0.05],
+        "low_resolution_voxel_size": [0, 0, 0]
+    }
+    if "spectrum_file" in config:
+        arguments["spectrum_file"] = config["spectrum_file"]
+
+    unknown = [key for key in config
+               if key not in JOB_KEYS and (key not in arguments or key in DERIVED_ARGUMENTS)]
+    if len(unknown) > 0:
+        raise ValueError(f"Unsupported sweep axes: {', '.join(sorted(unknown))} "
+                         f"(available: z, materials, spectrum_file or any MC-GPU argument except {', '.join(DERIVED_ARGUMENTS)})")
+
+    for key, value in config.items():
+        if key in arguments:
+            arguments[key] = value
+    return arguments
+
+
+def run_job(planner, job, material_sets, seeds, catalog=None, lease_lost=None):
+    """
+    Runs the projection, reconstruction and DICOM export of a sweep job and records it as done.
+    The seed is taken from the block of the worker in the seed registry `seeds`, the outputs are
+    registered in `catalog` (defaults to the catalog of the results folder). With a work queue,
+    lease_lost is the event set when the job was reclaimed by another worker, the job is then not
+    recorded as done.
+    """
+    config = job["config"]
+    filename = os.path.basename(config["phantom_file"])
+    results_dir = job["results_folder"]
+    new_seed = seeds.take(results_folder=results_dir, parameters=config)
+
+    print(f"Processing phantom: {filename} as ML[{config['ML_group']}] x CC[{config['cc']}] at Z = {config['z']}")
+
+    os.makedirs(f"{results_dir}/{new_seed}", exist_ok=True)
+
+    output_file = filename.replace(".raw.gz", f"_Z[{config['z']}]")
+    output_file = f"{results_dir}/{new_seed}/{output_file}"
+
+    # material sets of the specification can name the voxel ids as in PHANTOM_MATERIALS
+    materials = [dict(material, voxel_id=[PHANTOM_MATERIALS[m] if isinstance(m, str) else m
+                                          for m in material["voxel_id"]])
+                 for material in material_sets[config.get("materials", "lucite")]]
+
+    # S/P ratio of every 2-slice output as soon as it is projected, without building the stacks
+    sp_ratios = planner.spec.get("sp_ratios")
+    projection_hooks = [SPRatioHook(sp_ratios if isinstance(sp_ratios, str) else None, shared=True)] if sp_ratios else None
+
+    pline = Pipeline(
+        seed=new_seed,
+        results_folder=results_dir,
+        phantom_file=config["phantom_file"],
+        lesion_file=None,
+        arguments_mcgpu=mcgpu_arguments(config, output_file),
+        materials=materials,
+        catalog=catalog if catalog is not None else ResultsCatalog(f"{results_dir}/results_catalog.db", shared=True),
+        projection_hooks=projection_hooks
+    )
+
+    print("MC-GPU arguments:")
+    for param, value in pline.arguments_mcgpu.items():
+        print(f"  {param}: {value}")
+
+    pline.project()
+    pline.reconstruct()
+    pline.save_DICOM("dbt")
+    pline.save_DICOM("DM")
+
+    if lease_lost is not None and lease_lost.is_set():
+        raise RuntimeError(f"Lease of job {job['key']} lost, another worker runs it")
+    planner.mark_done(job, new_seed, [glob.escape(output_file) + "*"])
+    return {"seed": new_seed, "output_file": output_file}
+
+
 if __name__ == "__main__":
 
-    max_z = int(input("Enter the maximum Z value for the simulations: "))
-    z_interval = int(input("Enter the Z interval for the simulations: "))
-    # Get the absolute path of the current working directory
-    base_dir = os.getcwd()
+    parser = argparse.ArgumentParser(description="Runs the Z sweep declared in a sweep specification")
+    parser.add_argument("spec", nargs="?", default="./sweep_changing_z.json",
+                        help="Sweep specification (JSON or YAML)")
+    parser.add_argument("--shard", default="0/1",
+                        help="Worker index and number of workers, e.g. 2/4 (default: 0/1)")
+    parser.add_argument("--queue", default=None,
+                        help="Work queue folder shared by the workers (e.g. in the results folder), replaces --shard")
+    parser.add_argument("--enqueue", action="store_true",
+                        help="Only add the pending jobs of the sweep to the work queue")
+    parser.add_argument("--lease", type=float, default=600,
+                        help="Seconds without heartbeat after which a queued job is reclaimed (default: 600)")
+    parser.add_argument("--seeds", default=None,
+                        help="Seed registry shared by all the workers (default: the `seeds` of the specification, "
+                             "used_seeds.db in the queue folder with --queue, else in the working directory)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Only list the pending jobs of this worker")
+    parser.add_argument("--no-stack-sort", action="store_true",
+                        help="Do not run the stack sorting at the end")
+    args = parser.parse_args()
+
+    planner = SweepPlanner(args.spec)
+    material_sets = dict(MATERIAL_SETS, **planner.spec.get("material_sets", {}))
+
+    grid = planner.expand()
+    if len(grid) > 0:
+        # unsupported axes fail here rather than in every job
+        mcgpu_arguments(grid[0]["config"], "")
+
+    # workers may run on other nodes sharing the registry, its accesses are serialized with a lock file
+    seeds_file = args.seeds or planner.spec.get("seeds") or \
+        (os.path.join(args.queue, "used_seeds.db") if args.queue is not None else "used_seeds.db")
+    seeds = SeedRegistry(seeds_file, shared=True)
+    catalog = ResultsCatalog(planner.spec["catalog"], shared=True) if planner.spec.get("catalog") else None
+
+    if args.queue is not None:
+        queue = WorkQueue(args.queue, lease=args.lease)
+        if args.enqueue:
+            for job in planner.pending():
+                queue.put(job, key=job["key"])
+            print(f"Work queue status: {queue.status()}")
+            raise SystemExit(0)
+        # any number of workers, on any node sharing the queue folder, can pull jobs
+        queue.work(handler=lambda job: run_job(planner, job, material_sets, seeds, catalog, queue.lease_lost))
+        print(f"Work queue status: {queue.status()}")
+        # only the worker that drains the queue sorts the stacks, once every job has finished
+        if not args.no_stack_sort and queue.finalize():
+            run_stack_sort(planner.spec.get("catalog"))
+        raise SystemExit(0)
+
+    worker, workers = [int(v) for v in args.shard.split("/")]
+
+    # the full grid is sharded before removing the finished jobs, so every job always belongs to the same worker
+    jobs = planner.pending(planner.shard(grid, worker, workers))
+    print(f"Sweep of {len(grid)} jobs, {len(jobs)} pending for worker {worker}/{workers}")
 
-    # Check how many size phantoms we have by counting the number of directories in the phantom folder
-    ML_sizes = os.listdir("./phantoms/Lucite/Lesions")
-    print(ML_sizes)
-    for ML in ML_sizes:
-        raw_files = glob.glob(os.path.join("./phantoms/Lucite/Lesions", ML, "*.raw.gz"))
-        print(f"Found {len(raw_files)} raw files in {ML}")
+    if args.dry_run:
+        for job in jobs:
+            print(f"  {job['key']}: {job['config']}")
+        raise SystemExit(0)
 
-        if len(raw_files) == 0:
-            print("No raw files found! Check the path and file pattern.")
+    for job in jobs:
+        try:
+            run_job(planner, job, material_sets, seeds, catalog)
+        # Catch any exceptions that occur during the processing of the phantom
+        except Exception as e:
+            print(f"Error processing phantom {job['config']['phantom_file']}: {str(e)}")
+            print(f"Continuing with next job...")
             continue
 
-        phantom_files = []
-        for raw_file in raw_files:
-            cc, ml, pa = extract_phantom_value(raw_file)
-            phantom_files.append((cc, ml, pa, raw_file))
-
-        phantom_files.sort(key=lambda x: x[0])
-
-        for cc, ml, pa, raw_file in phantom_files:
-            for z in range(5, max_z+1, z_interval):
-                filename = os.path.basename(raw_file)
-                try:
-                    new_seed = random_number_generator()
-                except Exception as seed_e:
-                    print(f"Skipping phantom {filename} due to seed generation error: {seed_e}")
-                    continue
-                try:
-                    # Reset working directory at start of each phantom
-                    os.chdir(base_dir)
-
-                    print(f"Processing phantom: {filename} as ML[{ML}] x CC[{cc}] at Z = {z}")
-
-                    results_dir = f"./results/Lucite/Mag_W_Lesions/Main/{ML}/{int(cc)}"
-                    os.makedirs(results_dir, exist_ok=True)
-                    os.makedirs(f"{results_dir}/{new_seed}", exist_ok=True)
-
-                    new_output_file = os.path.basename(raw_file)
-                    z_suffix = f"_Z[{z}]"  # creates "_Z[0]"
-                    new_output_file = new_output_file.replace(".raw.gz", z_suffix)
-                    new_output_file = f"{results_dir}/{new_seed}/{new_output_file}"
-
-                    n_voxels_pa = int(pa / 0.05)
-                    n_voxels_ml = int(ml / 0.05)
-                    n_voxels_cc = int(cc / 0.05)
-
-                    # Create pipeline directly in the loop
-                    pline = Pipeline(
-                        seed=new_seed,
-                        results_folder=results_dir,
-                        phantom_file=f"./phantoms/Lucite/Lesions/{ML}/{filename}",
-                        lesion_file=None,
-                        arguments_mcgpu={
-                            "number_histories": int((5.51e10) * (2.718281828459045 ** (0.4758 * (cc - 2)))),
-                            "selected_gpu": 0,
-                            "number_gpus": 1,
-                            "gpu_threads": 128,
-                            "histories_per_thread": 20433,
-                            "source_position": [0.00001, ml / 2, 73.80141],
-                            "source_direction": [0.0, 0.0, -1.0],
-                            "fam_beam_aperture": [-15.0, 11.203],
-                            "euler_angles": [90.0, -90.0, 180.0],
-                            "focal_spot": 0.0300,
-                            "angular_blur": 0.18,
-                            "collimate_beam": "YES",
-                            "output_file": new_output_file,
-                            "image_pixels": [3584, 2816],
-                            "image_size": [30.464, 23.936],
-                            "distance_source": 76.24441,
-                            "image_offset": [0, 0],
-                            "detector_thickness": 0.02,
-                            "mean_free_path": 0.004027,
-                            "k_edge_energy": [12658.0, 11223.0, 0.596, 0.00593],
-                            "detector_gain": [50.0, 0.99],
-                            "additive_noise": 5200.0,
-                            "cover_thickness": [0.10, 1.9616],
-                            "antiscatter_grid_ratio": [0, 0, 0],
-                            "antiscatter_strips": [0.00089945, 1.9616],
-                            "antiscatter_grid_lines": 0,
-                            "number_projections": 2,
-                            "rotation_axis_distance": 73.80141,
-                            "projections_angle": 5.0,
-                            "angular_rotation_first": -5.0,
-                            "rotation_axis": [1.0, 0.0, 0.0],
-                            "axis_translation": 0,
-                            "detector_fixed": "YES",
-                            "simulate_both": "NO",
-                            "tally_material_dose": "YES",
-                            "tally_voxel_dose": "NO",
-                            "output_dose_filename": "mc-gpu_dose.dat",
-                            "voxel_geometry_offset": [0, 0, z],
-                            "number_voxels": [n_voxels_pa, n_voxels_ml, n_voxels_cc],
-                            "voxel_size": [0.05, 0.05, 0.05],
-                            "low_resolution_voxel_size": [0, 0, 0]
-                        },
-                        materials = [
-                            {"material": "./Victre/projection/material/Air_dry_near_s__5-120keV.mcgpu.gz",
-                            "density": 0.0012,
-                            "voxel_id": [PHANTOM_MATERIALS["air"]]
-                            },
-                            {"material": "./Victre/projection/material/adipose__5-120keV.mcgpu.gz",
-                            "density": 0.92,
-                            "voxel_id": [PHANTOM_MATERIALS["adipose"]]
-                            },
-                            {"material": "./Victre/projection/material/Polymethyl_met__5-120keV.mcgpu.gz",
-                            "density": 1.190,
-                            "voxel_id": [PHANTOM_MATERIALS["Lucite"]]
-                            },
-                            {"material": "./Victre/projection/material/Polymethyl_met__5-120keV.mcgpu.gz",
-                            "density": 1.1543,
-                            "voxel_id": [PHANTOM_MATERIALS["Lucite_lower_density"]]
-                            },
-                            {"material": "./Victre/projection/material/Polymethyl_met__5-120keV.mcgpu.gz",
-                            "density": 1.190,
-                            "voxel_id": [PHANTOM_MATERIALS["Lucite"]]
-                            },
-                            {"material": "./Victre/projection/material/Polymethyl_met__5-120keV.mcgpu.gz",
-                            "density": 1.190,
-                            "voxel_id": [PHANTOM_MATERIALS["Lucite"]]
-                            },
-                            {"material": "./Victre/projection/material/Polymethyl_met__5-120keV.mcgpu.gz",
-                            "density": 1.190,
-                            "voxel_id": [PHANTOM_MATERIALS["Lucite"]]
-                            },
-                            {"material": "./Victre/projection/material/Polymethyl_met__5-120keV.mcgpu.gz",
-                            "density": 1.190,
-                            "voxel_id": [PHANTOM_MATERIALS["Lucite"]]
-                            },
-                            {"material": "./Victre/projection/material/Polymethyl_met__5-120keV.mcgpu.gz",
-                            "density": 1.190,
-                            "voxel_id": [PHANTOM_MATERIALS["Lucite"]]
-                            },
-                            {"material": "./Victre/projection/material/Polymethyl_met__5-120keV.mcgpu.gz",
-                            "density": (0.95 * 1.190),
-                            "voxel_id": [PHANTOM_MATERIALS["Lucite_lower_density"]]
-                            }
-                        ]
-                    )
-
-                    print("MC-GPU arguments:")
-                    for param, value in pline.arguments_mcgpu.items():
-                        print(f"  {param}: {value}")
-
-                    try:
-                        pline.project()
-                        pline.reconstruct()
-                        pline.save_DICOM("dbt")
-                        pline.save_DICOM("DM")
-                    except Exception as e:
-                        print(f"Error during pipeline execution: {str(e)}")
-                        print(f"Continuing with next phantom...")
-                        continue
-                # Catch any exceptions that occur during the processing of the phantom
-                except Exception as e:
-                    print(f"Error processing phantom {filename}: {str(e)}")
-                    continue
-            print(f"Completed all Z values for ML[{ML}] CC[{cc}]")  # After Z loop
-        print(f"Completed all simulations for ML group: {ML}")  # After CC loop
-    print("All phantoms completed successfully.")
+    print("All jobs of this worker completed.")
 
     # Run the stack sorting
-    run_stack_sort()
+    if not args.no_stack_sort:
+        run_stack_sort(planner.spec.get("catalog"))
@@ -1,15 +1,21 @@
 import os
+import json
 import argparse
 import re
 import sys
+import glob
+import sqlite3
+import time
+import datetime
+import contextlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from pathlib import Path
 from tqdm import tqdm
-import cupy as np  # Use CuPy for GPU acceleration
+import numpy as np  # The stacks are assembled in memory-mapped files, on the host
+from array_backend import BACKENDS, get_backend, to_device, to_host
 from fnmatch import fnmatch
 
-# (Optional, original import of numpy commented out)
-# import numpy as np  # Uncomment if you prefer CPU computation
-
 def extract_file_info(filename):
     """
     Extract key values ML, CC and Z from the filename.
@@ -32,29 +38,240 @@ def extract_file_info(filename):
     else:
         return None
 
-def process_raw_file(file_path, slice_size, np_dtype, width, height):
+def process_raw_file(file_path, slice_size, np_dtype, width, height, stacks, index, xp=np):
     """
-    Processes a single .raw file, splitting it into two slices and computing the subtraction.
-    Returns a tuple of 3 arrays (primary, secondary, scatter) or (None, None, None) on failure.
+    Processes a single .raw file, reading its two slices straight into position `index` of the
+    (Primary+Scatter, Primary, Scatter) stacks and computing the subtraction with the xp backend.
+    Returns True on success or False on failure.
     """
+    stack_ps, stack_p, stack_sc = stacks
     try:
         with open(file_path, 'rb') as f:
-            data = f.read()
+            # Each slice is read at its offset directly into the output buffer, no intermediate copies.
+            for offset, stack in [(0, stack_ps), (slice_size, stack_p)]:
+                f.seek(offset)
+                if f.readinto(stack[index]) != slice_size:
+                    print(f"Warning: File {file_path} is shorter than expected {slice_size*2} bytes")
+                    return False
+        if xp is np:
+            np.subtract(stack_ps[index], stack_p[index], out=stack_sc[index])
+        else:
+            # Device round trip, the memmaps live on the host
+            stack_sc[index] = to_host(xp.subtract(to_device(stack_ps[index], xp), to_device(stack_p[index], xp)))
+        return True
+
+    except Exception as e:
+        print(f"Error processing {file_path}: {str(e)}")
+        return False
+
+def valid_files(file_list, slice_size):
+    """
+    Keep the (z_value, file_path) tuples whose file has the expected size of two slices, so the
+    stacks can be preallocated with the final number of slices.
+    """
+    valid = []
+    for z_val, file_path in file_list:
+        try:
+            file_size = os.path.getsize(file_path)
+        except OSError as e:
+            print(f"Error processing {file_path}: {str(e)}")
+            continue
+        if file_size != slice_size * 2:
+            print(f"Warning: File {file_path} has size {file_size} bytes vs expected {slice_size*2} bytes")
+            continue
+        valid.append((z_val, file_path))
+    return valid
+
+def read_slices(stacks, tasks, slice_size, np_dtype, width, height, io_threads, desc, xp=np):
+    """
+    Reads the files of the (index, z_value, file_path) tasks into their Z positions of the stacks
+    with a pool of io_threads threads, that prefetch the next slices while the previous ones finish
+    as reading is bound by the storage latency (e.g. on NFS). Returns the number of bytes read and
+    the set of Z positions whose file could not be read, to be removed from the stacks.
+    """
+    bytes_read = 0
+    failed = []
+    with ThreadPoolExecutor(max_workers=io_threads) as pool:
+        # At most 2 * io_threads reads are in flight, each one writes into its own Z position.
+        pending = deque()
+        progress = tqdm(total=len(tasks), desc=desc)
+        tasks = iter(tasks)
+        while True:
+            while len(pending) < 2 * io_threads:
+                try:
+                    idx, z_val, file_path = next(tasks)
+                except StopIteration:
+                    break
+                pending.append((idx, z_val, file_path,
+                                pool.submit(process_raw_file, file_path, slice_size, np_dtype,
+                                            width, height, stacks, idx, xp)))
+            if not pending:
+                break
+            idx, z_val, file_path, future = pending.popleft()
+            if future.result():
+                bytes_read += 2 * slice_size
+                print(f"Processed slice {idx+1}/{len(stacks[0])} (Z={z_val}) from: {file_path}")
+            else:
+                failed.append(idx)
+                print(f"Failed to process: {file_path}")
+            progress.update(1)
+        progress.close()
+    return bytes_read, set(failed)
+
+def file_signature(file_path):
+    """
+    Size and modification time of a file, to detect source files modified after being stacked.
+    """
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def load_stack_index(index_file, out_files, file_list, slice_size, np_dtype, width, height):
+    """
+    Load the sidecar index of a stack, the list of (z_value, file_path) slices it already contains.
+    Returns None if the stacks have to be rebuilt: no index, different image format, stack files with
+    a different size, or stacked source files that were modified or are no longer found.
+    """
+    try:
+        with open(index_file, 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if [index.get('width'), index.get('height'), index.get('dtype')] != [width, height, np.dtype(np_dtype).name]:
+        return None
+    if any(not os.path.exists(f) or os.path.getsize(f) != len(index['slices']) * slice_size for f in out_files):
+        return None
+    current = dict((file_path, z_val) for z_val, file_path in file_list)
+    for entry in index['slices']:
+        if current.get(entry['file']) != entry['z'] or file_signature(entry['file']) != entry['signature']:
+            return None
+    return [(entry['z'], entry['file']) for entry in index['slices']]
+
+def save_stack_index(index_file, slices, np_dtype, width, height):
+    """
+    Write the sidecar index of a stack, with the Z value, source file and its signature of every slice.
+    """
+    index = {'width': width, 'height': height, 'dtype': np.dtype(np_dtype).name,
+             'slices': [{'z': z_val, 'file': file_path, 'signature': file_signature(file_path)}
+                        for z_val, file_path in slices]}
+    with open(index_file + '.tmp', 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(index_file + '.tmp', index_file)
 
-        if len(data) != slice_size * 2:
-            print(f"Warning: File {file_path} has size {len(data)} bytes vs expected {slice_size*2} bytes")
-            return None, None, None
+def insert_slices(stacks, positions):
+    """
+    Move the slices already in the (extended) stacks to their new Z positions, from the end to the
+    start so no slice is overwritten before being moved. positions[i] is the new position of slice i,
+    slices before the first insertion do not move.
+    """
+    for old_idx in range(len(positions) - 1, -1, -1):
+        if positions[old_idx] == old_idx:
+            break
+        for stack in stacks:
+            stack[positions[old_idx]] = stack[old_idx]
 
-        data_slice1 = data[:slice_size]
-        data_slice2 = data[slice_size:]
-        arr_slice1 = np.frombuffer(data_slice1, dtype=np_dtype).reshape((height, width))
-        arr_slice2 = np.frombuffer(data_slice2, dtype=np_dtype).reshape((height, width))
-        arr_scatter = (arr_slice1 - arr_slice2).astype(np_dtype)
-        return arr_slice1, arr_slice2, arr_scatter
+def remove_slices(stacks, failed):
+    """
+    Move the slices after the failed Z positions down over them, from the start to the end so no
+    slice is overwritten before being moved. The last len(failed) slices of the stacks are left unused.
+    """
+    new_idx = min(failed)
+    for old_idx in range(new_idx, len(stacks[0])):
+        if old_idx in failed:
+            continue
+        for stack in stacks:
+            stack[new_idx] = stack[old_idx]
+        new_idx += 1
 
+def build_stacks(ml_distance, cc_val, file_list, output_root, slice_size, np_dtype, width, height, io_threads=4, rebuild=False,
+                 backend=None):
+    """
+    Builds the Primary+Scatter, Primary and Scatter stacks of one (ML, CC) group, sorted by Z.
+    The output files are preallocated as memory maps and filled one slice at a time, so the memory
+    used does not depend on the number of slices. A sidecar index keeps the slices already stacked:
+    unless rebuild is True, only the new files are read and inserted at their Z positions.
+    The files that cannot be read are left out of the stacks and of the index, no slice is zero-filled.
+    The backend (numpy or cupy) is resolved in each process, modules cannot be sent to the processes.
+    Returns a tuple (output files or None, bytes read, seconds).
+    """
+    start = time.perf_counter()
+    # Sort files by the Z value.
+    file_list = valid_files(sorted(file_list, key=lambda x: x[0]), slice_size)
+    print(f"\nBuilding stack for ML[{ml_distance}] and CC[{cc_val}] with {len(file_list)} slices (sorted by Z)")
+    if not file_list:
+        print(f"No valid slices for ML[{ml_distance}] CC[{cc_val}]")
+        return None, 0, time.perf_counter() - start
+
+    # Output filenames include ML and CC information.
+    out_prefix = f"ML[{ml_distance}]_CC[{cc_val}]"
+    out_files = [os.path.join(output_root, f"{out_prefix}_Primary_plus_Scatter_Stack.raw"),
+                 os.path.join(output_root, f"{out_prefix}_Primary_Stack.raw"),
+                 os.path.join(output_root, f"{out_prefix}_Scatter_Stack.raw")]
+    index_file = os.path.join(output_root, f"{out_prefix}_Stack_index.json")
+
+    stacked = None if rebuild else load_stack_index(index_file, out_files, file_list, slice_size, np_dtype, width, height)
+    if stacked is not None:
+        stacked_files = set(file_path for _, file_path in stacked)
+        new_files = [(z_val, file_path) for z_val, file_path in file_list if file_path not in stacked_files]
+        if not new_files:
+            print(f"Stacks for ML[{ml_distance}] CC[{cc_val}] are up to date ({len(stacked)} slices)")
+            return out_files, 0, time.perf_counter() - start
+        print(f"Appending {len(new_files)} new slices to the {len(stacked)} already stacked")
+        # Same order as a full build: stable sort by Z of the stacked slices followed by the new ones.
+        slices = sorted(stacked + new_files, key=lambda x: x[0])
+    else:
+        new_files = file_list
+        slices = file_list
+
+    try:
+        # The index is removed while the stacks are modified, an interrupted run is rebuilt from scratch.
+        if os.path.exists(index_file):
+            os.remove(index_file)
+        if stacked is not None:
+            for out_file in out_files:
+                os.truncate(out_file, len(slices) * slice_size)
+            stacks = [np.memmap(out_file, dtype=np_dtype, mode='r+', shape=(len(slices), height, width))
+                      for out_file in out_files]
+        else:
+            stacks = [np.memmap(out_file, dtype=np_dtype, mode='w+', shape=(len(slices), height, width))
+                      for out_file in out_files]
     except Exception as e:
-        print(f"Error processing {file_path}: {str(e)}")
-        return None, None, None
+        print(f"Error saving stacks for ML[{ml_distance}] CC[{cc_val}]: {str(e)}")
+        return None, 0, time.perf_counter() - start
+
+    new_position = dict((entry, idx) for idx, entry in enumerate(slices))
+    if stacked is not None:
+        insert_slices(stacks, [new_position[entry] for entry in stacked])
+
+    bytes_read, failed = read_slices(stacks, [(new_position[entry], entry[0], entry[1]) for entry in new_files],
+                             slice_size, np_dtype, width, height, io_threads,
+                             desc=f"ML[{ml_distance}]_CC[{cc_val}]", xp=get_backend(backend))
+
+    if failed:
+        # The failed files are dropped: the following slices move down and the stacks are shortened.
+        remove_slices(stacks, failed)
+        slices = [entry for idx, entry in enumerate(slices) if idx not in failed]
+        print(f"Dropped {len(failed)} slices that could not be read from ML[{ml_distance}] CC[{cc_val}]")
+    for stack in stacks:
+        stack.flush()
+    del stacks
+    elapsed = time.perf_counter() - start
+    if not slices:
+        for out_file in out_files:
+            os.remove(out_file)
+        print(f"No valid slices for ML[{ml_distance}] CC[{cc_val}]")
+        return None, bytes_read, elapsed
+    if failed:
+        for out_file in out_files:
+            os.truncate(out_file, len(slices) * slice_size)
+    save_stack_index(index_file, slices, np_dtype, width, height)
+    shape = (len(slices), height, width)
+    print(f"Saved stacks for ML[{ml_distance}] CC[{cc_val}]:")
+    print(f"  Primary+Scatter: {shape}")
+    print(f"  Primary:         {shape}")
+    print(f"  Scatter:         {shape}")
+    print(f"  Read {bytes_read / 1024**2:.1f} MB in {elapsed:.1f} s ({bytes_read / 1024**2 / max(elapsed, 1e-9):.1f} MB/s, {io_threads} I/O threads)")
+    return out_files, bytes_read, elapsed
 
 def find_files_in_directory(root_dir, patterns):
     """
@@ -70,6 +287,41 @@ def find_files_in_directory(root_dir, patterns):
                     break
     return matches
 
+def find_files_in_catalog(catalog_file, root_dir, patterns):
+    """
+    Query the results catalog written by the Pipeline for the projections under root_dir whose
+    file name matches any of the patterns, instead of walking the folders and parsing file names.
+    Returns a dictionary {ML_distance folder: {cc_val: [(z_val, file_path), ...]}} and a dictionary
+    with the ML value of each ML_distance folder.
+    """
+    root_dir = os.path.abspath(root_dir)
+    with contextlib.closing(sqlite3.connect(catalog_file)) as db:
+        rows = db.execute("SELECT path, ml, cc, z FROM outputs WHERE stage = 'project' AND path GLOB ? "
+                          "ORDER BY ml, cc, z", (os.path.join(glob.escape(root_dir), '*'),)).fetchall()
+
+    stacks, ml_values = {}, {}
+    for file_path, ml_val, cc_val, z_val in rows:
+        if not any(fnmatch(os.path.basename(file_path), pattern) for pattern in patterns):
+            continue
+        if cc_val is None or z_val is None:
+            print(f"Skipping file (no CC/Z in the catalog): {file_path}")
+            continue
+        # The ML_distance folder is the first folder below the input root, as when walking the folders.
+        ml_distance = os.path.relpath(file_path, root_dir).split(os.sep)[0]
+        ml_values[ml_distance] = ml_val
+        stacks.setdefault(ml_distance, {}).setdefault(int(cc_val), []).append((int(z_val), file_path))
+    return stacks, ml_values
+
+def register_stacks(catalog_file, stack_files, ml_val, cc_val):
+    """
+    Register the stacks in the results catalog so the analysis can find them by ML and CC.
+    """
+    created = datetime.datetime.now().isoformat(timespec="seconds")
+    with contextlib.closing(sqlite3.connect(catalog_file, timeout=60)) as db:
+        with db:  # commits the insertions
+            db.executemany("INSERT OR REPLACE INTO outputs (path, stage, ml, cc, size, created) VALUES (?, 'stack', ?, ?, ?, ?)",
+                           [(os.path.abspath(f), ml_val, cc_val, os.path.getsize(f), created) for f in stack_files])
+
 def main():
     parser = argparse.ArgumentParser(description='Process and stack raw images by ML and CC distance (and sort by Z).')
     parser.add_argument('input_root', help='Input root folder (e.g., /results/Lucite/Homogenous_Lucite/Mag)')
@@ -81,6 +333,16 @@ def main():
     # The pattern lets you activate files ending in _0002.raw.
     parser.add_argument('--patterns', nargs='+', default=['*_0002.raw'],
                         help='Filename patterns to search for (e.g., *_0002.raw)')
+    parser.add_argument('--catalog', default=None,
+                        help='Results catalog written by the Pipeline (e.g. results_catalog.db), used instead of walking the input root')
+    parser.add_argument('--io-threads', type=int, default=4,
+                        help='Number of threads reading the files of each stack (default: 4)')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Number of (ML, CC) stacks built in parallel processes (default: 1)')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Rebuild the stacks from scratch instead of appending only the new files')
+    parser.add_argument('--backend', default=None, choices=BACKENDS,
+                        help='Array backend for the subtraction (default: VICTRE_BACKEND environment variable or numpy)')
     args = parser.parse_args()
 
     input_root = args.input_root
@@ -106,26 +368,31 @@ def main():
 
     os.makedirs(output_root, exist_ok=True)
 
-    # Find ML_distance directories (e.g., "20cm", "40cm", etc.) in the input root.
-    ml_distances = [d for d in os.listdir(input_root)
-                    if os.path.isdir(os.path.join(input_root, d)) and 'cm' in d.lower()]
+    if args.catalog:
+        catalog_stacks, ml_values = find_files_in_catalog(args.catalog, input_root, patterns)
+        ml_distances = [d for d in catalog_stacks if 'cm' in d.lower()]
+    else:
+        # Find ML_distance directories (e.g., "20cm", "40cm", etc.) in the input root.
+        ml_distances = [d for d in os.listdir(input_root)
+                        if os.path.isdir(os.path.join(input_root, d)) and 'cm' in d.lower()]
     if not ml_distances:
         print("Error: No ML_distance directories found in the input root.")
         sys.exit(1)
 
     print(f"Found ML_distance directories: {ml_distances}\n")
 
-    # Process each ML folder separately.
+    # Collect the (ML, CC) groups of every ML folder first, they are independent from each other.
+    groups = []
     for ml_distance in ml_distances:
         ml_dir = os.path.join(input_root, ml_distance)
         print(f"Processing ML directory: {ml_distance}")
 
         # Instead of a single list we now group based on the CC distance.
         # The dictionary key is the CC value, and each value is a list of tuples (z_value, file_path).
-        stacks_dict = {}
+        stacks_dict = catalog_stacks[ml_distance] if args.catalog else {}
 
         # Use the new recursive file search function to find all files matching the patterns.
-        found_files = find_files_in_directory(ml_dir, patterns)
+        found_files = [] if args.catalog else find_files_in_directory(ml_dir, patterns)
         for file_path in found_files:
             # Only process files ending with '_0002.raw'
             if not file_path.endswith('_0002.raw'):
@@ -144,51 +411,35 @@ def main():
             print(f"Warning: No valid files found in ML folder: {ml_distance}")
             continue
 
-        # Process each CC group within the current ML folder.
         for cc_val, file_list in stacks_dict.items():
-            # Sort files by the Z value.
-            file_list.sort(key=lambda x: x[0])
-            print(f"\nBuilding stack for ML[{ml_distance}] and CC[{cc_val}] with {len(file_list)} slices (sorted by Z)")
-
-            stack_primary_and_scatter = []
-            stack_primary = []
-            stack_scatter = []
-
-            for idx, (z_val, file_path) in enumerate(tqdm(file_list, desc=f"ML[{ml_distance}]_CC[{cc_val}]")):
-                arr_slice1, arr_slice2, arr_scatter = process_raw_file(file_path, slice_size, np_dtype, width, height)
-                if arr_slice1 is not None:
-                    stack_primary_and_scatter.append(arr_slice1)
-                    stack_primary.append(arr_slice2)
-                    stack_scatter.append(arr_scatter)
-                    print(f"Processed slice {idx+1}/{len(file_list)} (Z={z_val}) from: {file_path}")
-                else:
-                    print(f"Failed to process: {file_path}")
-
-            if stack_primary_and_scatter:
-                stack_ps = np.stack(stack_primary_and_scatter)
-                stack_p  = np.stack(stack_primary)
-                stack_sc = np.stack(stack_scatter)
-
-                # Output filenames include ML and CC information.
-                out_prefix = f"ML[{ml_distance}]_CC[{cc_val}]"
-                out_file_ps = os.path.join(output_root, f"{out_prefix}_Primary_plus_Scatter_Stack.raw")
-                out_file_p  = os.path.join(output_root, f"{out_prefix}_Primary_Stack.raw")
-                out_file_sc = os.path.join(output_root, f"{out_prefix}_Scatter_Stack.raw")
+            groups.append((ml_distance, cc_val, file_list))
 
+    # Process each (ML, CC) group, in parallel processes if requested.
+    start = time.perf_counter()
+    total_bytes = 0
+    build_args = (output_root, slice_size, np_dtype, width, height, args.io_threads, args.rebuild, args.backend)
+    if args.processes > 1:
+        with ProcessPoolExecutor(max_workers=args.processes) as pool:
+            futures = {pool.submit(build_stacks, ml_distance, cc_val, file_list, *build_args): (ml_distance, cc_val)
+                       for ml_distance, cc_val, file_list in groups}
+            results = []
+            for future in as_completed(futures):
                 try:
-                    stack_ps.tofile(out_file_ps)
-                    stack_p.tofile(out_file_p)
-                    stack_sc.tofile(out_file_sc)
-                    print(f"Saved stacks for ML[{ml_distance}] CC[{cc_val}]:")
-                    print(f"  Primary+Scatter: {stack_ps.shape}")
-                    print(f"  Primary:         {stack_p.shape}")
-                    print(f"  Scatter:         {stack_sc.shape}")
+                    results.append((*futures[future], future.result()))
                 except Exception as e:
-                    print(f"Error saving stacks for ML[{ml_distance}] CC[{cc_val}]: {str(e)}")
-            else:
-                print(f"No valid slices for ML[{ml_distance}] CC[{cc_val}]")
+                    print(f"Error building stacks for ML[{futures[future][0]}] CC[{futures[future][1]}]: {str(e)}")
+    else:
+        results = [(ml_distance, cc_val, build_stacks(ml_distance, cc_val, file_list, *build_args))
+                   for ml_distance, cc_val, file_list in groups]
+
+    for ml_distance, cc_val, (out_files, bytes_read, _) in results:
+        total_bytes += bytes_read
+        if out_files is not None and args.catalog:
+            register_stacks(args.catalog, out_files, ml_values.get(ml_distance), cc_val)
 
-        print(f"\nCompleted processing for ML folder: {ml_distance}\n{'-'*60}")
+    elapsed = time.perf_counter() - start
+    print(f"\nBuilt {len(results)} stacks, read {total_bytes / 1024**2:.1f} MB in {elapsed:.1f} s "
+          f"({total_bytes / 1024**2 / max(elapsed, 1e-9):.1f} MB/s with {args.processes} processes x {args.io_threads} I/O threads)\n{'-'*60}")
 
     print("All ML and CC distances have been processed successfully.")
 
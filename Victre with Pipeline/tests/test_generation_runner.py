@@ -0,0 +1,129 @@
+import os
+import sys
+import stat
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "Add to Victre Folder"))
+
+from GenerationRunner import GenerationRunner  # noqa: E402
+from StageManifest import StageManifest  # noqa: E402
+
+# stand-in for breastPhantomMain and breastCompressMain: logs when it runs, then fails if the
+# results folder has a `fail` file or writes the phantom of the stage
+STUB = """#!{python:s}
+import os
+import sys
+import time
+
+stage, folder = sys.argv[1:3]
+start = time.time()
+time.sleep(0.3)
+with open(os.path.join(os.path.dirname(folder), "calls.log"), "a") as f:
+    f.write("{{:s}} {{:s}} {{:f}} {{:f}}\\n".format(stage, os.path.basename(folder), start, time.time()))
+if os.path.exists(os.path.join(folder, "fail")):
+    print("Error extracting eigenfunctions")
+    sys.exit(1)
+open(os.path.join(folder, stage + ".mhd"), "w").close()
+"""
+
+
+class StubPipeline:
+    """
+        Runs the stub executable for the generation and compression stages with the same
+        interface as the Pipeline, skipping the stages already recorded in the manifest
+    """
+
+    def __init__(self, results_folder, seed):
+        self.results_folder = results_folder
+        self.seed = seed
+        self.arguments_generation = {"imgRes": 0.5}
+        os.makedirs("{:s}/{:d}".format(results_folder, seed), exist_ok=True)
+        self.manifest = StageManifest("{:s}/{:d}/manifest.json".format(results_folder, seed))
+
+    def _run(self, stage, executable):
+        if stage in self.manifest:
+            return
+        folder = "{:s}/{:d}".format(self.results_folder, self.seed)
+        subprocess.run([executable, stage, folder], stdout=subprocess.DEVNULL)
+        if not os.path.exists("{:s}/{:s}.mhd".format(folder, stage)):
+            raise RuntimeError("{:s} error".format(stage))
+        self.manifest.record(stage, self.manifest.hash(stage, {}), ["{:s}/{:s}.mhd".format(folder, stage)], {})
+
+    def generate_phantom(self, generator):
+        self._run("generate", generator)
+
+    def compress_phantom(self, thickness, compressor):
+        self._run("compress", compressor)
+
+
+def make_stub(tmp_path):
+    stub = tmp_path / "stub.py"
+    stub.write_text(STUB.format(python=sys.executable))
+    stub.chmod(stub.stat().st_mode | stat.S_IEXEC)
+    return str(stub)
+
+
+def read_calls(results_folder):
+    with open(os.path.join(results_folder, "calls.log")) as f:
+        return [(stage, int(seed), float(start), float(end)) for stage, seed, start, end in (line.split() for line in f)]
+
+
+def max_concurrent(calls):
+    return max(len([c for c in calls if c[2] < call[3] and call[2] < c[3]]) for call in calls)
+
+
+def runner(pipelines, stub, **kwargs):
+    return GenerationRunner(pipelines, generator=stub, compressor=stub, verbosity=False, **kwargs)
+
+
+def test_jobs_run_concurrently_up_to_the_number_of_processes(tmp_path):
+    stub = make_stub(tmp_path)
+    results_folder = str(tmp_path / "results")
+    pipelines = [StubPipeline(results_folder, seed) for seed in range(6)]
+
+    status = runner(pipelines, stub, processes=3, memory=10 ** 12).run()
+
+    assert status == {seed: "done" for seed in range(6)}
+    calls = read_calls(results_folder)
+    assert len(calls) == 12
+    assert 1 < max_concurrent(calls) <= 3
+    for seed in range(6):
+        generate, compress = [c for c in calls if c[1] == seed]
+        assert generate[0] == "generate" and compress[0] == "compress"
+        assert generate[3] <= compress[2]
+
+
+def test_jobs_larger_than_the_memory_budget_run_alone(tmp_path):
+    stub = make_stub(tmp_path)
+    results_folder = str(tmp_path / "results")
+    pipelines = [StubPipeline(results_folder, seed) for seed in range(3)]
+    generation_runner = runner(pipelines, stub, processes=3, memory=1)
+
+    assert generation_runner.estimate_compression_memory(pipelines[0].arguments_generation) > \
+        generation_runner.estimate_memory(pipelines[0].arguments_generation) > 1
+    assert generation_runner.run() == {seed: "done" for seed in range(3)}
+    assert max_concurrent(read_calls(results_folder)) == 1
+
+
+def test_failed_job_does_not_stop_the_others_and_is_resumed(tmp_path):
+    stub = make_stub(tmp_path)
+    results_folder = str(tmp_path / "results")
+    pipelines = [StubPipeline(results_folder, seed) for seed in range(4)]
+    open("{:s}/2/fail".format(results_folder), "w").close()
+
+    status = runner(pipelines, stub, processes=2).run()
+
+    assert status[2].startswith("generate error")
+    assert os.path.exists("{:s}/2/output_runner.err".format(results_folder))
+    assert {seed: status[seed] for seed in [0, 1, 3]} == {0: "done", 1: "done", 3: "done"}
+    assert len([c for c in read_calls(results_folder) if c[1] != 2]) == 6
+
+    # the second run only generates and compresses the phantom that failed
+    os.remove("{:s}/2/fail".format(results_folder))
+    os.remove("{:s}/calls.log".format(results_folder))
+    pipelines = [StubPipeline(results_folder, seed) for seed in range(4)]
+
+    status = runner(pipelines, stub, processes=2).run()
+
+    assert status == {0: "skipped", 1: "skipped", 2: "done", 3: "skipped"}
+    assert [c[:2] for c in read_calls(results_folder)] == [("generate", 2), ("compress", 2)]
@@ -0,0 +1,37 @@
+import os
+import time
+import multiprocessing
+
+import pytest
+
+Victre_Tools = pytest.importorskip("Victre.Victre_Tools")
+
+
+def take_seeds(filename, count, results):
+    registry = Victre_Tools.SeedRegistry(filename, legacy_file=None, shared=True)
+    results.put([registry.take(results_folder="worker{:d}".format(os.getpid()), block=5) for _ in range(count)])
+
+
+def test_shared_registry_gives_unique_seeds_to_concurrent_workers(tmp_path):
+    filename = str(tmp_path / "used_seeds.db")
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=take_seeds, args=(filename, 20, results)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    seeds = [seed for _ in workers for seed in results.get(timeout=60)]
+    for worker in workers:
+        worker.join()
+
+    assert len(seeds) == len(set(seeds)) == 80
+    registry = Victre_Tools.SeedRegistry(filename, legacy_file=None, shared=True)
+    assert all(registry.info(seed)["results_folder"].startswith("worker") for seed in seeds)
+    assert not os.path.exists(filename + ".lockdir")
+
+
+def test_stale_lock_is_broken(tmp_path):
+    lock = str(tmp_path / "registry.lock")
+    os.mkdir(lock)
+    os.utime(lock, (time.time() - 1000, time.time() - 1000))
+    with Victre_Tools.file_lock(lock, timeout=5, stale=60):
+        assert os.path.isdir(lock)
+    assert not os.path.exists(lock)
@@ -0,0 +1,41 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "Add to Victre Folder"))
+
+from StageManifest import StageManifest  # noqa: E402
+
+
+def record(manifest, stage, parameters=None):
+    manifest.record(stage, manifest.hash(stage, parameters or {}), [], {})
+
+
+def test_project_depends_on_last_phantom_stage_without_insertions(tmp_path):
+    manifest = StageManifest(str(tmp_path / "manifest.json"))
+    for stage in ["generate", "compress", "crop", "project", "reconstruct"]:
+        record(manifest, stage)
+
+    assert manifest.dependencies("project") == ["crop"]
+    assert manifest.dependents("crop") == {"project", "reconstruct"}
+
+
+def test_recording_crop_again_invalidates_project_and_reconstruct(tmp_path):
+    manifest = StageManifest(str(tmp_path / "manifest.json"))
+    for stage in ["generate", "compress", "crop", "project", "reconstruct"]:
+        record(manifest, stage)
+    project_hash = manifest.hash("project", {})
+
+    record(manifest, "crop", {"size": [100, 100, 100]})
+
+    assert "project" not in manifest
+    assert "reconstruct" not in manifest
+    assert manifest.hash("project", {}) != project_hash
+    assert set(StageManifest(str(tmp_path / "manifest.json")).stages) == {"generate", "compress", "crop"}
+
+
+def test_project_depends_on_compress_without_crop(tmp_path):
+    manifest = StageManifest(str(tmp_path / "manifest.json"))
+    for stage in ["generate", "compress", "project"]:
+        record(manifest, stage)
+
+    assert manifest.dependencies("project") == ["compress"]
@@ -0,0 +1,51 @@
+import os
+import json
+import time
+import multiprocessing
+
+import pytest
+
+WorkQueue = pytest.importorskip("Victre.WorkQueue").WorkQueue
+
+
+def run_worker(folder, name, lease, heartbeat, duration, max_jobs, results):
+    queue = WorkQueue(folder, lease=lease, heartbeat=heartbeat, worker=name, verbosity=False)
+
+    def handler(payload):
+        time.sleep(duration)
+        return {"index": payload["index"], "worker": name}
+
+    results.put((name, queue.work(handler=handler, max_jobs=max_jobs)))
+
+
+def test_every_job_finishes_once_with_a_stalled_worker(tmp_path):
+    folder = str(tmp_path / "queue")
+    queue = WorkQueue(folder, lease=1, verbosity=False)
+    keys = [queue.put({"index": i}) for i in range(8)]
+    results = multiprocessing.Queue()
+
+    # the stalled worker never renews its lease (heartbeat longer than the job) and finishes after it expired,
+    # while another worker is still running the reclaimed job
+    stalled = multiprocessing.Process(target=run_worker, args=(folder, "stalled", 1, 60, 3, 1, results))
+    stalled.start()
+    while queue.status()["running"] == 0:
+        time.sleep(0.05)
+
+    workers = [multiprocessing.Process(target=run_worker, args=(folder, "worker{:d}".format(i), 1, 0.25, 1.5, None, results))
+               for i in range(3)]
+    for worker in workers:
+        worker.start()
+    for process in [stalled] + workers:
+        process.join(timeout=60)
+
+    counts = dict(results.get(timeout=5) for _ in range(4))
+    assert counts["stalled"] == {"done": 0, "failed": 0}
+    assert sum(c["done"] for c in counts.values()) == len(keys)
+    assert queue.status() == {"pending": 0, "running": 0, "done": len(keys), "failed": 0}
+    for key in keys:
+        with open("{:s}/done/{:s}.json".format(folder, key)) as f:
+            job = json.load(f)
+        assert job["result"]["worker"] != "stalled"
+        assert job["result"]["worker"] == job["worker"]
+    assert queue.finalize()
+    assert not queue.finalize()